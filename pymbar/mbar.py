@@ -37,11 +37,17 @@ This module contains implementations of
 
 """
 
+import copy
 import math
+import multiprocessing
+import tempfile
+from timeit import default_timer as _timer
+import six
 import numpy as np
 import numpy.linalg as linalg
 from pymbar import mbar_solvers
-from pymbar.utils import kln_to_kn, kn_to_n, ParameterError, DataError, logsumexp, check_w_normalized
+from pymbar.utils import kln_to_kn, kn_to_n, ParameterError, DataError, logsumexp, blocked_logsumexp, check_w_normalized, \
+    FactorizedReducedPotential
 
 DEFAULT_SOLVER_PROTOCOL = mbar_solvers.DEFAULT_SOLVER_PROTOCOL
 
@@ -71,7 +77,11 @@ class MBAR:
     # =========================================================================
 
     def __init__(self, u_kn, N_k, maximum_iterations=10000, relative_tolerance=1.0e-7, verbose=False, initial_f_k=None,
-                 solver_protocol=None, initialize='zeros', x_kindices=None, **kwargs):
+                 solver_protocol=None, initialize='zeros', x_kindices=None, chunk_size=None,
+                 log_weights_file=None, dtype=np.float64, n_threads=1, subsampling_schedule=None,
+                 subsampling_protocol=None, counts_n=None, compress_duplicates=False, callback=None,
+                 checkpoint_file=None, checkpoint_interval=10, resume_from=None, time_budget=None,
+                 n_processes=1, collapse_duplicate_states=False, **kwargs):
         """Initialize multistate Bennett acceptance ratio (MBAR) on a set of simulation data.
 
         Upon initialization, the dimensionless free energies for all states are computed.
@@ -84,6 +94,11 @@ class MBAR:
         u_kn : np.ndarray, float, shape=(K, N_max)
             ``u_kn[k,n]`` is the reduced potential energy of uncorrelated
             configuration n evaluated at state ``k``.
+            If ``chunk_size`` is given, this may also be an ``np.memmap`` or the
+            filename of a ``.npy`` file, which is then memory-mapped.
+            It may also be a :class:`pymbar.utils.FactorizedReducedPotential`, whose blocks are evaluated
+            on demand and never stored; ``chunk_size`` then defaults to
+            :data:`pymbar.mbar_solvers.DEFAULT_CHUNK_SIZE`.
         u_kln : np.ndarray, float, shape (K, L, N_max)
             If the simulation is in form ``u_kln[k,l,n]`` it is converted to ``u_kn`` format
 
@@ -123,9 +138,15 @@ class MBAR:
             The default will try to solve with an adaptive solver algorithm
             which alternates between self-consistent iteration and
             Newton-Raphson, where the method with the smallest
-            gradient is chosen to improve numerical stability.
-
-        initialize : 'zeros' or 'BAR', optional, Default: 'zeros'
+            gradient is chosen to improve numerical stability.  With
+            mbar_solvers.LARGE_N_STATES or more sampled states, it uses
+            Anderson-accelerated self-consistent iteration instead, which
+            never forms the K x K Hessian.  For many thousands of states,
+            pass solver_protocol=mbar_solvers.HIERARCHICAL_SOLVER_PROTOCOL,
+            which first solves clusters of overlapping states separately;
+            it is never chosen automatically.
+
+        initialize : 'zeros', 'BAR' or 'BAR-tree', optional, Default: 'zeros'
             If equal to 'BAR', use BAR between the pairwise state to
             initialize the free energies.  Eventually, should specify a path;
             for now, it just does it zipping up the states.
@@ -134,13 +155,102 @@ class MBAR:
             maximize the overlap between states. Its up to the user
             to arrange the states in such an order, or at least close to such an order.
             If you are uncertain what the order of states should be, or if it does not make
-            sense to think of states as adjacent, then choose 'zeroes'.
+            sense to think of states as adjacent, then choose 'BAR-tree', which finds the path
+            itself: it uses BAR along the spanning tree of the best-overlapping pairs of states
+            (see :func:`pymbar.mbar_solvers.overlap_spanning_tree`), computed by ``n_processes``
+            processes in parallel.
 
             (default: 'zeros', unless specific values are passed in.)
         x_kindices
             Which state is each x from?  Usually doesn't matter, but does for BAR. We assume the samples
             are in ``K`` order (the first ``N_k[0]`` samples are from the 0th state, the next ``N_k[1]`` samples from
             the 1st state, and so forth.
+        chunk_size : int, optional, default=None
+            If given, ``u_kn`` is kept as passed (e.g. memory-mapped from disk) rather than copied into memory,
+            and the free energies and log weights are computed in blocks of ``chunk_size`` samples.
+            See :class:`pymbar.mbar_solvers.ChunkedMBARContext`.  The solver, ``Log_W_nk`` and the sums over
+            states in the analysis methods are out-of-core; the other arrays of the analysis methods are not.
+        log_weights_file : str, optional, default=None
+            Only used with ``chunk_size``: file in which ``Log_W_nk`` is stored as an ``np.memmap``.
+            If None, an anonymous temporary file is used.
+        dtype : np.dtype or str, optional, default=np.float64
+            Storage precision of ``u_kn`` and ``Log_W_nk``, either ``'float64'`` or ``'float32'``.
+            With ``'float32'``, the per-sample minimum is subtracted from ``u_kn`` (as in
+            :func:`pymbar.mbar_solvers.precondition_u_kn`) before it is rounded to single precision
+            and stored, halving the memory of both matrices.  The solver arithmetic and all sums
+            over samples are still carried out in double precision, the solver keeps its shifts of
+            ``u_kn`` in double precision rather than rounding them into the stored values, and its
+            result is polished by a Newton step in double precision.
+        n_threads : int, optional, default=1
+            Number of threads used for the sums over states and samples, in the solver and in the
+            methods that recompute weights.  If None or 0, one thread per CPU is used.
+            See :func:`pymbar.utils.blocked_logsumexp`.
+        subsampling_schedule : tuple(float), 'auto' or None, optional, default=None
+            Fractions of the samples of each state to solve on, in order, before ``solver_protocol``
+            is run on all of the data; each level starts from the free energies of the previous one.
+            The subsamples are stratified by ``x_kindices``.  If ``'auto'``, the schedule is chosen from
+            ``N_k`` by :func:`pymbar.mbar_solvers.default_subsampling_schedule`, which only subsamples
+            large data sets.  If None, the full data is solved directly.  An explicit ``solver_protocol``
+            is run as given after the subsampled levels; see :func:`pymbar.mbar_solvers.solve_mbar_for_all_states`.
+        subsampling_protocol : list(dict) or None, optional, default=None
+            Solver protocol for the coarsest subsampled level, in the format of ``solver_protocol``.
+            Finer levels are warm-started with Newton steps using the Hessian of the level before.
+            If None, :data:`pymbar.mbar_solvers.DEFAULT_SUBSAMPLING_PROTOCOL` is used.
+        counts_n : np.ndarray, float, shape=(N), optional, default=None
+            ``counts_n[n]`` is the multiplicity of sample ``n``, i.e. the number of identical samples
+            (or the bootstrap count) it stands for; if None, every sample counts once.  ``N_k`` must
+            count the samples with their multiplicities, so that ``N_k.sum() == counts_n.sum()``.
+            ``W_nk[n, k]`` is then the total weight of the copies of sample ``n``, so that sums over
+            ``n`` of ``W_nk`` and expectations are unchanged, and all uncertainties are those of the
+            expanded data set.  Unless ``x_kindices`` is given, the samples are assumed to be ordered
+            by state, with the counts of the first samples adding up to ``N_k[0]``, and so on.
+        compress_duplicates : bool, optional, default=False
+            If True, samples from the same state whose columns of ``u_kn`` are identical (as happens with
+            discrete energies or restarted trajectories) are merged into one sample with a multiplicity
+            before solving, see :func:`pymbar.mbar_solvers.compress_duplicate_samples`.
+            ``sample_index_n[n]`` is the distinct sample that input sample ``n`` was merged into.
+            Only the solve uses the merged samples: copies of a sample have the same weight, so
+            ``Log_W_nk`` and all other attributes are then expanded back to the input samples.
+            Cannot be used with ``chunk_size``.
+        callback : callable, optional, default=None
+            Called with each telemetry record of the solver as it is produced: one per iteration
+            (``record['event'] == 'iteration'``) and one per solver step (``'step'``), with the
+            method, gradient norms, relative changes, wall times, kernel times and evaluation counts;
+            see :func:`pymbar.mbar_solvers.solve_mbar_once`.  Whether or not it is given, the step
+            records, each with the list of its iteration records, are kept in ``solver_trace``.
+        checkpoint_file : str, optional, default=None
+            If given, the progress of the solver (the current free energies, subsampling level, protocol
+            step and iteration, and a hash of the input data) is saved to this file every
+            ``checkpoint_interval`` iterations and after every solver step, so that a solve killed before
+            it finishes can be continued with ``resume_from``; see
+            :class:`pymbar.mbar_solvers.SolverCheckpoint`.
+        checkpoint_interval : int, optional, default=10
+            Number of solver iterations between saves to ``checkpoint_file``.
+        resume_from : str, optional, default=None
+            Checkpoint file of an interrupted solve of the same data with the same options.  The solve
+            continues from where the checkpoint was saved instead of from ``initialize`` or ``initial_f_k``.
+            Raises ParameterError if the checkpoint was written for different ``u_kn``, ``N_k`` or
+            ``counts_n``.  It may be the same file as ``checkpoint_file``.
+        time_budget : float, optional, default=None
+            If given, the solver is stopped after this many seconds and the iterate with the lowest
+            gradient norm found so far is used, see :func:`pymbar.mbar_solvers.solve_mbar_for_all_states`.
+            Whether the budget was exhausted, the gradient norm of the result and an estimate of its
+            remaining error (see :func:`pymbar.mbar_solvers.estimate_error`) are then kept in
+            ``convergence``, so that the caller can decide whether to accept it.
+        n_processes : int or None, optional, default=1
+            The states are split into the groups whose free energy differences the samples determine,
+            see :func:`pymbar.mbar_solvers.state_components`; ``n_components`` and ``components_k``
+            keep the number of groups and the group of each state.  If there are several, e.g. two
+            alchemical legs stored with infinite energies across, each group is solved separately, by
+            ``n_processes`` processes in parallel (None for one per CPU), and differences between
+            groups are reported as NaN.
+        collapse_duplicate_states : bool, optional, default=False
+            States whose reduced potentials agree on all samples (the sum of their squared differences
+            is below ``relative_tolerance``, see :func:`pymbar.mbar_solvers.duplicate_states`) are always
+            found, kept in ``representatives_k`` (the first state of the group of duplicates of each state)
+            and ``samestates``, and their differences are reported as zero.  If True, the samples of each
+            group are also pooled into its first state for the solve, so that the solvers handle one state
+            per group; the free energies of the others are then computed from the solution.
 
         Notes
         -----
@@ -193,17 +303,47 @@ class MBAR:
             self.K = np.shape(u_kn)[1]  # need to set self.K, and it's the second index
             u_kn = kln_to_kn(u_kn, N_k=self.N_k)
 
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.float32, np.float64):
+            raise ParameterError("dtype must be float32 or float64, not %s" % self.dtype)
+
         # u_kn[k,n] is the reduced potential energy of sample n evaluated at state k
-        self.u_kn = np.array(u_kn, dtype=np.float64)
+        # In single precision, u_kn is stored relative to the per-sample shift u_shift_n.
+        self.u_shift_n = None
+        if chunk_size is None and isinstance(u_kn, FactorizedReducedPotential):
+            chunk_size = mbar_solvers.DEFAULT_CHUNK_SIZE
+        if chunk_size is None:
+            # Stored state-major (C order) whatever the input layout, so that both the sums over states
+            # and over samples in blocked_logsumexp run over long contiguous rows of u_kn.
+            if self.dtype == np.float64:
+                self.u_kn = np.array(u_kn, dtype=np.float64, order='C')
+            else:
+                u_kn = np.asarray(u_kn)
+                self.u_shift_n = np.asarray(u_kn.min(0), dtype=np.float64)
+                self.u_kn = np.empty(u_kn.shape, dtype=self.dtype)
+                np.subtract(u_kn, self.u_shift_n, out=self.u_kn, casting='unsafe')
+        else:
+            if isinstance(u_kn, six.string_types):
+                u_kn = np.load(u_kn, mmap_mode='r')
+            self.u_kn = u_kn  # Streamed in blocks by the solver, never copied as a whole.
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
 
         K, N = np.shape(u_kn)
 
         if verbose:
             print("K (total states) = %d, total samples = %d" % (K, N))
 
-        if np.sum(self.N_k) != N:
+        self.counts_n = mbar_solvers.validate_counts(counts_n, N)
+        self.log_counts_n = None
+        if self.counts_n is not None:
+            with np.errstate(divide='ignore'):
+                self.log_counts_n = np.log(self.counts_n)
+        if self.counts_n is None and np.sum(self.N_k) != N:
             raise ParameterError(
                 'The sum of all N_k must equal the total number of samples (length of second dimension of u_kn.')
+        if self.counts_n is not None and not np.isclose(np.sum(self.N_k), self.counts_n.sum()):
+            raise ParameterError('The sum of all N_k must equal the sum of counts_n.')
 
         # Store local copies of other data
         self.K = K  # number of thermodynamic states energies are evaluated at
@@ -213,6 +353,11 @@ class MBAR:
         # if not defined, identify from which state each sample comes from.
         if x_kindices is not None:
             self.x_kindices = x_kindices
+        elif self.counts_n is not None:
+            # Each state's samples end where the running total of their counts reaches N_k.
+            ends_k = np.searchsorted(np.cumsum(self.counts_n), np.cumsum(self.N_k) - 0.5) + 1
+            ends_k[self.N_k.cumsum() == 0] = 0
+            self.x_kindices = np.searchsorted(ends_k, np.arange(N), side='right').astype(np.int64)
         else:
             self.x_kindices = np.arange(N, dtype=np.int64)
             Nsum = 0
@@ -220,6 +365,24 @@ class MBAR:
                 self.x_kindices[Nsum:Nsum+self.N_k[k]] = k
                 Nsum += self.N_k[k]
 
+        # Merge identical samples until the weights are computed, keeping the map back to the input samples.
+        self.sample_index_n = None
+        if compress_duplicates:
+            if chunk_size is not None:
+                raise ParameterError('compress_duplicates cannot be used with chunk_size.')
+            input_samples = (self.u_kn, self.u_shift_n, self.x_kindices, self.counts_n, self.log_counts_n, self.N)
+            unique_n, self.sample_index_n, self.counts_n = mbar_solvers.compress_duplicate_samples(
+                u_kn, x_kindices=self.x_kindices, counts_n=self.counts_n)
+            with np.errstate(divide='ignore'):
+                self.log_counts_n = np.log(self.counts_n)
+            self.u_kn = self.u_kn[:, unique_n]
+            if self.u_shift_n is not None:
+                self.u_shift_n = self.u_shift_n[unique_n]
+            self.x_kindices = np.asarray(self.x_kindices)[unique_n]
+            self.N = N = len(unique_n)
+            if verbose:
+                print("%d distinct samples after merging duplicates." % N)
+
         # verbosity level -- if True, will print extra debug information
         self.verbose = verbose
 
@@ -228,23 +391,21 @@ class MBAR:
         # if, for any set of data, all reduced potential energies are the same,
         # they are probably the same state.  We check to within
         # relative_tolerance.
-
+        self.representatives_k = mbar_solvers.duplicate_states(
+            self.u_kn, counts_n=self.counts_n, tolerance=relative_tolerance,
+            chunk_size=chunk_size or mbar_solvers.DEFAULT_CHUNK_SIZE)
         self.samestates = []
-        if self.verbose:
-            for k in range(K):
-                for l in range(k):
-                    diffsum = 0
-                    uzero = u_kn[k, :] - u_kn[l, :]
-                    diffsum += np.dot(uzero, uzero)
-                    if (diffsum < relative_tolerance):
-                        self.samestates.append([k, l])
-                        self.samestates.append([l, k])
-                        print('')
-                        print('Warning: states %d and %d have the same energies on the dataset.' % (l, k))
-                        print('They are therefore likely to to be the same thermodynamic state.  This can occasionally cause')
-                        print('numerical problems with computing the covariance of their energy difference, which must be')
-                        print('identically zero in any case. Consider combining them into a single state.')
-                        print('')
+        for k in np.where(self.representatives_k != np.arange(K))[0]:
+            for l in np.where(self.representatives_k[:k] == self.representatives_k[k])[0]:
+                self.samestates.append([k, l])
+                self.samestates.append([l, k])
+                if self.verbose:
+                    print('')
+                    print('Warning: states %d and %d have the same energies on the dataset.' % (l, k))
+                    print('They are therefore likely to to be the same thermodynamic state.  This can occasionally cause')
+                    print('numerical problems with computing the covariance of their energy difference, which must be')
+                    print('identically zero in any case. Consider combining them into a single state.')
+                    print('')
 
         # Print number of samples from each state.
         if self.verbose:
@@ -267,7 +428,11 @@ class MBAR:
 
         # If an initial guess of the relative dimensionless free energies is
         # specified, start with that.
-        if initial_f_k is not None:
+        if resume_from is not None:
+            # The solver starts from the free energies saved in the checkpoint.
+            if self.verbose:
+                print("Resuming the solve from checkpoint %s." % resume_from)
+        elif initial_f_k is not None:
             if self.verbose:
                 print("Initializing f_k with provided initial guess.")
             # Cast to np array.
@@ -284,25 +449,96 @@ class MBAR:
             self.f_k[:] = self.f_k[:] - self.f_k[0]
         else:
             # Initialize estimate of relative dimensionless free energies.
-            self._initializeFreeEnergies(verbose, method=initialize)
+            self._initializeFreeEnergies(verbose, method=initialize, n_processes=n_processes)
 
             if self.verbose:
                 print("Initial dimensionless free energies with method %s" % (initialize))
                 print("f_k = ")
                 print(self.f_k)
 
+        # The numbers of samples and the origins of the samples seen by the solvers.
+        self._solver_N_k, solver_x_kindices = self.N_k, self.x_kindices
+        if collapse_duplicate_states and len(self.samestates) > 0:
+            # Each group of duplicates is solved as its first state, with the samples of all of them.
+            self._solver_N_k = np.bincount(self.representatives_k, weights=self.N_k, minlength=K)
+            solver_x_kindices = self.representatives_k.take(self.x_kindices, mode='clip')
+            if self.verbose:
+                print("Solving for %d distinct states." % len(np.unique(self.representatives_k)))
+
         if solver_protocol is None:
             solver_protocol = ({'method': None},)
+        # Options for this data set are added to copies, not to the caller's (or a module-level) protocol.
+        solver_protocol = tuple(dict(solver, options=dict(solver.get('options') or dict())) for solver in solver_protocol)
         for solver in solver_protocol:
-            if 'options' not in solver:
-                solver['options'] = dict()
             if 'verbose' not in solver['options']:
                 # should add in other ways to get information out of the scipy solvers, not just adaptive,
                 # which might involve passing in different combinations of options, and passing out other strings.
                 solver['options']['verbose'] = self.verbose
-
-        self.f_k = mbar_solvers.solve_mbar_for_all_states(self.u_kn, self.N_k, self.f_k, solver_protocol)
-        self.Log_W_nk = mbar_solvers.mbar_log_W_nk(self.u_kn, self.N_k, self.f_k)
+            if solver.get('method') == 'stochastic':
+                # Minibatches are stratified by the state each sample came from.
+                solver['options'].setdefault('x_kindices', solver_x_kindices)
+            elif solver.get('method') == 'hierarchical':
+                # Clusters are solved with the samples drawn from their states, numbered among the states with samples.
+                solver['options'].setdefault('x_kindices', np.cumsum(self._solver_N_k > 0)[solver_x_kindices] - 1)
+
+        # Free energy differences are only defined within groups of states linked by samples with finite energies.
+        self.n_components, self.components_k = mbar_solvers.state_components(
+            self.u_kn, self.N_k, x_kindices=self.x_kindices, counts_n=self.counts_n,
+            chunk_size=chunk_size or mbar_solvers.DEFAULT_CHUNK_SIZE)
+        if self.n_components > 1 and self.verbose:
+            print("The states fall into %d disconnected components, which are solved separately:" % self.n_components)
+            print(self.components_k)
+
+        checkpoint = None
+        if checkpoint_file is not None:
+            checkpoint = mbar_solvers.SolverCheckpoint(checkpoint_file, interval=checkpoint_interval)
+        # Scratch arrays of the solvers, reused by all of their iterations and by later solves (see bootstrap()).
+        self._workspace = mbar_solvers.SolverWorkspace()
+        start = _timer()
+        self.f_k = mbar_solvers.solve_mbar_for_all_states(self.u_kn, self._solver_N_k, self.f_k, solver_protocol,
+                                                          chunk_size=chunk_size, n_threads=n_threads,
+                                                          subsampling_schedule=subsampling_schedule,
+                                                          subsampling_protocol=subsampling_protocol,
+                                                          x_kindices=solver_x_kindices, counts_n=self.counts_n,
+                                                          workspace=self._workspace,
+                                                          callback=self._solverTraceCallback(callback),
+                                                          checkpoint=checkpoint, resume_from=resume_from,
+                                                          time_budget=time_budget, components=self.components_k,
+                                                          n_processes=n_processes)
+        self.convergence = None
+        if time_budget is not None:
+            budget_exhausted = _timer() - start >= time_budget
+            if chunk_size is None:
+                context = mbar_solvers.MBARContext(self.u_kn, self.N_k, n_threads=n_threads, counts_n=self.counts_n,
+                                                   workspace=self._workspace, validate=False)
+            else:
+                context = mbar_solvers.ChunkedMBARContext(self.u_kn, self.N_k, chunk_size=chunk_size,
+                                                          n_threads=n_threads, counts_n=self.counts_n)
+            self.convergence = dict(budget_exhausted=budget_exhausted,
+                                    gradient_norm=np.linalg.norm(context.gradient(self.f_k)),
+                                    estimated_error=mbar_solvers.estimate_error(context, self.f_k))
+            if self.verbose and budget_exhausted:
+                print("Time budget of %g s exhausted: gradient norm %.3g, estimated error %.3g" %
+                      (time_budget, self.convergence['gradient_norm'], self.convergence['estimated_error']))
+        self._workspace.clear()  # Not kept alive between solves.
+        if chunk_size is None:
+            context = mbar_solvers.MBARContext(self.u_kn, self.N_k, n_threads=n_threads, validate=False)
+            self.Log_W_nk = np.asarray(context.log_W_nk(self.f_k), dtype=self.dtype)
+        else:
+            if log_weights_file is None:
+                log_weights_file = tempfile.TemporaryFile()
+            Log_W_nk = np.memmap(log_weights_file, dtype=self.dtype, mode='w+', shape=(N, K))
+            context = mbar_solvers.ChunkedMBARContext(self.u_kn, self.N_k, chunk_size=chunk_size, n_threads=n_threads)
+            self.Log_W_nk = context.log_W_nk(self.f_k, out=Log_W_nk)
+        if self.sample_index_n is not None:
+            # Copies of a sample have the same weight, so the input samples are restored for the analysis methods.
+            self.Log_W_nk = self.Log_W_nk[self.sample_index_n]
+            self.u_kn, self.u_shift_n, self.x_kindices, self.counts_n, self.log_counts_n, self.N = input_samples
+        if self.counts_n is not None:
+            # Each row holds the total weight of all copies of the sample.
+            self.Log_W_nk += self.log_counts_n[:, np.newaxis]
+        # Normalization of Log_W_nk is checked by the first uncertainty calculation; see _checkWeightsNormalized().
+        self._weights_checked = False
 
         # Print final dimensionless free energies.
         if self.verbose:
@@ -394,12 +630,13 @@ class MBAR:
         """
 
         N_eff = np.zeros(self.K)
+        N_total = self.N if self.counts_n is None else self.counts_n.sum()
         for k in range(self.K):
-            w = np.exp(self.Log_W_nk[:,k])
-            N_eff[k] = 1/np.sum(w**2)
+            w = self._expandedWeights(np.exp(self.Log_W_nk[:, k:k + 1]))[:, 0]
+            N_eff[k] = 1/np.sum(w**2, dtype=np.float64)
             if verbose:
                 print("Effective number of sample in state %d is %10.3f" % (k,N_eff[k]))
-                print("Efficiency for state %d is %d/%d = %10.4f" % (k,N_eff[k],len(w),N_eff[k]/len(w)))
+                print("Efficiency for state %d is %d/%d = %10.4f" % (k,N_eff[k],N_total,N_eff[k]/N_total))
 
         return N_eff
 
@@ -444,8 +681,7 @@ class MBAR:
 
         """
 
-        W = np.matrix(self.getWeights(), np.float64)
-        O = np.multiply(self.N_k, W.T * W)
+        O = np.multiply(self.N_k, np.matrix(self._computeGramMatrix(np.exp(self.Log_W_nk)), np.float64))
         (eigenvals, eigevec) = linalg.eig(O)
         # sort in descending order
         eigenvals = np.sort(eigenvals)[::-1]
@@ -484,7 +720,8 @@ class MBAR:
         Possible keys in the result_vals dictionary:
 
         'Delta_f' : np.ndarray, float, shape=(K, K)
-            Deltaf_ij[i,j] is the estimated free energy difference
+            Deltaf_ij[i,j] is the estimated free energy difference, or NaN if states i and j are
+            in different disconnected components (see ``components_k``).
         'dDelta_f' : np.ndarray, float, shape=(K, K)
             If compute_uncertainty==True,
             dDeltaf_ij[i,j] is the estimated statistical uncertainty
@@ -522,6 +759,9 @@ class MBAR:
         self._zerosamestates(Deltaf_ij)
 
         Deltaf_ij = np.array(Deltaf_ij)  # Convert from np.matrix to np.array
+        # Differences between disconnected components are undefined.
+        disconnected_ij = self.components_k[:, np.newaxis] != self.components_k
+        Deltaf_ij[disconnected_ij] = np.nan
 
         result_vals = dict()
 
@@ -538,6 +778,7 @@ class MBAR:
             self._zerosamestates(dDeltaf_ij)
             # Return matrix of free energy differences and uncertainties.
             dDeltaf_ij = np.array(dDeltaf_ij)
+            dDeltaf_ij[disconnected_ij] = np.nan
             result_vals['dDelta_f'] = dDeltaf_ij
 
         if return_theta:
@@ -648,6 +889,8 @@ class MBAR:
         if len(shapeu) == 1:
             u_ln = np.reshape(u_ln,[1,shapeu[0]])
 
+        # The observables are shifted below, so work on a copy: A_n may share memory with u_kn.
+        A_n = np.array(A_n, dtype=np.float64)
         shapeA = np.shape(A_n)
         if len(shapeA) == 1:
             A_n = np.reshape(A_n,[1,shapeA[0]])
@@ -680,7 +923,7 @@ class MBAR:
         # log weight matrix
         msize = K + NL + S # augmented size; all of the states needed to calculate
                            # the observables, and the observables themselves.
-        Log_W_nk = np.zeros([N, msize], np.float64) # log weight matrix
+        Log_W_nk = np.zeros([N, msize], self.Log_W_nk.dtype) # log weight matrix
         N_k = np.zeros([msize], np.int64)  # counts
         f_k = np.zeros([msize], np.float64)  # free energies
 
@@ -691,15 +934,20 @@ class MBAR:
         f_k[0:K] = self.f_k
 
         # Pre-calculate the log denominator: Eqns 13, 14 in MBAR paper
-        states_with_samples = (self.N_k > 0)
-        log_denominator_n = logsumexp(self.f_k[states_with_samples] - self.u_kn[states_with_samples].T, b=self.N_k[states_with_samples], axis=1)
+        log_denominator_n = self._computeLogDenominator()
+        if self.u_shift_n is not None and u_ln is not self.u_kn:
+            # u_ln is not relative to the per-sample shift of the stored u_kn, so take it out of the denominator.
+            log_denominator_n -= self.u_shift_n
         # Compute row of W_nk matrix for the extra states corresponding to u_ln
         # that the state list specifies
         for l in L_list:
             la = K+l  #l, augmented
             # Calculate log normalizing constants and log weights via Eqns 13, 14
-            log_C_a = -logsumexp(-u_ln[l] - log_denominator_n)
-            Log_W_nk[:, la] = log_C_a - u_ln[l] - log_denominator_n
+            log_w_n = -u_ln[l] - log_denominator_n
+            if self.log_counts_n is not None:
+                log_w_n = log_w_n + self.log_counts_n
+            log_C_a = -logsumexp(log_w_n)
+            Log_W_nk[:, la] = log_C_a + log_w_n
             f_k[la] = log_C_a
 
         # Compute the remaining rows/columns of W_nk, and calculate
@@ -722,10 +970,6 @@ class MBAR:
         for s in range(S):
             A_i[s] += (A_min[state_map[1,s]] - 1)
 
-        # these values may be used outside the routine, so copy back.
-        for i in A_list:
-            A_n[i, :] = A_n[i,:] + (A_min[i] - 1)
-
         # expectations of the observables at these states
         if S > 0:
             result_vals['observables'] = A_i
@@ -1255,7 +1499,10 @@ class MBAR:
 
         # Retrieve N and K for convenience.
         [K,N] = np.shape(u_kn)
-        A_in = u_kn.copy()
+        if u_kn is self.u_kn and self.u_shift_n is not None:
+            A_in = self.u_kn + self.u_shift_n  # The energies are the observable here, so undo the per-sample shift.
+        else:
+            A_in = np.array(u_kn, dtype=np.float64)
         state_map = np.zeros([2,K],int)
         for k in range(K):
             state_map[0,k] = k
@@ -1427,7 +1674,7 @@ class MBAR:
         # Compute uncertainties by forming matrix of W_nk.
         N_k = np.zeros([self.K + nbins], np.int64)
         N_k[0:K] = self.N_k
-        W_nk = np.zeros([self.N, self.K + nbins], np.float64)
+        W_nk = np.zeros([self.N, self.K + nbins], self.Log_W_nk.dtype)
         W_nk[:, 0:K] = np.exp(self.Log_W_nk)
         for i in range(nbins):
             # Get indices of samples that fall in this bin.
@@ -1516,10 +1763,130 @@ class MBAR:
             raise ParameterError("Uncertainty method '%s' not recognized." % uncertainties)
 
 
+    #=========================================================================
+    def bootstrap(self, n_bootstraps, functions=None, seed=None, n_processes=1, solver_protocol=None):
+        """
+        Compute bootstrap distributions of any MBAR results.
+
+        Each bootstrap replicate draws ``N_k[k]`` samples with replacement from the samples of each state ``k``
+        (as identified by ``x_kindices``), expressed as the sample multiplicities ``counts_n`` of a copy of this
+        MBAR object that shares ``u_kn``.  Its free energies are solved starting from the converged ``f_k``,
+        and then each of ``functions`` is evaluated on it.
+
+        Parameters
+        ----------
+        n_bootstraps : int
+            Number of bootstrap replicates
+        functions : dict(str, callable), optional
+            ``functions[name](replicate)`` is evaluated on the MBAR object of each replicate, and its results
+            over the replicates are returned under ``name``.  They should not compute uncertainties.
+            If None, only the free energy differences ``'Delta_f'`` are computed.
+        seed : int or None, optional, default=None
+            Seed of the random number generator.  Each replicate has its own generator, seeded from it,
+            so the results do not depend on ``n_processes``.
+        n_processes : int or None, optional, default=1
+            Number of processes the replicates are distributed over.  If None, one per CPU.
+            If greater than one, ``functions`` must be picklable, e.g. functions defined at module level.
+        solver_protocol : list(dict) or None, optional, default=None
+            Solver protocol for the replicates, see :func:`pymbar.mbar_solvers.solve_mbar`.
+            If None, :data:`pymbar.mbar_solvers.COARSE_TO_FINE_SOLVER_METHOD` is used, as for other warm starts.
+
+        Returns
+        -------
+        result_vals : dictionary
+
+        Keys in the result_vals dictionary:
+
+        'f_k' : np.ndarray, float, shape=(n_bootstraps, K)
+            The dimensionless free energies of each replicate
+        name : np.ndarray, shape=(n_bootstraps, ...)
+            The results of ``functions[name]`` for each replicate
+
+        Examples
+        --------
+
+        >>> from pymbar import testsystems
+        >>> (x_n, u_kn, N_k, s_n) = testsystems.HarmonicOscillatorsTestCase().sample(mode='u_kn')
+        >>> mbar = MBAR(u_kn, N_k)
+        >>> functions = {'A': lambda m: m.computeExpectations(x_n, compute_uncertainty=False)['mu']}
+        >>> results = mbar.bootstrap(20, functions=functions, seed=0)
+        >>> dA_k = results['A'].std(0)
+
+        """
+        if functions is None:
+            functions = {'Delta_f': _bootstrap_free_energy_differences}
+        seeds = np.random.RandomState(seed).randint(2**31, size=n_bootstraps)
+        if n_processes == 1:
+            _bootstrap_initialize(self, functions, solver_protocol)
+            try:
+                replicates = [_bootstrap_replicate(replicate_seed) for replicate_seed in seeds]
+            finally:
+                _bootstrap_state.clear()
+                self._workspace.clear()
+        else:
+            pool = multiprocessing.Pool(n_processes, initializer=_bootstrap_initialize,
+                                        initargs=(self, functions, solver_protocol))
+            try:
+                replicates = pool.map(_bootstrap_replicate, seeds)
+            finally:
+                pool.close()
+                pool.join()
+
+        result_vals = dict()
+        for name in replicates[0]:
+            result_vals[name] = np.array([replicate[name] for replicate in replicates])
+        return result_vals
+
     #=========================================================================
     # PRIVATE METHODS - INTERFACES ARE NOT EXPORTED
     #=========================================================================
 
+    def _bootstrapReplicate(self, random_state, solver_protocol=None):
+        """
+        Return a copy of this MBAR object for a bootstrap resample of the samples of each state.
+
+        REQUIRED ARGUMENTS
+          random_state (np.random.RandomState) - source of the resampling
+
+        OPTIONAL ARGUMENTS
+          solver_protocol (list(dict)) - solver protocol, see mbar_solvers.solve_mbar
+            (default: None, which uses mbar_solvers.COARSE_TO_FINE_SOLVER_METHOD)
+
+        RETURN VALUES
+          replicate (MBAR) - MBAR object sharing u_kn, with the resample given by counts_n
+
+        NOTES
+          Samples are drawn in proportion to their multiplicities, if any.
+        """
+        counts_n = np.zeros(self.N, dtype=np.float64)
+        weights_n = np.ones(self.N) if self.counts_n is None else self.counts_n
+        for k in self.states_with_samples:
+            n = np.where(self.x_kindices == k)[0]
+            counts_n[n] = random_state.multinomial(self.N_k[k], weights_n[n] / weights_n[n].sum())
+
+        replicate = copy.copy(self)
+        replicate.counts_n = counts_n
+        with np.errstate(divide='ignore'):
+            replicate.log_counts_n = np.log(counts_n)
+        if solver_protocol is None:
+            # Starting this close to the solution, Hessian-free iteration converges in a few steps.
+            solver_protocol = ({'method': mbar_solvers.COARSE_TO_FINE_SOLVER_METHOD},)
+        solver_protocol = tuple(dict(step, options=dict(step.get('options', dict()))) for step in solver_protocol)
+        replicate.f_k = mbar_solvers.solve_mbar_for_all_states(self.u_kn, self._solver_N_k, self.f_k.copy(), solver_protocol,
+                                                               chunk_size=self.chunk_size, n_threads=self.n_threads,
+                                                               subsampling_schedule=(), counts_n=counts_n,
+                                                               workspace=self._workspace, components=self.components_k,
+                                                               callback=replicate._solverTraceCallback())
+        if self.chunk_size is None:
+            context = mbar_solvers.MBARContext(self.u_kn, self.N_k, n_threads=self.n_threads, validate=False)
+        else:
+            context = mbar_solvers.ChunkedMBARContext(self.u_kn, self.N_k, chunk_size=self.chunk_size,
+                                                      n_threads=self.n_threads)
+        replicate.Log_W_nk = np.asarray(context.log_W_nk(replicate.f_k), dtype=self.dtype)
+        replicate.Log_W_nk += replicate.log_counts_n[:, np.newaxis]
+        replicate._weights_checked = False
+        return replicate
+
     def _ErrorOfDifferences(self, cov, warning_cutoff=1.0e-10):
         """
         inputs:
@@ -1624,21 +1991,21 @@ class MBAR:
         if(K != N_k.size):
             raise ParameterError(
                 'W must be NxK, where N_k is a K-dimensional array.')
-        if(np.sum(N_k) != N):
-            raise ParameterError('W must be NxK, where N = sum_k N_k.')
+        if self.counts_n is None:
+            if(np.sum(N_k) != N):
+                raise ParameterError('W must be NxK, where N = sum_k N_k.')
+        elif N != self.counts_n.size or not np.isclose(np.sum(N_k), self.counts_n.sum()):
+            raise ParameterError('W must be NxK, where sum_k N_k = sum_n counts_n.')
 
-        check_w_normalized(W, N_k)
+        self._checkWeightsNormalized()
 
         # Compute estimate of asymptotic covariance matrix using specified method.
         if method == 'approximate':
             # Use fast approximate expression from Kong et al. -- this underestimates the true covariance, but may be a good approximation in some cases and requires no matrix inversions
             # Theta = P'P
 
-            # Construct matrices
-            W = np.matrix(W, dtype=np.float64)
-
             # Compute covariance
-            Theta = W.T * W
+            Theta = np.matrix(self._computeGramMatrix(W))
 
         elif method == 'svd':
             # Use singular value decomposition based approach given in supplementary material to efficiently compute uncertainty
@@ -1646,7 +2013,7 @@ class MBAR:
 
             # Construct matrices
             Ndiag = np.matrix(np.diag(N_k), dtype=np.float64)
-            W = np.matrix(W, dtype=np.float64)
+            W = np.matrix(self._expandedWeights(W), dtype=np.float64)
             I = np.identity(K, dtype=np.float64)
 
             # Compute SVD of W
@@ -1665,13 +2032,12 @@ class MBAR:
 
             # Construct matrices
             Ndiag = np.matrix(np.diag(N_k), dtype=np.float64)
-            W = np.matrix(W, dtype=np.float64)
             I = np.identity(K, dtype=np.float64)
 
             # Compute singular values and right singular vectors of W without using SVD
             # Instead, we compute eigenvalues and eigenvectors of W'W.
             # Note W'W = (U S V')'(U S V') = V S' U' U S V' = V (S'S) V'
-            [S2, V] = linalg.eigh(W.T * W)
+            [S2, V] = linalg.eigh(self._computeGramMatrix(W))
             # Set any slightly negative eigenvalues to zero.
             S2[np.where(S2 < 0.0)] = 0.0
             # Form matrix of singular values Sigma, and V.
@@ -1690,7 +2056,52 @@ class MBAR:
 
     #=========================================================================
 
-    def _initializeFreeEnergies(self, verbose=False, method='zeros'):
+    def _computeGramMatrix(self, W):
+        """
+        Compute W'W in double precision.
+
+        REQUIRED ARGUMENTS
+          W (np NxK array) - weight matrix, possibly stored in single precision
+
+        RETURN VALUES
+          WtW (np KxK array) - W'W
+
+        NOTES
+          Single-precision weights are converted in blocks of samples, so no full-size double-precision copy is made.
+          With sample multiplicities, this is W'W of the expanded data set, see `_expandedWeights()`.
+        """
+        W = np.asarray(W)
+        if W.dtype == np.float64 and self.counts_n is None:
+            return np.dot(W.T, W)
+        [N, K] = W.shape
+        block_size = max(1, 2**20 // K)
+        WtW = np.zeros([K, K], np.float64)
+        for start in range(0, N, block_size):
+            W_block = self._expandedWeights(np.array(W[start:start + block_size], dtype=np.float64), start=start)
+            WtW += np.dot(W_block.T, W_block)
+        return WtW
+
+    def _expandedWeights(self, W, start=0):
+        """
+        Scale the rows of W so that W'W is that of the data set with every sample repeated counts_n times.
+
+        REQUIRED ARGUMENTS
+          W (np NxK array) - weight matrix, whose rows are the total weights of all copies of each sample
+
+        OPTIONAL ARGUMENTS
+          start (int) - index of the sample in the first row of W (default: 0)
+
+        RETURN VALUES
+          W (np NxK array) - W_nk / sqrt(counts_n), or W itself if every sample counts once
+        """
+        if self.counts_n is None:
+            return W
+        counts_n = self.counts_n[start:start + W.shape[0]]
+        return W / np.sqrt(np.where(counts_n > 0, counts_n, 1.0))[:, np.newaxis]
+
+    #=========================================================================
+
+    def _initializeFreeEnergies(self, verbose=False, method='zeros', n_processes=1):
         """
         Compute an initial guess at the relative free energies.
 
@@ -1699,6 +2110,9 @@ class MBAR:
         method (string) - Method for initializing guess at free energies.
         'zeros' - all free energies are initially set to zero
         'mean-reduced-potential' - the mean reduced potential is used
+        'BAR' - BAR between consecutive states with samples
+        'BAR-tree' - BAR along a spanning tree of the best-overlapping pairs of states
+        n_processes (int) - number of processes computing the BAR estimates (default: 1)
 
         """
 
@@ -1714,35 +2128,53 @@ class MBAR:
                 print("Initializing free energies with mean reduced potential for each state.")
             means = np.zeros([self.K], float)
             for k in self.states_with_samples:
-                means[k] = self.u_kn[k, 0:self.N_k[k]].mean()
+                means[k] = self.u_kn[k, 0:self.N_k[k]].mean(dtype=np.float64)
+                if self.u_shift_n is not None:
+                    means[k] += self.u_shift_n[0:self.N_k[k]].mean()
             if (np.max(np.abs(means)) < 0.000001):
                 print("Warning: All mean reduced potentials are close to zero. If you are using energy differences in the u_kln matrix, then the mean reduced potentials will be zero, and this is expected behavoir.")
             self.f_k = means
-        elif (method == 'BAR'):
-            # For now, make a simple list of those states with samples.
-            initialization_order = np.where(self.N_k > 0)[0]
+        elif method in ('BAR', 'BAR-tree'):
+            if method == 'BAR':
+                # Chain BAR along the given order of the states with samples.
+                initialization_order = np.where(self.N_k > 0)[0]
+                edges = list(zip(initialization_order[:-1], initialization_order[1:]))
+            else:
+                if verbose:
+                    print("Initializing free energies with BAR along the tree of best-overlapping pairs of states.")
+                edges = mbar_solvers.overlap_spanning_tree(
+                    self.u_kn, self.N_k, x_kindices=self.x_kindices, counts_n=self.counts_n,
+                    chunk_size=self.chunk_size or mbar_solvers.DEFAULT_CHUNK_SIZE)
             # Initialize all f_k to zero.
             self.f_k[:] = 0.0
-            # Initialize the rest
-            for index in range(0, np.size(initialization_order) - 1):
-                k = initialization_order[index]
-                l = initialization_order[index + 1]
-                # forward work
-                # here, we actually need to distinguish which states are which
-                w_F = (
-                    self.u_kn[l,self.x_kindices==k] - self.u_kn[k,self.x_kindices==k])
-                    #self.u_kln[k, l, 0:self.N_k[k]] - self.u_kln[k, k, 0:self.N_k[k]])
-                    # reverse work
-                w_R = (
-                    self.u_kn[k,self.x_kindices==l] - self.u_kn[l,self.x_kindices==l])
-                    #self.u_kln[l, k, 0:self.N_k[l]] - self.u_kln[l, l, 0:self.N_k[l]])
-
-                if (len(w_F) > 0 and len(w_R) > 0):
-                    # BAR solution doesn't need to be incredibly accurate to
-                    # kickstart NR.
-                    import pymbar.bar
-                    self.f_k[l] = self.f_k[k] + pymbar.bar.BAR(
-                        w_F, w_R, relative_tolerance=0.000001, verbose=False, compute_uncertainty=False)
+            # The samples of each state, found once rather than for every pair.
+            x_kindices = np.asarray(self.x_kindices)
+            order_n = np.argsort(x_kindices, kind='mergesort')
+            starts_k = np.searchsorted(x_kindices[order_n], np.arange(self.K + 1))
+
+            def works(k, l):
+                # Work u_l - u_k of the samples from state k.
+                n = order_n[starts_k[k]:starts_k[k + 1]]
+                u_kn = np.asarray(self.u_kn[np.ix_([k, l], n)], dtype=np.float64)
+                w = u_kn[1] - u_kn[0]
+                if self.counts_n is not None:
+                    w = np.repeat(w, self.counts_n[n].astype(np.int64))
+                return w
+
+            jobs = [(works(k, l), works(l, k)) for (k, l) in edges]
+            if n_processes == 1:
+                delta_f = [_bar_delta_f(job) for job in jobs]
+            else:
+                pool = multiprocessing.Pool(n_processes)
+                try:
+                    delta_f = pool.map(_bar_delta_f, jobs)
+                finally:
+                    pool.close()
+                    pool.join()
+            # Each edge starts from a state whose free energy is already set.
+            for (k, l), df in zip(edges, delta_f):
+                if df is not None:
+                    self.f_k[l] = self.f_k[k] + df
                 else:
                     # no states observed, so we don't need to initialize this free energy anyway, as
                     # the solution is noniterative.
@@ -1757,6 +2189,57 @@ class MBAR:
 
         return
 
+    def _solverTraceCallback(self, callback=None):
+        """
+        Start a new solver_trace, and return the solver callback that fills it.
+
+        OPTIONAL ARGUMENTS
+          callback (callable) - also called with every telemetry record (default: None)
+
+        RETURN VALUES
+          record (callable) - callback for mbar_solvers.solve_mbar_for_all_states
+        """
+        self.solver_trace = []
+
+        def record(entry):
+            if entry['event'] == 'step':
+                self.solver_trace.append(entry)
+            if callback is not None:
+                callback(entry)
+        return record
+
+    def _checkWeightsNormalized(self):
+        """
+        Check that the weights Log_W_nk of the solution are normalized, the first time this is called.
+
+        NOTES
+          The weight matrices whose covariances are computed consist of the columns of Log_W_nk and
+          of columns that are normalized by construction, so it is enough to check Log_W_nk once,
+          rather than every weight matrix with two passes over N x K elements.
+          Raises ParameterError, see utils.check_w_normalized.
+        """
+        if not self._weights_checked:
+            check_w_normalized(np.exp(self.Log_W_nk), self.N_k, counts_n=self.counts_n)
+            self._weights_checked = True
+
+    def _computeLogDenominator(self):
+        """
+        Return the log of the MBAR denominator, \log \sum_{k=1}^K N_k exp[f_k - u_k(x_n)], of each sample.
+
+        RETURN VALUES
+          log_denominator_n (N array) - relative to the per-sample shift of the stored u_kn, if any
+
+        NOTES
+          If u_kn is streamed in chunks, so is this sum.
+        """
+        states_with_samples = self.states_with_samples
+        if self.chunk_size is not None:
+            context = mbar_solvers.ChunkedMBARContext(self.u_kn, self.N_k[states_with_samples], chunk_size=self.chunk_size,
+                                                      states=states_with_samples, n_threads=self.n_threads)
+            return context.log_denominator_n(self.f_k[states_with_samples])
+        return blocked_logsumexp(self.u_kn[states_with_samples], axis=0, b=self.N_k[states_with_samples, np.newaxis],
+                                 offset=self.f_k[states_with_samples, np.newaxis], negate=True, n_threads=self.n_threads)
+
     def _computeUnnormalizedLogWeights(self, u_n):
         """
         Return unnormalized log weights.
@@ -1771,5 +2254,43 @@ class MBAR:
 
         REFERENCE
           'log weights' here refers to \log [ \sum_{k=1}^K N_k exp[f_k - (u_k(x_n) - u(x_n)] ]
+          plus the log multiplicity of each sample, if counts_n was given.
         """
-        return -1. * logsumexp(self.f_k + u_n[:, np.newaxis] - self.u_kn.T, b=self.N_k, axis=1)
+        log_w_n = -1. * self._computeLogDenominator()
+        log_w_n -= u_n
+        if self.u_shift_n is not None:
+            log_w_n += self.u_shift_n  # u_n is not relative to the per-sample shift of the stored u_kn.
+        if self.log_counts_n is not None:
+            log_w_n += self.log_counts_n
+        return log_w_n
+
+
+# Per-process state of MBAR.bootstrap(), set once for each worker process.
+_bootstrap_state = dict()
+
+
+def _bootstrap_initialize(mbar, functions, solver_protocol):
+    _bootstrap_state.update(mbar=mbar, functions=functions, solver_protocol=solver_protocol)
+
+
+def _bootstrap_replicate(seed):
+    mbar = _bootstrap_state['mbar']
+    replicate = mbar._bootstrapReplicate(np.random.RandomState(seed), _bootstrap_state['solver_protocol'])
+    result_vals = dict(f_k=replicate.f_k)
+    for name, function in _bootstrap_state['functions'].items():
+        result_vals[name] = np.asarray(function(replicate))
+    return result_vals
+
+
+def _bar_delta_f(works):
+    """BAR estimate from the forward and reverse works of a pair of states, or None without samples of one."""
+    w_F, w_R = works
+    if len(w_F) == 0 or len(w_R) == 0:
+        return None
+    # BAR solution doesn't need to be incredibly accurate to kickstart NR.
+    import pymbar.bar
+    return pymbar.bar.BAR(w_F, w_R, relative_tolerance=0.000001, verbose=False, compute_uncertainty=False)['Delta_f']
+
+
+def _bootstrap_free_energy_differences(mbar):
+    return mbar.getFreeEnergyDifferences(compute_uncertainty=False)['Delta_f']
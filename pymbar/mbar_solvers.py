@@ -1,17 +1,50 @@
 from __future__ import division  # Ensure same division behavior in py2 and py3
 import numpy as np
 import math
+import os
+import hashlib
+import collections
+import multiprocessing
+import six
+import time
+from timeit import default_timer as _timer
 import scipy.optimize
-from pymbar.utils import ensure_type, logsumexp, check_w_normalized
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.sparse.csgraph
+from pymbar.utils import ensure_type, logsumexp, blocked_logsumexp, check_w_normalized, ParameterError, LOGSUMEXP_BLOCK_SIZE
 import warnings
 
 # Below are the recommended default protocols (ordered sequence of minimization algorithms / NLE solvers) for solving the MBAR equations.
 # Note: we use tuples instead of lists to avoid accidental mutability.
-#DEFAULT_SUBSAMPLING_PROTOCOL = (dict(method="L-BFGS-B"), )  # First use BFGS on subsampled data.
-#DEFAULT_SOLVER_PROTOCOL = (dict(method="hybr"), )  # Then do fmin hybrid on full dataset.
+# Subsampled levels of a coarse-to-fine solve only need to be as precise as their statistical error.
+SUBSAMPLING_TOLERANCE = 1.0e-6
+DEFAULT_SUBSAMPLING_PROTOCOL = (dict(method=None, tol=SUBSAMPLING_TOLERANCE),)
 # Use Adpative solver as first attempt
 DEFAULT_SOLVER_METHOD = "adaptive"
 DEFAULT_SOLVER_PROTOCOL = (dict(method=DEFAULT_SOLVER_METHOD,),)
+# With this many states or more, forming and solving the K x K Hessian dominates, so the
+# default method becomes the Hessian-free Anderson-accelerated self-consistent iteration.
+LARGE_N_STATES = 1000
+DEFAULT_LARGE_N_STATES_SOLVER_METHOD = "anderson"
+# With subsampling_schedule='auto', problems with at least this many samples are first solved on
+# stratified subsamples; see `default_subsampling_schedule()`.
+SUBSAMPLING_MINIMUM_SAMPLES = 100000
+# Default method for the full-data steps that follow the subsampled levels.
+COARSE_TO_FINE_SOLVER_METHOD = "anderson"
+# Number of samples per block when u_kn is streamed from disk (see ChunkedMBARContext).
+DEFAULT_CHUNK_SIZE = 100000
+# Methods of solve_mbar_once() implemented here, which report every iteration to a callback.
+ITERATIVE_SOLVER_METHODS = ('adaptive', 'hessian-free', 'anderson', 'chord', 'stochastic', 'hierarchical')
+# With this many states or more, Newton steps try a sparse Hessian (see MBARContext.sparse_hessian()).
+SPARSE_HESSIAN_MINIMUM_STATES = 200
+# Weights N_k W_nk below this are dropped from the sparse Hessian.
+SPARSE_HESSIAN_THRESHOLD = 1.0e-10
+# The dense Hessian is used instead if more than this fraction of the weights is kept.
+SPARSE_HESSIAN_MAXIMUM_DENSITY = 0.1
+# For very many states: solve clusters of overlapping states separately, then polish on the full data.
+HIERARCHICAL_SOLVER_PROTOCOL = (dict(method="hierarchical"), dict(method="chord"),
+                                dict(method=DEFAULT_LARGE_N_STATES_SOLVER_METHOD))
 
 
 def validate_inputs(u_kn, N_k, f_k):
@@ -37,13 +70,760 @@ def validate_inputs(u_kn, N_k, f_k):
     """
     n_states, n_samples = u_kn.shape
 
-    u_kn = ensure_type(u_kn, 'float', 2, "u_kn or Q_kn", shape=(n_states, n_samples))
+    # Single-precision u_kn is kept as is; all arithmetic on it is promoted to double precision.
+    u_kn_dtype = np.float32 if u_kn.dtype == np.float32 else 'float'
+    if u_kn.ndim == 2 and not u_kn.flags.c_contiguous and u_kn.flags.f_contiguous:
+        # Sample-major (e.g. u_nk.T) input is kept in its layout rather than copied to state-major.
+        u_kn = ensure_type(u_kn.T, u_kn_dtype, 2, "u_kn or Q_kn", shape=(n_samples, n_states)).T
+    else:
+        u_kn = ensure_type(u_kn, u_kn_dtype, 2, "u_kn or Q_kn", shape=(n_states, n_samples))
     N_k = ensure_type(N_k, 'float', 1, "N_k", shape=(n_states,), warn_on_cast=False)  # Autocast to float because will be eventually used in float calculations.
     f_k = ensure_type(f_k, 'float', 1, "f_k", shape=(n_states,))
 
     return u_kn, N_k, f_k
 
 
+def validate_counts(counts_n, n_samples):
+    """Check and return the sample multiplicities counts_n, or None if every sample counts once.
+
+    Parameters
+    ----------
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', or None
+        The number of identical samples each sample stands for
+    n_samples : int
+        The number of samples
+
+    Returns
+    -------
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', or None
+        The multiplicities, converted to float
+    """
+    if counts_n is None:
+        return None
+    counts_n = ensure_type(counts_n, 'float', 1, "counts_n", shape=(n_samples,), warn_on_cast=False)
+    if np.any(counts_n < 0):
+        raise ParameterError("counts_n must be nonnegative")
+    return counts_n
+
+
+def compress_duplicate_samples(u_kn, x_kindices=None, counts_n=None):
+    """Find the samples whose columns of u_kn are identical, and merge them into one sample with a multiplicity.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies, i.e. -log unnormalized probabilities
+    x_kindices : np.ndarray, shape=(n_samples), dtype='int', optional
+        The state each sample was drawn from.  If given, only samples from the same state are merged.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional
+        The multiplicities of the input samples; if None, every sample counts once.
+
+    Returns
+    -------
+    unique_n : np.ndarray, shape=(n_unique), dtype='int'
+        The index of the first occurrence of each distinct sample, in increasing order
+    sample_index_n : np.ndarray, shape=(n_samples), dtype='int'
+        The distinct sample each input sample was merged into, so that u_kn[:, unique_n][:, sample_index_n] == u_kn
+    counts_n : np.ndarray, shape=(n_unique), dtype='float'
+        The summed multiplicities of the distinct samples
+
+    Notes
+    -----
+    Columns are compared by their bytes, so merging is exact: two samples whose energies differ
+    in the last bit (or by the sign of a zero) are kept apart.
+    """
+    u_kn = np.asarray(u_kn, dtype=np.float64)
+    n_states, n_samples = u_kn.shape
+    keys_nk = np.empty((n_samples, n_states + 1), dtype=np.float64)
+    keys_nk[:, 0] = 0.0 if x_kindices is None else x_kindices
+    keys_nk[:, 1:] = u_kn.T
+    # View each row as a single opaque value, so np.unique sorts and compares whole columns of u_kn.
+    keys_n = keys_nk.view(np.dtype((np.void, keys_nk.dtype.itemsize * keys_nk.shape[1])))[:, 0]
+    _, first_n, sample_index_n = np.unique(keys_n, return_index=True, return_inverse=True)
+
+    # Number the distinct samples in order of first occurrence, so that unsorted data keeps its order.
+    order = np.argsort(first_n, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    unique_n = first_n[order]
+    sample_index_n = rank[np.ravel(sample_index_n)]
+
+    counts_n = validate_counts(counts_n, n_samples)
+    counts_n = np.bincount(sample_index_n, weights=counts_n, minlength=len(unique_n)).astype(np.float64)
+    return unique_n, sample_index_n, counts_n
+
+
+class SolverWorkspace(object):
+    """Scratch arrays reused by the MBAR solvers across iterations, solver steps and solves.
+
+    The N x K weight matrix and the other large temporaries of `MBARContext` are written
+    into these buffers with ``out=`` arguments, instead of being allocated anew for every
+    evaluation.  A workspace may be shared by several contexts used from the same thread;
+    each buffer remembers which context last requested it, so that a context never mistakes
+    another one's weights for its own cached ones.  `pymbar.MBAR` keeps one per instance.
+    """
+
+    def __init__(self):
+        self._buffers = dict()
+        self._owners = dict()
+
+    def array(self, name, shape, owner=None, dtype=np.float64):
+        """Return an uninitialized array of the given shape, backed by the buffer `name`.
+
+        The buffer is only reallocated if it is too small for `shape` or of another dtype.
+        """
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.size < size or buffer.dtype != dtype:
+            self._buffers[name] = None  # Release the old buffer before allocating the new one.
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[name] = buffer
+        self._owners[name] = owner
+        return buffer[:size].reshape(shape)
+
+    def owns(self, name, owner):
+        """Return True if `owner` was the last to request the buffer `name`."""
+        return owner is not None and self._owners.get(name) is owner
+
+    def clear(self):
+        """Release all buffers."""
+        self._buffers.clear()
+        self._owners.clear()
+
+    @property
+    def nbytes(self):
+        """Total size of the buffers, in bytes."""
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+class MBARContext(object):
+    """Evaluate MBAR quantities for a fixed u_kn and N_k, sharing work between consumers.
+
+    The solvers need the gradient, Hessian, objective, weights and the
+    self-consistent update at the same handful of f_k, and each of those is
+    built from the same K x N log-denominator pass.  An MBARContext validates
+    the inputs once, then caches the log-denominator and log-numerator for the
+    most recently requested f_k (and the weight matrix for the last one) so that
+    each of them is computed only once per point.
+
+    For telemetry, ``evaluation_counts[name]`` and ``kernel_times[name]`` count the calls of,
+    and the wall time in seconds spent in, each kernel ('log_denominator_n', 'log_numerator_k',
+    'W_nk') and each derived quantity ('gradient', 'objective_and_gradient',
+    'self_consistent_update', 'hessian', 'hessian_vector_product'), over the lifetime of the context.
+    The times are exclusive: the time of a quantity does not include the kernels it called.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies, i.e. -log unnormalized probabilities
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    cache_size : int, optional, default=3
+        Number of distinct f_k whose log-denominators and log-numerators are kept.
+        `adaptive()` evaluates three points per iteration.
+    n_threads : int, optional, default=1
+        Number of threads used by the K x N reductions; see `blocked_logsumexp()`.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample, i.e. the number of identical samples it stands for.
+        N_k must count each sample with its multiplicity.  If None, every sample counts once.
+        The weights W_nk are those of a single copy of sample n, so that sum_n counts_n W_nk = 1.
+    workspace : SolverWorkspace, optional, default=None
+        Buffers for the weight matrix and the other large temporaries, which may be shared
+        with other contexts and solves.  If None, the context has its own.
+    overwrite_u_kn : bool, optional, default=False
+        If True, `precondition()` shifts u_kn in place.  Otherwise u_kn is copied by the
+        first call, and the copy is shifted in place by later calls.
+    validate : bool, optional, default=True
+        If False, u_kn and N_k are trusted to have been checked already, e.g. by `validate_inputs()`,
+        and are used as they are.  For callers inside pymbar that build many contexts from the same data.
+
+    Notes
+    -----
+    Single-precision u_kn is never modified: rounding a shifted copy to single precision again
+    at every preconditioning would perturb the problem being solved.  Instead, `precondition()`
+    keeps the shift of each sample in shift_n, in double precision, and u_kn - shift_n is
+    formed in double precision one block of samples at a time, as in `ChunkedMBARContext`.
+    For double-precision u_kn, shift_n is None.
+    """
+
+    def __init__(self, u_kn, N_k, cache_size=3, n_threads=1, counts_n=None, workspace=None, overwrite_u_kn=False,
+                 validate=True):
+        if validate:
+            u_kn, N_k, _ = validate_inputs(u_kn, N_k, np.zeros(len(N_k)))
+        else:
+            N_k = np.asarray(N_k, dtype=np.float64)
+        self.u_kn = u_kn
+        self.N_k = N_k
+        self.n_threads = n_threads
+        self.n_states, self.n_samples = u_kn.shape
+        self.shift_n = np.zeros(self.n_samples, dtype=np.float64) if u_kn.dtype == np.float32 else None
+        self.counts_n = validate_counts(counts_n, self.n_samples)
+        self.states_with_samples = (N_k > 0)
+        self.cache_size = max(int(cache_size), 1)
+        self.workspace = SolverWorkspace() if workspace is None else workspace
+        self.overwrite_u_kn = overwrite_u_kn
+        self._workspace_owner = object()  # Identifies the buffers this context wrote last.
+        self.evaluation_counts = collections.Counter()
+        self.kernel_times = collections.Counter()
+        self._nested_time = 0.0
+        self._cache = collections.OrderedDict()
+        self._W_key = None
+        self._W_nk = None
+
+    def _timed(self, name, compute, *args):
+        """Return compute(*args), counting the call and its exclusive wall time under `name`."""
+        nested_before, self._nested_time = self._nested_time, 0.0
+        start = _timer()
+        try:
+            return compute(*args)
+        finally:
+            elapsed = _timer() - start
+            self.kernel_times[name] += elapsed - self._nested_time
+            self.evaluation_counts[name] += 1
+            self._nested_time = nested_before + elapsed
+
+    def _entry(self, f_k):
+        """Return the cache entry for f_k, creating it if necessary."""
+        # The solvers call this several times per iteration with f_k they made themselves.
+        if not (type(f_k) is np.ndarray and f_k.dtype == np.float64 and f_k.shape == (self.n_states,)):
+            f_k = ensure_type(f_k, 'float', 1, "f_k", shape=(self.n_states,))
+        key = f_k.tobytes()
+        entry = self._cache.pop(key, None)
+        if entry is None:
+            # Keep a private copy so that callers modifying f_k in place cannot invalidate the entry.
+            entry = dict(f_k=f_k.copy(), key=key)
+        self._cache[key] = entry  # (Re)insert as the most recently used entry.
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return entry
+
+    def clear(self):
+        """Drop all cached evaluations."""
+        self._cache.clear()
+        self._W_key = None
+        self._W_nk = None
+
+    def precondition(self, f_k):
+        """Shift u_kn by sample-dependent constants conditioned on f_k; see `precondition_u_kn()`.
+
+        u_kn is only copied if overwrite_u_kn is False, and then only the first time.
+        Single-precision u_kn is left as it is, and the shift is added to shift_n instead.
+        """
+        if self.shift_n is not None:
+            f_k = ensure_type(f_k, 'float', 1, "f_k", shape=(self.n_states,))
+            offset = self.N_k.dot(f_k) / float(self.N_k.sum())
+            for start, stop, u_block in self.iter_u_kn():
+                # Same shift as precondition_u_kn(), relative to the current one.
+                u_min = u_block.min(0)
+                u_block -= u_min
+                self.shift_n[start:stop] += u_min - blocked_logsumexp(u_block, axis=0, b=self.N_k[:, np.newaxis],
+                                                                      offset=f_k[:, np.newaxis], negate=True) + offset
+        elif self.overwrite_u_kn:
+            precondition_u_kn(self.u_kn, self.N_k, f_k, n_threads=self.n_threads, out=self.u_kn, validate=False)
+        else:
+            self.u_kn = precondition_u_kn(self.u_kn, self.N_k, f_k, n_threads=self.n_threads, validate=False)
+            self.overwrite_u_kn = True  # The copy belongs to this context.
+        self.clear()
+
+    def check_weights_normalized(self, f_k):
+        """Raise ParameterError if the weights at f_k are not normalized; see `check_w_normalized()`."""
+        if self.counts_n is None:
+            check_w_normalized(self.W_nk(f_k), self.N_k)
+        else:
+            check_w_normalized(self.W_nk(f_k) * self.counts_n[:, np.newaxis], self.N_k, counts_n=self.counts_n)
+
+    def _compute_log_denominator_n(self, f_k):
+        """Compute log sum_k N_k exp(f_k - u_kn) over the states with samples."""
+        states_with_samples = self.states_with_samples
+        # Only the states with samples can contribute to the denominator term.
+        if np.all(states_with_samples):
+            u_kn = self.u_kn
+        else:
+            u_kn = self.u_kn[states_with_samples]
+        log_denominator_n = blocked_logsumexp(u_kn, axis=0, b=self.N_k[states_with_samples, np.newaxis],
+                                              offset=f_k[states_with_samples, np.newaxis], negate=True,
+                                              n_threads=self.n_threads)
+        if self.shift_n is not None:
+            log_denominator_n += self.shift_n
+        return log_denominator_n
+
+    def _unshifted(self, log_denominator_n):
+        """log_denominator_n for u_kn as stored, i.e. without the per-sample shift_n."""
+        return log_denominator_n if self.shift_n is None else log_denominator_n - self.shift_n
+
+    def _compute_log_numerator_k(self, log_denominator_n):
+        """Compute log sum_n counts_n exp(-u_kn) / denominator_n for all states."""
+        return blocked_logsumexp(self.u_kn, axis=1, b=self.counts_n, offset=-self._unshifted(log_denominator_n),
+                                 negate=True, n_threads=self.n_threads)
+
+    def _compute_log_W_nk(self, f_k, log_denominator_n, out=None):
+        """Compute the N x K matrix of normalized log weights, in `out` if given."""
+        out = np.subtract(f_k, self.u_kn.T, out=out, dtype=np.float64)
+        out -= self._unshifted(log_denominator_n)[:, np.newaxis]
+        return out
+
+    def _compute_W_nk(self, f_k):
+        """Compute the N x K matrix of normalized weights in the workspace."""
+        W_nk = self.workspace.array('W_nk', (self.n_samples, self.n_states), owner=self._workspace_owner)
+        self.log_W_nk(f_k, out=W_nk)
+        return np.exp(W_nk, out=W_nk)
+
+    def log_denominator_n(self, f_k):
+        """Log-denominator of equation (9) in the JCP MBAR paper for each sample."""
+        entry = self._entry(f_k)
+        if 'log_denominator_n' not in entry:
+            entry['log_denominator_n'] = self._timed('log_denominator_n', self._compute_log_denominator_n, entry['f_k'])
+        return entry['log_denominator_n']
+
+    def log_numerator_k(self, f_k):
+        """Log of sum_n exp(-u_kn) / sum_k' N_k' exp(f_k' - u_k'n) for each state."""
+        entry = self._entry(f_k)
+        if 'log_numerator_k' not in entry:
+            log_denominator_n = self.log_denominator_n(f_k)
+            entry['log_numerator_k'] = self._timed('log_numerator_k', self._compute_log_numerator_k, log_denominator_n)
+        return entry['log_numerator_k']
+
+    def log_W_nk(self, f_k, out=None):
+        """Normalized log weights, equation (9) in the JCP MBAR paper.
+
+        If given, `out` of shape (n_samples, n_states) is filled and returned.
+        """
+        entry = self._entry(f_k)
+        return self._compute_log_W_nk(entry['f_k'], self.log_denominator_n(f_k), out=out)
+
+    def W_nk(self, f_k):
+        """Normalized weights, equation (9) in the JCP MBAR paper.
+
+        Only the weight matrix of the last f_k is cached.  It lives in the workspace, so it is
+        overwritten by the next call with another f_k, or by another context sharing the workspace.
+        """
+        entry = self._entry(f_k)
+        if self._W_key != entry['key'] or not self.workspace.owns('W_nk', self._workspace_owner):
+            self._W_nk = None  # Release the old matrix before building the new one.
+            self._W_nk = self._timed('W_nk', self._compute_W_nk, entry['f_k'])
+            self._W_key = entry['key']
+        return self._W_nk
+
+    def self_consistent_update(self, f_k):
+        """Self-consistent update of f_k, equation C3 in the JCP MBAR paper."""
+        return self._timed('self_consistent_update', self._compute_self_consistent_update, f_k)
+
+    def _compute_self_consistent_update(self, f_k):
+        # All states can contribute to the numerator term.
+        return -1. * self.log_numerator_k(f_k)
+
+    def gradient(self, f_k):
+        """Gradient of the MBAR objective, equation C6 in the JCP MBAR paper."""
+        return self._timed('gradient', self._compute_gradient, f_k)
+
+    def _compute_gradient(self, f_k):
+        entry = self._entry(f_k)
+        return -1 * self.N_k * (1.0 - np.exp(entry['f_k'] + self.log_numerator_k(f_k)))
+
+    def objective_and_gradient(self, f_k):
+        """MBAR objective function and its gradient."""
+        return self._timed('objective_and_gradient', self._compute_objective_and_gradient, f_k)
+
+    def _compute_objective_and_gradient(self, f_k):
+        entry = self._entry(f_k)
+        log_denominator_n = self.log_denominator_n(f_k)
+        if self.counts_n is not None:
+            log_denominator_n = self.counts_n * log_denominator_n
+        obj = math.fsum(log_denominator_n) - self.N_k.dot(entry['f_k'])
+        return obj, self.gradient(f_k)
+
+    def hessian(self, f_k):
+        """Hessian of the MBAR objective, equation C9 in the JCP MBAR paper."""
+        return self._timed('hessian', self._compute_hessian, f_k)
+
+    def _compute_hessian(self, f_k):
+        W = self.W_nk(f_k)
+        N_k = self.N_k
+
+        if self.counts_n is None:
+            H = W.T.dot(W)
+        else:
+            # W' diag(counts_n) W, accumulated over blocks of samples to avoid an N x K temporary.
+            H = np.zeros((self.n_states, self.n_states), dtype=np.float64)
+            block_size = max(1, LOGSUMEXP_BLOCK_SIZE // self.n_states)
+            for start in range(0, self.n_samples, block_size):
+                stop = min(start + block_size, self.n_samples)
+                cW = self.workspace.array('counts_W_nk', (stop - start, self.n_states))
+                np.multiply(W[start:stop], self.counts_n[start:stop, np.newaxis], out=cW)
+                H += W[start:stop].T.dot(cW)
+        H *= N_k
+        H *= N_k[:, np.newaxis]
+        H -= np.diag(self.weight_sums_k(f_k) * N_k)
+
+        return -1.0 * H
+
+    def sparse_hessian(self, f_k, threshold=SPARSE_HESSIAN_THRESHOLD, maximum_density=1.0):
+        """Hessian of the MBAR objective as a scipy.sparse matrix, for states that overlap with few others.
+
+        Weights with N_k W_nk < threshold, i.e. samples with a negligible probability of belonging
+        to state k, are dropped, so that in umbrella sampling or alchemical ladders, where each
+        sample has weight in only b neighbouring states, the overlap matrix costs O(N b^2) instead
+        of O(N K^2) and the Hessian has O(K b) entries.  The diagonal is exact.
+
+        Returns None, without forming the Hessian, if more than maximum_density of the weights are kept.
+        """
+        return self._timed('sparse_hessian', self._compute_sparse_hessian, f_k, threshold, maximum_density)
+
+    def _compute_sparse_hessian(self, f_k, threshold, maximum_density):
+        N_k = self.N_k
+        maximum_nonzeros = maximum_density * self.n_samples * self.n_states
+        n_nonzeros = 0
+        rows, columns, values = [], [], []
+        for start, stop, W in self.iter_W_nk(f_k):
+            n, k = np.nonzero(W * N_k >= threshold)
+            n_nonzeros += len(n)
+            if n_nonzeros > maximum_nonzeros:
+                return None
+            W_kept = W[n, k]
+            if self.counts_n is not None:
+                # W' diag(counts_n) W as the product of sqrt(counts_n) W with itself.
+                W_kept *= np.sqrt(self.counts_n[start + n])
+            rows.append(start + n)
+            columns.append(k)
+            values.append(W_kept)
+        W = scipy.sparse.csr_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                    shape=(self.n_samples, self.n_states))
+        N = scipy.sparse.diags(N_k)
+        H = N.dot(W.T.dot(W)).dot(N) - scipy.sparse.diags(self.weight_sums_k(f_k) * N_k)
+        return (-H).tocsr()
+
+    def iter_W_nk(self, f_k):
+        """Iterate over (start, stop, W_nk[start:stop]) for blocks of samples."""
+        W = self.W_nk(f_k)
+        block_size = max(1, LOGSUMEXP_BLOCK_SIZE // self.n_states)
+        for start in range(0, self.n_samples, block_size):
+            stop = min(start + block_size, self.n_samples)
+            yield start, stop, W[start:stop]
+
+    def hessian_vector_product(self, f_k, v_k):
+        """Product of the Hessian of the MBAR objective with v_k, without forming the Hessian.
+
+        Costs two N x K matrix-vector products with the weight matrix, instead of
+        the O(N K^2) work of `hessian()`.
+        """
+        return self._timed('hessian_vector_product', self._compute_hessian_vector_product, f_k, v_k)
+
+    def _compute_hessian_vector_product(self, f_k, v_k):
+        W = self.W_nk(f_k)
+        Nv_k = self.N_k * v_k
+        WNv_n = W.dot(Nv_k)
+        if self.counts_n is not None:
+            WNv_n *= self.counts_n
+        return self.weight_sums_k(f_k) * Nv_k - self.N_k * W.T.dot(WNv_n)
+
+    def weight_sums_k(self, f_k):
+        """Column sums sum_n counts_n W_nk of the weight matrix, from the cached log-numerator."""
+        entry = self._entry(f_k)
+        return np.exp(entry['f_k'] + self.log_numerator_k(f_k))
+
+    def u_kn_columns(self, n):
+        """The (preconditioned) columns u_kn[:, n] for an array of sample indices n."""
+        if self.shift_n is None:
+            return np.asarray(self.u_kn[:, n], dtype=np.float64)
+        return self.u_kn[:, n] - self.shift_n[n]
+
+    def u_kn_block(self, k, n):
+        """The (preconditioned) block u_kn[k][:, n] for arrays of state indices k and sample indices n."""
+        if self.shift_n is None:
+            return np.asarray(self.u_kn[np.ix_(k, n)], dtype=np.float64)
+        return self.u_kn[np.ix_(k, n)] - self.shift_n[n]
+
+    def iter_u_kn(self):
+        """Iterate over (start, stop, u_kn[:, start:stop]) for blocks of samples.
+
+        The blocks are views of u_kn, except in single precision, where they are shifted copies.
+        """
+        block_size = max(1, LOGSUMEXP_BLOCK_SIZE // self.n_states)
+        for start in range(0, self.n_samples, block_size):
+            stop = min(start + block_size, self.n_samples)
+            if self.shift_n is None:
+                yield start, stop, self.u_kn[:, start:stop]
+            else:
+                yield start, stop, self.u_kn[:, start:stop] - self.shift_n[start:stop]
+
+
+class LinearMBARContext(MBARContext):
+    """MBARContext that works with Q_kn = exp(-u_kn) instead of u_kn where it is safe to.
+
+    u_kn is shifted once by per-sample and per-state constants, u_kn = c_n + d_k + v_kn,
+    chosen so that v_kn >= 0 with a zero in every row and every column, and
+    Q_kn = exp(-v_kn) is stored.  The MBAR denominator and numerator then are
+
+        sum_k N_k exp(f_k - u_kn) = exp(-c_n) sum_k [N_k exp(f_k - d_k)] Q_kn
+        sum_n exp(-u_kn) / denominator_n = exp(-d_k) sum_n Q_kn [exp(-c_n) / denominator_n]
+
+    i.e. two matrix-vector products per evaluation instead of two K x N passes of exp().
+
+    Terms that underflow in linear space are dropped.  Whenever the dropped terms could change
+    a denominator or numerator by more than machine precision, the evaluation falls back to
+    the log-space kernels of MBARContext, so results are never less precise than in log space.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies, i.e. -log unnormalized probabilities
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    cache_size : int, optional, default=3
+        Number of distinct f_k whose log-denominators and log-numerators are kept.
+    n_threads : int, optional, default=1
+        Number of threads used by the log-space fallbacks; see `blocked_logsumexp()`.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample; see `MBARContext`.
+    workspace : SolverWorkspace, optional, default=None
+        Buffers for the weight matrix; see `MBARContext`.
+    overwrite_u_kn : bool, optional, default=False
+        Whether u_kn may be preconditioned in place; see `MBARContext`.
+    validate : bool, optional, default=True
+        Whether to check u_kn and N_k; see `MBARContext`.
+    """
+
+    def __init__(self, u_kn, N_k, cache_size=3, n_threads=1, counts_n=None, workspace=None, overwrite_u_kn=False,
+                 validate=True):
+        super(LinearMBARContext, self).__init__(u_kn, N_k, cache_size=cache_size, n_threads=n_threads, counts_n=counts_n,
+                                                workspace=workspace, overwrite_u_kn=overwrite_u_kn, validate=validate)
+        self.Q_kn = None
+        self._build_Q_kn()
+        # Any sum of at most n terms that each underflowed below `tiny` is negligible
+        # next to a sum larger than n * tiny / eps.
+        finfo = np.finfo(np.float64)
+        self._min_denominator = self.n_states * finfo.tiny / finfo.eps
+        self._min_numerator = self.n_samples * finfo.tiny / finfo.eps
+        self.n_log_space_fallbacks = 0
+
+    def _build_Q_kn(self):
+        u_min_n = self.u_kn.min(0).astype(np.float64)
+        # Rebuilt in the memory of the old matrix after preconditioning.
+        Q_kn = np.subtract(self.u_kn, u_min_n, out=self.Q_kn, dtype=np.float64)
+        self.d_k = Q_kn.min(1)
+        Q_kn -= self.d_k[:, np.newaxis]
+        np.negative(Q_kn, out=Q_kn)
+        np.exp(Q_kn, out=Q_kn)
+        self.Q_kn = Q_kn
+        # c_n is the minimum of the preconditioned u_kn, which in single precision includes shift_n.
+        self.c_n = u_min_n if self.shift_n is None else u_min_n - self.shift_n
+
+    def precondition(self, f_k):
+        super(LinearMBARContext, self).precondition(f_k)
+        self._build_Q_kn()
+
+    def _compute_log_denominator_n(self, f_k):
+        x_k = f_k - self.d_k
+        x_max = x_k[self.states_with_samples].max()
+        a_k = self.N_k * np.exp(x_k - x_max)  # States without samples have N_k = 0 and drop out.
+        denominator_n = self.Q_kn.T.dot(a_k)
+        if not np.all(denominator_n > self._min_denominator):
+            self.n_log_space_fallbacks += 1
+            return super(LinearMBARContext, self)._compute_log_denominator_n(f_k)
+        return np.log(denominator_n) + x_max - self.c_n
+
+    def _compute_log_numerator_k(self, log_denominator_n):
+        y_n = -self.c_n - log_denominator_n
+        y_max = y_n.max()
+        x_n = np.exp(y_n - y_max)
+        if self.counts_n is not None:
+            x_n *= self.counts_n
+        numerator_k = self.Q_kn.dot(x_n)
+        if not np.all(numerator_k > self._min_numerator):
+            self.n_log_space_fallbacks += 1
+            return super(LinearMBARContext, self)._compute_log_numerator_k(log_denominator_n)
+        return np.log(numerator_k) + y_max - self.d_k
+
+    def _compute_W_nk(self, f_k):
+        # W_nk = exp(f_k - d_k) Q_kn exp(-c_n - log_denominator_n), scaled so that neither factor overflows.
+        x_k = f_k - self.d_k
+        y_n = -self.c_n - self.log_denominator_n(f_k)
+        x_max = x_k.max()
+        finfo = np.finfo(np.float64)
+        if np.any(y_n + x_max > np.log(finfo.max)) or np.ptp(x_k) > -np.log(finfo.tiny / finfo.eps):
+            return super(LinearMBARContext, self)._compute_W_nk(f_k)
+        W_nk = self.workspace.array('W_nk', (self.n_samples, self.n_states), owner=self._workspace_owner)
+        np.multiply(self.Q_kn.T, np.exp(x_k - x_max), out=W_nk)
+        W_nk *= np.exp(y_n + x_max)[:, np.newaxis]
+        return W_nk
+
+
+class ChunkedMBARContext(MBARContext):
+    """MBARContext that streams u_kn in blocks of samples, for data that does not fit in memory.
+
+    u_kn is typically a read-only np.memmap (e.g. from ``np.load(filename, mmap_mode='r')``).
+    It is never copied as a whole: every K x N quantity is accumulated over column blocks of
+    `chunk_size` samples, so the working memory is a few K x chunk_size arrays plus O(N + K^2).
+    Preconditioning is stored as a per-sample shift rather than as a modified copy of u_kn.
+
+    The gradient, objective, self-consistent update, Hessian and Hessian-vector products are
+    all computed blockwise.  `W_nk()` still returns the full weight matrix; use `iter_W_nk()`
+    or `log_W_nk(f_k, out=...)` with a memmap to keep the weights out of memory as well.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray or np.memmap, shape=(n_all_states, n_samples), dtype='float'
+        The reduced potential energies, i.e. -log unnormalized probabilities
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each of the states used
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+        Number of samples (columns of u_kn) read and processed at a time
+    states : np.ndarray, dtype='int', optional, default=None
+        Rows of u_kn to use, e.g. the states with samples.  If None, all rows are used.
+    cache_size : int, optional, default=3
+        Number of distinct f_k whose log-denominators and log-numerators are kept.
+    n_threads : int, optional, default=1
+        Number of threads used by the reductions over each block; see `blocked_logsumexp()`.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample; see `MBARContext`.
+    workspace : SolverWorkspace, optional, default=None
+        Buffers for the weight matrix returned by `W_nk()`; see `MBARContext`.
+    """
+
+    def __init__(self, u_kn, N_k, chunk_size=None, states=None, cache_size=3, n_threads=1, counts_n=None,
+                 workspace=None):
+        if chunk_size is None:
+            chunk_size = DEFAULT_CHUNK_SIZE
+        if u_kn.ndim != 2:
+            raise ValueError("u_kn must be ndim 2. You supplied %s" % u_kn.ndim)
+        self.states = None if states is None else np.asarray(states, dtype=np.int64)
+        n_states = u_kn.shape[0] if states is None else len(self.states)
+        N_k = ensure_type(N_k, 'float', 1, "N_k", shape=(n_states,), warn_on_cast=False)
+        # u_kn is not validated, which would read it into memory, and is never modified.
+        super(ChunkedMBARContext, self).__init__(u_kn, N_k, cache_size=cache_size, n_threads=n_threads,
+                                                 counts_n=counts_n, workspace=workspace, validate=False)
+        self.n_states = n_states
+        self.chunk_size = max(int(chunk_size), 1)
+        self.shift_n = np.zeros(self.n_samples, dtype=np.float64)
+
+    def _read_block(self, start, stop):
+        """Read u_kn[:, start:stop] for the states used, without the per-sample shift."""
+        u_block = np.array(self.u_kn[:, start:stop], dtype=np.float64)
+        if self.states is not None:
+            u_block = u_block[self.states]
+        return u_block
+
+    def u_kn_columns(self, n):
+        u_columns = np.array(self.u_kn[:, n], dtype=np.float64)
+        if self.states is not None:
+            u_columns = u_columns[self.states]
+        u_columns -= self.shift_n[n]
+        return u_columns
+
+    def u_kn_block(self, k, n):
+        rows = k if self.states is None else self.states[k]
+        u_block = np.array(self.u_kn[np.ix_(rows, n)], dtype=np.float64)
+        u_block -= self.shift_n[n]
+        return u_block
+
+    def iter_u_kn(self):
+        """Iterate over (start, stop, u_kn[:, start:stop] - shift_n[start:stop]) for each block of samples."""
+        for start in range(0, self.n_samples, self.chunk_size):
+            stop = min(start + self.chunk_size, self.n_samples)
+            u_block = self._read_block(start, stop)
+            u_block -= self.shift_n[start:stop]
+            yield start, stop, u_block
+
+    def iter_W_nk(self, f_k):
+        """Iterate over (start, stop, W_nk[start:stop]) for each block of samples."""
+        entry = self._entry(f_k)
+        log_denominator_n = self.log_denominator_n(f_k)
+        for start, stop, u_block in self.iter_u_kn():
+            yield start, stop, np.exp(entry['f_k'] - u_block.T - log_denominator_n[start:stop, np.newaxis])
+
+    def precondition(self, f_k):
+        f_k = ensure_type(f_k, 'float', 1, "f_k", shape=(self.n_states,))
+        N_k = self.N_k
+        offset = N_k.dot(f_k) / float(N_k.sum())
+        for start in range(0, self.n_samples, self.chunk_size):
+            stop = min(start + self.chunk_size, self.n_samples)
+            u_block = self._read_block(start, stop)
+            u_min = u_block.min(0)
+            u_block -= u_min
+            # Same shift as precondition_u_kn(), which returns u_kn - shift_n.
+            self.shift_n[start:stop] = u_min - blocked_logsumexp(u_block, axis=0, b=N_k[:, np.newaxis], offset=f_k[:, np.newaxis],
+                                                                 negate=True, n_threads=self.n_threads) + offset
+        self.clear()
+
+    def _compute_log_denominator_n(self, f_k):
+        states_with_samples = self.states_with_samples
+        log_denominator_n = np.empty(self.n_samples, dtype=np.float64)
+        for start, stop, u_block in self.iter_u_kn():
+            log_denominator_n[start:stop] = blocked_logsumexp(u_block[states_with_samples], axis=0,
+                                                              b=self.N_k[states_with_samples, np.newaxis],
+                                                              offset=f_k[states_with_samples, np.newaxis],
+                                                              negate=True, n_threads=self.n_threads)
+        return log_denominator_n
+
+    def _compute_log_numerator_k(self, log_denominator_n):
+        log_numerator_k = np.empty(self.n_states, dtype=np.float64)
+        log_numerator_k.fill(-np.inf)
+        for start, stop, u_block in self.iter_u_kn():
+            b = None if self.counts_n is None else self.counts_n[start:stop]
+            np.logaddexp(log_numerator_k, blocked_logsumexp(u_block, axis=1, b=b, offset=-log_denominator_n[start:stop],
+                                                            negate=True, n_threads=self.n_threads), out=log_numerator_k)
+        return log_numerator_k
+
+    def log_W_nk(self, f_k, out=None):
+        """Normalized log weights, equation (9) in the JCP MBAR paper.
+
+        If given, `out` (e.g. an np.memmap of shape (n_samples, n_states)) is filled block by block and returned.
+        """
+        entry = self._entry(f_k)
+        log_denominator_n = self.log_denominator_n(f_k)
+        if out is None:
+            out = np.empty((self.n_samples, self.n_states), dtype=np.float64)
+        for start, stop, u_block in self.iter_u_kn():
+            out[start:stop] = entry['f_k'] - u_block.T - log_denominator_n[start:stop, np.newaxis]
+        return out
+
+    def _compute_hessian(self, f_k):
+        N_k = self.N_k
+        H = np.zeros((self.n_states, self.n_states), dtype=np.float64)
+        for start, stop, W in self.iter_W_nk(f_k):
+            if self.counts_n is None:
+                H += W.T.dot(W)
+            else:
+                H += W.T.dot(W * self.counts_n[start:stop, np.newaxis])
+        H *= N_k
+        H *= N_k[:, np.newaxis]
+        H -= np.diag(self.weight_sums_k(f_k) * N_k)
+
+        return -1.0 * H
+
+    def _compute_hessian_vector_product(self, f_k, v_k):
+        Nv_k = self.N_k * v_k
+        WtWv_k = np.zeros(self.n_states, dtype=np.float64)
+        for start, stop, W in self.iter_W_nk(f_k):
+            WNv_n = W.dot(Nv_k)
+            if self.counts_n is not None:
+                WNv_n *= self.counts_n[start:stop]
+            WtWv_k += W.T.dot(WNv_n)
+        return self.weight_sums_k(f_k) * Nv_k - self.N_k * WtWv_k
+
+    def check_weights_normalized(self, f_k, tolerance=1.0e-4):
+        # Row sums are checked block by block, and column sums accumulated over blocks.
+        column_sums = np.zeros(self.n_states, dtype=np.float64)
+        for start, stop, W in self.iter_W_nk(f_k):
+            if self.counts_n is None:
+                column_sums += W.sum(0)
+            else:
+                column_sums += self.counts_n[start:stop].dot(W)
+            row_sums = W.dot(self.N_k)
+            badrows = (np.abs(row_sums - 1) > tolerance)
+            if np.any(badrows):
+                firstbad = start + np.where(badrows)[0][0]
+                raise ParameterError(
+                    'Warning: Should have \\sum_k N_k W_nk = 1.  Actual row sum for sample %d was %f. %d other rows have similar problems' %
+                    (firstbad, row_sums[firstbad - start], np.sum(badrows)))
+        badcolumns = (np.abs(column_sums - 1) > tolerance)
+        if np.any(badcolumns):
+            firstbad = np.where(badcolumns)[0][0]
+            raise ParameterError(
+                'Warning: Should have \\sum_n W_nk = 1.  Actual column sum for state %d was %f. %d other columns have similar problems' %
+                (firstbad, column_sums[firstbad], np.sum(badcolumns)))
+
+
 def self_consistent_update(u_kn, N_k, f_k):
     """Return an improved guess for the dimensionless free energies
 
@@ -65,16 +845,7 @@ def self_consistent_update(u_kn, N_k, f_k):
     -----
     Equation C3 in MBAR JCP paper.
     """
-
-    u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
-    
-    states_with_samples = (N_k > 0)
-
-    # Only the states with samples can contribute to the denominator term.
-    log_denominator_n = logsumexp(f_k[states_with_samples] - u_kn[states_with_samples].T, b=N_k[states_with_samples], axis=1)
-    
-    # All states can contribute to the numerator term.
-    return -1. * logsumexp(-log_denominator_n - u_kn, axis=1)
+    return MBARContext(u_kn, N_k).self_consistent_update(f_k)
 
 
 def mbar_gradient(u_kn, N_k, f_k):
@@ -98,11 +869,7 @@ def mbar_gradient(u_kn, N_k, f_k):
     -----
     This is equation C6 in the JCP MBAR paper.
     """
-    u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
-
-    log_denominator_n = logsumexp(f_k - u_kn.T, b=N_k, axis=1)
-    log_numerator_k = logsumexp(-log_denominator_n - u_kn, axis=1)
-    return -1 * N_k * (1.0 - np.exp(f_k + log_numerator_k))
+    return MBARContext(u_kn, N_k).gradient(f_k)
 
 
 def mbar_objective_and_gradient(u_kn, N_k, f_k):
@@ -138,15 +905,7 @@ def mbar_objective_and_gradient(u_kn, N_k, f_k):
     The gradient is equation C6 in the JCP MBAR paper; the objective
     function is its integral.
     """
-    u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
-
-    log_denominator_n = logsumexp(f_k - u_kn.T, b=N_k, axis=1)
-    log_numerator_k = logsumexp(-log_denominator_n - u_kn, axis=1)
-    grad = -1 * N_k * (1.0 - np.exp(f_k + log_numerator_k))
-
-    obj = math.fsum(log_denominator_n) - N_k.dot(f_k)
-
-    return obj, grad
+    return MBARContext(u_kn, N_k).objective_and_gradient(f_k)
 
 
 def mbar_hessian(u_kn, N_k, f_k):
@@ -170,16 +929,7 @@ def mbar_hessian(u_kn, N_k, f_k):
     -----
     Equation (C9) in JCP MBAR paper.
     """
-    u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
-
-    W = mbar_W_nk(u_kn, N_k, f_k)
-
-    H = W.T.dot(W)
-    H *= N_k
-    H *= N_k[:, np.newaxis]
-    H -= np.diag(W.sum(0) * N_k)
-
-    return -1.0 * H
+    return MBARContext(u_kn, N_k).hessian(f_k)
 
 
 def mbar_log_W_nk(u_kn, N_k, f_k):
@@ -203,11 +953,7 @@ def mbar_log_W_nk(u_kn, N_k, f_k):
     -----
     Equation (9) in JCP MBAR paper.
     """
-    u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
-
-    log_denominator_n = logsumexp(f_k - u_kn.T, b=N_k, axis=1)
-    logW = f_k - u_kn.T - log_denominator_n[:, np.newaxis]
-    return logW
+    return MBARContext(u_kn, N_k).log_W_nk(f_k)
 
 
 def mbar_W_nk(u_kn, N_k, f_k):
@@ -234,7 +980,212 @@ def mbar_W_nk(u_kn, N_k, f_k):
     return np.exp(mbar_log_W_nk(u_kn, N_k, f_k))
 
 
-def adaptive(u_kn, N_k, f_k, tol = 1.0e-12, options = None):
+class _IterationReporter(object):
+    """Send a telemetry record for each iteration of a solver to options['callback'], if it is set.
+
+    Each record holds the wall time of the iteration and the kernel times and evaluation counts
+    of the context during it, a copy of the current (accepted) f_k, and the fields given by the solver;
+    see `solve_mbar_once()`.
+    """
+
+    def __init__(self, options, context):
+        self.callback = options.get('callback')
+        self.context = context
+        if self.callback is not None:
+            self._start()
+
+    def _start(self):
+        self.start = _timer()
+        self.kernel_times = collections.Counter(self.context.kernel_times)
+        self.evaluation_counts = collections.Counter(self.context.evaluation_counts)
+
+    def __call__(self, iteration, f_k, **fields):
+        if self.callback is None:
+            return
+        record = dict(event='iteration', iteration=iteration, wall_time=_timer() - self.start,
+                      kernel_times=dict(self.context.kernel_times - self.kernel_times),
+                      evaluation_counts=dict(self.context.evaluation_counts - self.evaluation_counts),
+                      f_k=np.array(f_k))
+        record.update(fields)
+        self.callback(record)
+        self._start()
+
+
+def _reduced_hessian_solver(H):
+    """Return a function solving H[1:, 1:] x = b, the Newton equations in the reduced coordinates with f_k[0] := 0.
+
+    A sparse H (see `MBARContext.sparse_hessian()`) is factorized once by sparse LU; a dense H,
+    or a sparse one that turns out to be singular, is solved by least squares.
+    """
+    if scipy.sparse.issparse(H):
+        H = H.tocsc()[1:, 1:]
+        try:
+            return scipy.sparse.linalg.splu(H).solve
+        except RuntimeError:
+            H = H.toarray()
+    else:
+        H = H[1:, 1:]
+    return lambda b: np.linalg.lstsq(H, b, rcond=-1)[0]
+
+
+def _hessian(context, f_k, sparse_hessian=None, threshold=SPARSE_HESSIAN_THRESHOLD):
+    """Hessian at f_k, sparse if sparse_hessian is True, or if it is None, there are enough states and it pays off."""
+    H = None
+    if sparse_hessian or (sparse_hessian is None and context.n_states >= SPARSE_HESSIAN_MINIMUM_STATES):
+        H = context.sparse_hessian(f_k, threshold=threshold,
+                                   maximum_density=1.0 if sparse_hessian else SPARSE_HESSIAN_MAXIMUM_DENSITY)
+    if H is None:
+        H = context.hessian(f_k)
+    return H
+
+
+def _double_precision_polish(context, f_k):
+    """One Newton step from f_k, in double precision, kept if it lowers the gradient norm.
+
+    Used after solving with single-precision u_kn.  The context is first preconditioned at f_k,
+    so that its shift_n (see `MBARContext`) makes the objective near f_k as precise as possible.
+    """
+    f_k = f_k - f_k[0]
+    context.precondition(f_k)
+    g = context.gradient(f_k)
+    f_newton = f_k.copy()
+    f_newton[1:] -= _reduced_hessian_solver(_hessian(context, f_k))(g[1:])
+    if np.linalg.norm(context.gradient(f_newton)) < np.linalg.norm(g):
+        return f_newton
+    return f_k
+
+
+class _TimeBudgetExhausted(Exception):
+    """Raised by `_TimeBudget.observe()` to stop a solver at its deadline."""
+
+
+class _TimeBudget(object):
+    """Keep the iterate of a solver with the lowest gradient norm, and stop the solver at a deadline."""
+
+    def __init__(self, time_budget, context):
+        self.deadline = _timer() + time_budget
+        self.context = context
+        self.f_k = None
+        self.gradient_norm = np.inf
+
+    def observe(self, f_k, gradient_norm=None):
+        """Record f_k, computing its gradient norm if it is not given, and raise _TimeBudgetExhausted after the deadline."""
+        if gradient_norm is None:
+            gradient_norm = np.linalg.norm(self.context.gradient(f_k))
+        if self.f_k is None or gradient_norm < self.gradient_norm:
+            self.f_k = np.array(f_k)
+            self.gradient_norm = gradient_norm
+        if _timer() >= self.deadline:
+            raise _TimeBudgetExhausted()
+
+
+def estimate_error(context, f_k, maximum_cg_iterations=10):
+    """Estimate how far f_k is from the solution, as the largest entry of the Newton step from f_k.
+
+    The step is found approximately by conjugate gradients with Hessian-vector products, as in
+    `hessian_free_newton()`, so this costs at most 2 * maximum_cg_iterations + 1 passes over the data.
+
+    Parameters
+    ----------
+    context : MBARContext
+        Evaluation context of the problem.
+    f_k : np.ndarray, shape=(n_states), dtype='float'
+        The reduced free energies.
+    maximum_cg_iterations : int, optional, default=10
+        Maximum number of conjugate gradient iterations.
+
+    Returns
+    -------
+    error : float
+        Estimated largest error of the free energy differences f_k - f_k[0].
+    """
+    g = context.gradient(f_k)
+    with np.errstate(divide='ignore'):
+        inverse_diagonal = 1.0 / (context.weight_sums_k(f_k) * context.N_k)
+    inverse_diagonal[~np.isfinite(inverse_diagonal)] = 0.0  # States without samples do not move.
+    hvp = lambda v: context.hessian_vector_product(f_k, v)
+    step, _ = _preconditioned_cg(hvp, g, inverse_diagonal, 0.1, maximum_cg_iterations)
+    return np.max(np.abs(step - step[0]))
+
+
+def _newton_or_self_consistent_iteration(f_k, tol, options, context, report, newton_step, newton_label, newton_name):
+    """Outer loop shared by `adaptive()` and `hessian_free_newton()`.
+
+    Each iteration takes the Newton step f_k - dx, with (dx, entries) = newton_step(f_k, gradient),
+    or the self-consistent update, whichever gives the lower gradient norm (the self-consistent
+    update for the first two iterations), until the largest relative change of f_k is below tol.
+    The step taken is reported as 'SCI' or newton_label, together with the entries.
+    """
+    nr_iter = 0
+    sci_iter = 0
+    doneIterating = False
+    for iteration in range(0, options['maximum_iterations']):
+        g = context.gradient(f_k)  # Objective function gradient
+        Hinvg, entries = newton_step(f_k, g)
+        Hinvg -= Hinvg[0]
+        f_nr = f_k - Hinvg
+
+        # self-consistent iteration gradient norm and saved log sums.
+        f_sci = context.self_consistent_update(f_k)
+        f_sci = f_sci - f_sci[0]  # zero out the minimum
+        g_sci = context.gradient(f_sci)
+        gnorm_sci = np.dot(g_sci, g_sci)
+
+        # Newton gradient norm and saved log sums.
+        g_nr = context.gradient(f_nr)
+        gnorm_nr = np.dot(g_nr, g_nr)
+
+        # the gradient of whichever point we pick is kept by the context for the next round.
+
+        if options['verbose']:
+            print("self consistent iteration gradient norm is %10.5g, %s gradient norm is %10.5g" % (gnorm_sci, newton_name, gnorm_nr))
+        # decide which directon to go depending on size of gradient norm
+        f_old = f_k
+        if (gnorm_sci < gnorm_nr or sci_iter < 2):
+            f_k = f_sci
+            gnorm = gnorm_sci
+            sci_iter += 1
+            step = 'SCI'
+            if options['verbose']:
+                if sci_iter < 2:
+                    print("Choosing self-consistent iteration on iteration %d" % iteration)
+                else:
+                    print("Choosing self-consistent iteration for lower gradient on iteration %d" % iteration)
+        else:
+            f_k = f_nr
+            gnorm = gnorm_nr
+            nr_iter += 1
+            step = newton_label
+            if options['verbose']:
+                print("%s used on iteration %d" % (newton_name, iteration))
+
+        div = np.abs(f_k[1:]) # what we will divide by to get relative difference
+        zeroed = np.abs(f_k[1:])< np.min([10**-8,tol]) # check which values are near enough to zero, hard coded max for now.
+        div[zeroed] = 1.0  # for these values, use absolute values.
+        max_delta = np.max(np.abs(f_k[1:]-f_old[1:])/div)
+        report(iteration, f_k, step=step, gradient_norm=np.sqrt(gnorm), gradient_norm_sci=np.sqrt(gnorm_sci),
+               gradient_norm_nr=np.sqrt(gnorm_nr), max_delta=max_delta, **entries)
+        if np.isnan(max_delta) or (max_delta < tol):
+            doneIterating = True
+            break
+
+    if doneIterating:
+        if options['verbose']:
+            print('Converged to tolerance of {:e} in {:d} iterations.'.format(max_delta, iteration + 1))
+            print('Of {:d} iterations, {:d} were {} iterations and {:d} were self-consistent iterations'.format(iteration + 1, nr_iter, newton_name, sci_iter))
+            if np.all(f_k == 0.0):
+                # all f_k appear to be zero
+                print('WARNING: All f_k appear to be zero.')
+    else:
+        print('WARNING: Did not converge to within specified tolerance.')
+        if options['maximum_iterations'] <= 0:
+            print("No iterations ran be cause maximum_iterations was <= 0 ({})!".format(options['maximum_iterations']))
+        else:
+            print('max_delta = {:e}, tol = {:e}, maximum_iterations = {:d}, iterations completed = {:d}'.format(max_delta,tol, options['maximum_iterations'], iteration))
+    return f_k
+
+
+def adaptive(u_kn, N_k, f_k, tol = 1.0e-12, options = None, context = None):
 
     """
     Determine dimensionless free energies by a combination of Newton-Raphson iteration and self-consistent iteration.
@@ -248,6 +1199,18 @@ def adaptive(u_kn, N_k, f_k, tol = 1.0e-12, options = None):
         gamma (float between 0 and 1) - incrementor for NR iterations (default 1.0).  Usually not changed now, since adaptively switch.
         maximum_iterations (int) - maximum number of Newton-Raphson iterations (default 250: either NR converges or doesn't, pretty quickly)
         verbose (boolean) - verbosity level for debug output
+        callback (callable) - called with a telemetry record (dict) after each iteration (default None).
+            Its 'step' is 'SCI' or 'NR'; see `solve_mbar_once()`.
+        sparse_hessian (boolean) - whether to solve the Newton equations with a sparse Hessian, see
+            `MBARContext.sparse_hessian()`.  If None (default), it is tried with SPARSE_HESSIAN_MINIMUM_STATES
+            states or more, and dropped for the dense Hessian if more than SPARSE_HESSIAN_MAXIMUM_DENSITY
+            of the weights are needed.
+        sparse_hessian_threshold (float) - weights N_k W_nk below this are left out of the sparse Hessian
+            (default SPARSE_HESSIAN_THRESHOLD)
+
+    context (MBARContext) - evaluation context for u_kn and N_k, so that the log-denominators
+        shared by the gradient, Hessian and self-consistent update are only computed once per f_k.
+        If None, one is created.
 
     NOTES
 
@@ -266,90 +1229,646 @@ def adaptive(u_kn, N_k, f_k, tol = 1.0e-12, options = None):
     See Appendix C.2 of [1].
 
     """
+    if options is None:
+        options = dict()
+    if context is None:
+        context = MBARContext(u_kn, N_k)
+
     # put the defaults here in case we get passed an 'options' dictionary that is only partial
     options.setdefault('verbose',False)
     options.setdefault('maximum_iterations',250)
     options.setdefault('print_warning',False)
     options.setdefault('gamma',1.0)
+    options.setdefault('callback', None)
+    options.setdefault('sparse_hessian', None)
+    options.setdefault('sparse_hessian_threshold', SPARSE_HESSIAN_THRESHOLD)
+    report = _IterationReporter(options, context)
+    # In a list, so that newton_step() can stop trying the sparse Hessian.
+    sparse_hessian = [options['sparse_hessian']]
+    if sparse_hessian[0] is None:
+        sparse_hessian[0] = len(f_k) >= SPARSE_HESSIAN_MINIMUM_STATES
+        maximum_density = SPARSE_HESSIAN_MAXIMUM_DENSITY
+    else:
+        maximum_density = 1.0
 
     gamma = options['gamma']
-    doneIterating = False
     if options['verbose'] == True:
         print("Determining dimensionless free energies by Newton-Raphson / self-consistent iteration.")
 
     if tol < 1.5e-15:
         print("Tolerance may be too close to machine precision to converge.")
-    # keep track of Newton-Raphson and self-consistent iterations
-    nr_iter = 0
-    sci_iter = 0
 
-    f_sci = np.zeros(len(f_k), dtype=np.float64)
-    f_nr = np.zeros(len(f_k), dtype=np.float64)
+    def newton_step(f_k, g):
+        H = None
+        if sparse_hessian[0]:
+            H = context.sparse_hessian(f_k, threshold=options['sparse_hessian_threshold'],
+                                       maximum_density=maximum_density)
+            # The states overlap too much for a sparse Hessian to pay off; stop trying.
+            sparse_hessian[0] = H is not None
+        if H is None:
+            H = context.hessian(f_k)  # Objective function hessian
+            Hinvg = np.linalg.lstsq(H, g, rcond=-1)[0]
+        else:
+            Hinvg = np.zeros_like(g)
+            Hinvg[1:] = _reduced_hessian_solver(H)(g[1:])
+        return gamma * Hinvg, dict()
 
-    # Perform Newton-Raphson iterations (with sci computed on the way)
-    for iteration in range(0, options['maximum_iterations']):
-        g = mbar_gradient(u_kn, N_k, f_k)  # Objective function gradient
-        H = mbar_hessian(u_kn, N_k, f_k)  # Objective function hessian
-        Hinvg = np.linalg.lstsq(H, g, rcond=-1)[0]
-        Hinvg -= Hinvg[0]
-        f_nr = f_k - gamma * Hinvg
+    return _newton_or_self_consistent_iteration(f_k, tol, options, context, report, newton_step, 'NR', 'Newton-Raphson')
 
-        # self-consistent iteration gradient norm and saved log sums.
-        f_sci = self_consistent_update(u_kn, N_k, f_k)
-        f_sci = f_sci -  f_sci[0]   # zero out the minimum
-        g_sci = mbar_gradient(u_kn, N_k, f_sci)
-        gnorm_sci = np.dot(g_sci, g_sci)
 
-        # newton raphson gradient norm and saved log sums.
-        g_nr = mbar_gradient(u_kn, N_k, f_nr)
-        gnorm_nr = np.dot(g_nr, g_nr)
+def _preconditioned_cg(matvec, b, inverse_diagonal, rtol, maximum_iterations):
+    """Solve matvec(x) = b by conjugate gradients with a diagonal (Jacobi) preconditioner.
+
+    Returns the solution and the number of iterations.  Iteration stops when the
+    residual norm drops below rtol * |b|, or after maximum_iterations steps.
+    """
+    x = np.zeros_like(b)
+    r = b.copy()
+    z = inverse_diagonal * r
+    p = z.copy()
+    rz = r.dot(z)
+    b_norm = np.linalg.norm(b)
+    for iteration in range(maximum_iterations):
+        if np.linalg.norm(r) <= rtol * b_norm:
+            return x, iteration
+        Ap = matvec(p)
+        pAp = p.dot(Ap)
+        if pAp <= 0:
+            # Only reached along the null space (constant shifts of f_k); the current x is the best we can do.
+            return x, iteration
+        alpha = rz / pAp
+        x += alpha * p
+        r -= alpha * Ap
+        z = inverse_diagonal * r
+        rz_new = r.dot(z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    return x, maximum_iterations
+
+
+def _minibatch_gradient_and_hessian(u_kn, N_k, f_k, scale_n):
+    """Estimate the MBAR gradient and Hessian from a minibatch of samples.
+
+    u_kn holds the columns of the minibatch, and scale_n[n] is the number of
+    samples that column n stands for, so that sums over the minibatch weighted
+    by scale_n are unbiased estimates of the sums over all samples.
+    """
+    log_denominator_n = blocked_logsumexp(u_kn, axis=0, b=N_k[:, np.newaxis], offset=f_k[:, np.newaxis], negate=True)
+    W = np.exp(f_k - u_kn.T - log_denominator_n[:, np.newaxis])
+    sW = W * scale_n[:, np.newaxis]
+    weight_sums_k = sW.sum(0)
+    g = -1 * N_k * (1.0 - weight_sums_k)
+    H = sW.T.dot(W)
+    H *= N_k
+    H *= N_k[:, np.newaxis]
+    H -= np.diag(weight_sums_k * N_k)
+    return g, -1.0 * H
+
 
-        # we could save the gradient, for the next round, but it's not too expensive to
-        # compute since we are doing the Hessian anyway.
+def stochastic(u_kn, N_k, f_k, tol=1.0e-12, options=None, context=None):
+    """
+    Determine dimensionless free energies approximately by variance-reduced minibatch Newton iteration.
+
+    Meant as the first step of a solver protocol for very large numbers of samples, followed by
+    e.g. `adaptive()` on the full data, such as ({'method': 'stochastic'}, {'method': 'adaptive'}).
+
+    Each epoch makes one full pass over the data to compute the gradient at a snapshot f_snap,
+    then takes `inner_iterations` Newton steps on random minibatches of samples, stratified by the
+    state each sample was drawn from.  The minibatch gradient is variance-reduced (SVRG):
+
+        g = g_batch(f_k) - g_batch(f_snap) + g_full(f_snap)
+
+    and the step is solved with the minibatch Hessian at f_k, so no full Hessian is ever formed.
+    If an epoch increases the full gradient norm, it is undone and the step size is halved.
+
+    OPTIONAL ARGUMENTS
+    tol (float between 0 and 1) - relative tolerance for convergence between epochs (default 1.0e-12)
 
+    options: dictionary of options
+        maximum_iterations (int) - maximum number of epochs, i.e. full passes over the data (default 10)
+        inner_iterations (int) - number of minibatch steps per epoch (default 10)
+        batch_fraction (float) - fraction of the samples of each state drawn per minibatch (default 0.01)
+        minimum_batch_size (int) - minimum number of samples per minibatch (default 100 * number of states)
+        gamma (float between 0 and 1) - initial step size (default 1.0)
+        x_kindices (np.ndarray of int) - state each sample was drawn from; the minibatches are stratified
+            by it.  If None, the samples are assumed to be ordered by state, N_k[0] from the first and so on.
+        seed (int) - seed for the random number generator (default None)
+        verbose (boolean) - verbosity level for debug output
+        callback (callable) - called with a telemetry record (dict) after each epoch (default None).
+            Its 'step' is 'epoch', or 'rejected' for an epoch that was undone; see `solve_mbar_once()`.
+
+    context (MBARContext) - evaluation context for u_kn and N_k.  If None, one is created.
+    """
+    if options is None:
+        options = dict()
+    if context is None:
+        context = MBARContext(u_kn, N_k)
+    N_k = context.N_k
+    n_states = context.n_states
+    n_samples = context.n_samples
+
+    options.setdefault('verbose', False)
+    options.setdefault('maximum_iterations', 10)
+    options.setdefault('inner_iterations', 10)
+    options.setdefault('batch_fraction', 0.01)
+    options.setdefault('minimum_batch_size', 100 * n_states)
+    options.setdefault('gamma', 1.0)
+    options.setdefault('x_kindices', None)
+    options.setdefault('seed', None)
+    options.setdefault('callback', None)
+    report = _IterationReporter(options, context)
+
+    if options['verbose']:
+        print("Determining dimensionless free energies by stochastic minibatch Newton iteration.")
+
+    # Group the samples by the state they were drawn from.
+    if options['x_kindices'] is None:
+        strata_n = np.repeat(np.arange(n_states), N_k.astype(np.int64))
+    else:
+        strata_n = np.asarray(options['x_kindices'])
+    if len(strata_n) != n_samples:
+        raise ParameterError("x_kindices must have one entry for each of the %d samples" % n_samples)
+    order_n = np.argsort(strata_n, kind='mergesort')
+    strata, strata_starts, strata_counts = np.unique(strata_n[order_n], return_index=True, return_counts=True)
+    batch_fraction = max(options['batch_fraction'], options['minimum_batch_size'] / float(n_samples))
+    batch_counts = np.clip(np.round(batch_fraction * strata_counts).astype(np.int64), 1, strata_counts)
+    scale_n = np.repeat(strata_counts / batch_counts.astype(np.float64), batch_counts)
+    random = np.random.RandomState(options['seed'])
+
+    def draw_batch():
+        offsets = np.concatenate([random.randint(0, count, size=b) for (count, b) in zip(strata_counts, batch_counts)])
+        return order_n[np.repeat(strata_starts, batch_counts) + offsets]
+
+    gamma = options['gamma']
+    f_k = f_k - f_k[0]
+    g_full = context.gradient(f_k)
+    gnorm = np.dot(g_full, g_full)
+    doneIterating = False
+    max_delta = np.nan
+    iteration = 0
+    for iteration in range(options['maximum_iterations']):
+        f_snap = f_k
+        f_k = f_snap.copy()
+        for inner in range(options['inner_iterations']):
+            n = draw_batch()
+            u_batch = context.u_kn_columns(n)
+            batch_scale_n = scale_n if context.counts_n is None else scale_n * context.counts_n[n]
+            g_batch, H_batch = _minibatch_gradient_and_hessian(u_batch, N_k, f_k, batch_scale_n)
+            g_snap, _ = _minibatch_gradient_and_hessian(u_batch, N_k, f_snap, batch_scale_n)
+            g = g_batch - g_snap + g_full
+            # Work in the reduced coordinates with f_k[0] := 0.
+            step = np.linalg.lstsq(H_batch[1:, 1:], g[1:], rcond=-1)[0]
+            f_k[1:] -= gamma * step
+
+        g_new = context.gradient(f_k)
+        gnorm_new = np.dot(g_new, g_new)
+        if not gnorm_new < gnorm:
+            # The epoch made things worse; undo it and take smaller steps.
+            if options['verbose']:
+                print("Epoch %d increased the gradient norm to %10.5g; reducing the step size to %g" % (iteration, gnorm_new, gamma / 2))
+            report(iteration, f_snap, step='rejected', gradient_norm=np.sqrt(gnorm_new), max_delta=np.nan, gamma=gamma)
+            f_k = f_snap
+            gamma /= 2
+            continue
         if options['verbose']:
-            print("self consistent iteration gradient norm is %10.5g, Newton-Raphson gradient norm is %10.5g" % (gnorm_sci, gnorm_nr))
-        # decide which directon to go depending on size of gradient norm
+            print("Epoch %d: gradient norm %10.5g" % (iteration, gnorm_new))
+        g_full = g_new
+        gnorm = gnorm_new
+
+        div = np.abs(f_k[1:])  # what we will divide by to get relative difference
+        zeroed = np.abs(f_k[1:]) < np.min([10**-8, tol])  # check which values are near enough to zero
+        div[zeroed] = 1.0  # for these values, use absolute values.
+        max_delta = np.max(np.abs(f_k[1:] - f_snap[1:]) / div)
+        report(iteration, f_k, step='epoch', gradient_norm=np.sqrt(gnorm), max_delta=max_delta, gamma=gamma)
+        if np.isnan(max_delta) or (max_delta < tol):
+            doneIterating = True
+            break
+
+    if options['verbose']:
+        if doneIterating:
+            print('Converged to tolerance of {:e} in {:d} epochs.'.format(max_delta, iteration + 1))
+        else:
+            print('Stopped after {:d} epochs with max_delta = {:e}; refine with a full-data solver.'.format(iteration + 1, max_delta))
+    return f_k
+
+
+def hessian_free_newton(u_kn, N_k, f_k, tol=1.0e-12, options=None, context=None):
+    """
+    Determine dimensionless free energies by Newton-Krylov iteration without ever forming the Hessian.
+
+    Each Newton system H p = g is solved inexactly by preconditioned conjugate gradients,
+    using Hessian-vector products from the weight matrix (two N x K matrix-vector products each)
+    and the diagonal preconditioner diag(N_k sum_n W_nk).  As in `adaptive()`, the
+    self-consistent update is taken instead whenever it gives the lower gradient norm.
+    Memory and time per iteration are O(N K), so this is suited to problems with thousands
+    of states, where `mbar_hessian()` and the O(K^3) solve in `adaptive()` dominate.
+
+    OPTIONAL ARGUMENTS
+    tol (float between 0 and 1) - relative tolerance for convergence (default 1.0e-12)
+
+    options: dictionary of options
+        maximum_iterations (int) - maximum number of Newton iterations (default 250)
+        maximum_cg_iterations (int) - maximum number of conjugate gradient iterations per Newton step (default: number of states)
+        cg_tolerance (float) - upper bound on the relative residual of each CG solve; tightened as the gradient shrinks (default 0.1)
+        verbose (boolean) - verbosity level for debug output
+        callback (callable) - called with a telemetry record (dict) after each iteration (default None).
+            Its 'step' is 'SCI' or 'NK' (Newton-Krylov); see `solve_mbar_once()`.
+
+    context (MBARContext) - evaluation context for u_kn and N_k.  If None, one is created.
+    """
+    if options is None:
+        options = dict()
+    if context is None:
+        context = MBARContext(u_kn, N_k)
+
+    options.setdefault('verbose', False)
+    options.setdefault('maximum_iterations', 250)
+    options.setdefault('maximum_cg_iterations', len(f_k))
+    options.setdefault('cg_tolerance', 0.1)
+    options.setdefault('callback', None)
+    report = _IterationReporter(options, context)
+
+    if options['verbose']:
+        print("Determining dimensionless free energies by Hessian-free Newton-Krylov / self-consistent iteration.")
+
+    def newton_step(f_k, g):
+        # Inexact Newton: the CG tolerance follows the gradient norm, so late steps converge quadratically.
+        rtol = min(options['cg_tolerance'], np.sqrt(np.linalg.norm(g)))
+        inverse_diagonal = 1.0 / (context.weight_sums_k(f_k) * context.N_k)
+        hvp = lambda v: context.hessian_vector_product(f_k, v)
+        Hinvg, n_cg = _preconditioned_cg(hvp, g, inverse_diagonal, rtol, options['maximum_cg_iterations'])
+        return Hinvg, dict(cg_iterations=n_cg)
+
+    return _newton_or_self_consistent_iteration(f_k, tol, options, context, report, newton_step, 'NK', 'Newton-Krylov')
+
+
+def anderson(u_kn, N_k, f_k, tol=1.0e-12, options=None, context=None):
+    """
+    Determine dimensionless free energies by Anderson-accelerated (DIIS) self-consistent iteration.
+
+    The self-consistent update f_k <- G(f_k) (equation C3 in the JCP MBAR paper) converges
+    linearly, and slowly when states overlap poorly.  Anderson mixing keeps the last `history`
+    iterates and residuals r = G(f_k) - f_k, and steps to the combination of the G(f_k) whose
+    residuals best cancel in the least-squares sense.  Each iteration costs one self-consistent
+    update, O(N K), and no Hessian is ever formed, so this suits problems with many states.
+    If a step increases the residual norm, it is replaced by a plain self-consistent step and
+    the history is restarted.
+
+    OPTIONAL ARGUMENTS
+    tol (float between 0 and 1) - relative tolerance for convergence (default 1.0e-12)
+
+    options: dictionary of options
+        maximum_iterations (int) - maximum number of iterations (default 10000)
+        history (int) - number of previous iterates to mix (default 5)
+        verbose (boolean) - verbosity level for debug output
+        callback (callable) - called with a telemetry record (dict) after each iteration (default None).
+            Its 'step' is 'anderson', or 'SCI' after a restart, and it holds the 'residual_norm'
+            |G(f_k) - f_k| instead of a gradient norm; see `solve_mbar_once()`.
+
+    context (MBARContext) - evaluation context for u_kn and N_k.  If None, one is created.
+    """
+    if options is None:
+        options = dict()
+    if context is None:
+        context = MBARContext(u_kn, N_k)
+
+    options.setdefault('verbose', False)
+    options.setdefault('maximum_iterations', 10000)
+    options.setdefault('history', 5)
+    options.setdefault('callback', None)
+    report = _IterationReporter(options, context)
+
+    if options['verbose']:
+        print("Determining dimensionless free energies by Anderson-accelerated self-consistent iteration.")
+
+    def fixed_point_map(f_k):
+        f_sci = context.self_consistent_update(f_k)
+        return f_sci - f_sci[0]
+
+    # Histories of the differences between successive values of G(f_k) and of the residuals.
+    dG = collections.deque(maxlen=options['history'])
+    dR = collections.deque(maxlen=options['history'])
+    f_k = f_k - f_k[0]
+    G_k = fixed_point_map(f_k)
+    r_k = G_k - f_k
+    rnorm = np.linalg.norm(r_k)
+
+    doneIterating = False
+    n_restarts = 0
+    max_delta = np.nan
+    iteration = 0
+    for iteration in range(0, options['maximum_iterations']):
         f_old = f_k
-        if (gnorm_sci < gnorm_nr or sci_iter < 2):
-            f_k = f_sci
-            sci_iter += 1
-            if options['verbose']:
-                if sci_iter < 2:
-                    print("Choosing self-consistent iteration on iteration %d" % iteration)
-                else:
-                    print("Choosing self-consistent iteration for lower gradient on iteration %d" % iteration)
+        step = 'anderson'
+        if len(dR) > 0:
+            gamma = np.linalg.lstsq(np.array(dR).T, r_k, rcond=-1)[0]
+            f_k = G_k - np.dot(gamma, np.array(dG))
         else:
-            f_k = f_nr
-            nr_iter += 1
+            f_k = G_k
+            step = 'SCI'
+
+        G_new = fixed_point_map(f_k)
+        r_new = G_new - f_k
+        rnorm_new = np.linalg.norm(r_new)
+
+        if not rnorm_new <= rnorm and len(dR) > 0:
+            # The extrapolation made things worse: fall back to the plain self-consistent step.
             if options['verbose']:
-                print("Newton-Raphson used on iteration %d" % iteration)
+                print("Anderson step increased the residual norm to %10.5g on iteration %d; restarting" % (rnorm_new, iteration))
+            n_restarts += 1
+            step = 'SCI'
+            dG.clear()
+            dR.clear()
+            f_k = G_k
+            G_new = fixed_point_map(f_k)
+            r_new = G_new - f_k
+            rnorm_new = np.linalg.norm(r_new)
+        else:
+            dG.append(G_new - G_k)
+            dR.append(r_new - r_k)
+        G_k, r_k, rnorm = G_new, r_new, rnorm_new
 
-        div = np.abs(f_k[1:]) # what we will divide by to get relative difference
-        zeroed = np.abs(f_k[1:])< np.min([10**-8,tol]) # check which values are near enough to zero, hard coded max for now.
+        if options['verbose']:
+            print("Anderson iteration %d: residual norm %10.5g" % (iteration, rnorm))
+
+        div = np.abs(f_k[1:])  # what we will divide by to get relative difference
+        zeroed = np.abs(f_k[1:]) < np.min([10**-8, tol])
         div[zeroed] = 1.0  # for these values, use absolute values.
-        max_delta = np.max(np.abs(f_k[1:]-f_old[1:])/div)
+        max_delta = np.max(np.abs(f_k[1:] - f_old[1:]) / div)
+        report(iteration, f_k, step=step, residual_norm=rnorm, max_delta=max_delta, restarts=n_restarts)
         if np.isnan(max_delta) or (max_delta < tol):
             doneIterating = True
             break
 
     if doneIterating:
         if options['verbose']:
-            print('Converged to tolerance of {:e} in {:d} iterations.'.format(max_delta, iteration + 1))
-            print('Of {:d} iterations, {:d} were Newton-Raphson iterations and {:d} were self-consistent iterations'.format(iteration + 1, nr_iter, sci_iter))
-            if np.all(f_k == 0.0):
-                # all f_k appear to be zero
-                print('WARNING: All f_k appear to be zero.')
+            print('Converged to tolerance of {:e} in {:d} iterations ({:d} restarts).'.format(max_delta, iteration + 1, n_restarts))
     else:
         print('WARNING: Did not converge to within specified tolerance.')
-        if options['maximum_iterations'] <= 0:
-            print("No iterations ran be cause maximum_iterations was <= 0 ({})!".format(options['maximum_iterations']))
+        print('max_delta = {:e}, tol = {:e}, maximum_iterations = {:d}, iterations completed = {:d}'.format(max_delta, tol, options['maximum_iterations'], iteration))
+    return f_k
+
+
+def chord_newton(u_kn, N_k, f_k, tol=1.0e-12, options=None, context=None):
+    """
+    Determine dimensionless free energies by Newton iteration with a fixed Hessian (the chord method).
+
+    Every step solves with the same Hessian, given in the options or computed once at the starting f_k,
+    so each iteration costs a single gradient evaluation.  Convergence is linear, at a rate set by how
+    well that Hessian approximates the one at the solution; a Hessian from a large subsample of the
+    data, evaluated near the solution, typically gains several digits per step.
+    Iteration stops early once a step fails to reduce the gradient norm tenfold, i.e. when the fixed
+    Hessian stops paying off, returning the best f_k found, so this is best followed by another method in a
+    solver protocol.
+
+    OPTIONAL ARGUMENTS
+    tol (float between 0 and 1) - relative tolerance for convergence (default 1.0e-12)
+
+    options: dictionary of options
+        hessian (np.ndarray or scipy.sparse matrix, shape=(n_states, n_states)) - Hessian of the MBAR objective
+            to use (default: the Hessian at f_k).  A sparse Hessian is factorized once, so iterations cost O(N K).
+        sparse_hessian (boolean) - whether the Hessian computed at f_k is sparse; see `adaptive()` (default None)
+        maximum_iterations (int) - maximum number of iterations (default 20)
+        verbose (boolean) - verbosity level for debug output
+        callback (callable) - called with a telemetry record (dict) after each iteration (default None).
+            Its 'step' is 'chord', or 'rejected' for the final step if it was not taken; see `solve_mbar_once()`.
+
+    context (MBARContext) - evaluation context for u_kn and N_k.  If None, one is created.
+    """
+    if options is None:
+        options = dict()
+    if context is None:
+        context = MBARContext(u_kn, N_k)
+
+    options.setdefault('verbose', False)
+    options.setdefault('maximum_iterations', 20)
+    options.setdefault('hessian', None)
+    options.setdefault('callback', None)
+    options.setdefault('sparse_hessian', None)
+    options.setdefault('sparse_hessian_threshold', SPARSE_HESSIAN_THRESHOLD)
+    report = _IterationReporter(options, context)
+
+    if options['verbose']:
+        print("Determining dimensionless free energies by fixed-Hessian Newton iteration.")
+
+    f_k = f_k - f_k[0]
+    H = options['hessian']
+    if H is None:
+        H = _hessian(context, f_k, options['sparse_hessian'], options['sparse_hessian_threshold'])
+    # Work in the reduced coordinates with f_k[0] := 0.
+    solve = _reduced_hessian_solver(H)
+    g = context.gradient(f_k)
+    gnorm = np.dot(g, g)
+
+    doneIterating = False
+    max_delta = np.nan
+    iteration = 0
+    for iteration in range(0, options['maximum_iterations']):
+        f_new = f_k.copy()
+        f_new[1:] -= solve(g[1:])
+        g_new = context.gradient(f_new)
+        gnorm_new = np.dot(g_new, g_new)
+        if not gnorm_new < gnorm:
+            if options['verbose']:
+                print("Fixed-Hessian step increased the gradient norm to %10.5g on iteration %d; stopping" % (gnorm_new, iteration))
+            report(iteration, f_k, step='rejected', gradient_norm=np.sqrt(gnorm_new), max_delta=np.nan)
+            break
+        if options['verbose']:
+            print("Fixed-Hessian iteration %d: gradient norm %10.5g" % (iteration, gnorm_new))
+
+        div = np.abs(f_new[1:])  # what we will divide by to get relative difference
+        zeroed = np.abs(f_new[1:]) < np.min([10**-8, tol])
+        div[zeroed] = 1.0  # for these values, use absolute values.
+        max_delta = np.max(np.abs(f_new[1:] - f_k[1:]) / div)
+        stalled = not gnorm_new < 0.01 * gnorm  # gnorm is the squared norm.
+        f_k, g, gnorm = f_new, g_new, gnorm_new
+        report(iteration, f_k, step='chord', gradient_norm=np.sqrt(gnorm), max_delta=max_delta)
+        if np.isnan(max_delta) or (max_delta < tol):
+            doneIterating = True
+            break
+        if stalled:
+            if options['verbose']:
+                print("Fixed-Hessian step did not reduce the gradient norm tenfold on iteration %d; stopping" % iteration)
+            break
+
+    if options['verbose']:
+        if doneIterating:
+            print('Converged to tolerance of {:e} in {:d} iterations.'.format(max_delta, iteration + 1))
         else:
-            print('max_delta = {:e}, tol = {:e}, maximum_iterations = {:d}, iterations completed = {:d}'.format(max_delta,tol, options['maximum_iterations'], iteration))
+            print('Stopped after {:d} iterations with max_delta = {:e}.'.format(iteration + 1, max_delta))
+    return f_k
+
+
+def hierarchical(u_kn, N_k, f_k, tol=1.0e-12, options=None, context=None):
+    """
+    Determine dimensionless free energies approximately by solving clusters of overlapping states separately.
+
+    Meant as the first step of a solver protocol for very large numbers of states, followed by a
+    method on the full data that polishes the result, as in HIERARCHICAL_SOLVER_PROTOCOL.
+
+    The states are linked by their overlap at the starting f_k: state i is linked to state k if a
+    sample drawn from i has N_k W_nk >= overlap_threshold.  They are ordered by reverse Cuthill-McKee
+    on these links, so that overlapping states end up close together, and the order is cut into
+    clusters of `cluster_size` consecutive states.  The MBAR equations of each cluster, extended by
+    the `halo` states on either side of it in that order, are solved with the samples drawn from
+    those states only.  With C clusters, an iteration costs O(N K / C) for each, times the growth
+    from the halo, and the clusters can be solved in parallel.  The offsets a_c between the
+    clusters then solve the MBAR equations of a coarse problem whose C states are the mixtures
+    of the states of each cluster, with reduced potentials
+
+        v_cn = -log sum_{k in c} (N_k / N_c) exp(f_k - u_kn),   N_c = sum_{k in c} N_k
+
+    where f_k are the free energies of the cluster solves.  This is exact if the samples drawn
+    from the states of an extended cluster determine the free energy differences within the cluster;
+    otherwise the samples of the other states shift them slightly, which the following step corrects.
+    The halo keeps the samples of the neighbouring states of the states at the edges of each cluster,
+    which are the ones shifted most.
+
+    OPTIONAL ARGUMENTS
+    tol (float between 0 and 1) - not used; the cluster and coarse solves use the tolerances of their protocols
+
+    options: dictionary of options
+        cluster_size (int) - number of states per cluster (default: the square root of the number of states)
+        halo (int) - number of neighbouring states on either side solved with each cluster (default: cluster_size)
+        overlap_threshold (float) - smallest N_k W_nk that links two states (default 0.01)
+        x_kindices (np.ndarray of int) - state each sample was drawn from, numbered like the states given
+            to the solver.  If None, the samples are assumed to be ordered by state, N_k[0] from the first and so on.
+        cluster_protocol (tuple of dict) - solver protocol of each cluster, see `solve_mbar()` (default: the default protocol)
+        coarse_protocol (tuple of dict) - solver protocol of the coarse problem (default: the default protocol)
+        n_processes (int) - number of processes solving the clusters (default 1)
+        verbose (boolean) - verbosity level for debug output
+        callback (callable) - called with a telemetry record (dict) after the cluster solves, whose 'step' is
+            'clusters', and after the coarse solve, whose 'step' is 'coarse'; see `solve_mbar_once()`.
+
+    context (MBARContext) - evaluation context for u_kn and N_k.  If None, one is created.
+    """
+    if options is None:
+        options = dict()
+    if context is None:
+        context = MBARContext(u_kn, N_k)
+    N_k = context.N_k
+    n_states = context.n_states
+    n_samples = context.n_samples
+
+    options.setdefault('verbose', False)
+    options.setdefault('cluster_size', max(2, int(round(np.sqrt(n_states)))))
+    options.setdefault('halo', None)
+    options.setdefault('overlap_threshold', 0.01)
+    options.setdefault('x_kindices', None)
+    options.setdefault('cluster_protocol', DEFAULT_SOLVER_PROTOCOL)
+    options.setdefault('coarse_protocol', DEFAULT_SOLVER_PROTOCOL)
+    options.setdefault('n_processes', 1)
+    options.setdefault('callback', None)
+    report = _IterationReporter(options, context)
+
+    if options['verbose']:
+        print("Determining dimensionless free energies by solving clusters of states.")
+
+    if options['x_kindices'] is not None:
+        x_kindices = np.asarray(options['x_kindices'])
+        if len(x_kindices) != n_samples or np.any(x_kindices < 0) or np.any(x_kindices >= n_states):
+            raise ParameterError("x_kindices must give one of the %d states for each of the %d samples" % (n_states, n_samples))
+    state_n = _sample_states(N_k, options['x_kindices'], context.counts_n)
+
+    # Link the state each sample was drawn from to the states in which it has a large weight.
+    f_k = f_k - f_k[0]
+    log_denominator_n = context.log_denominator_n(f_k)
+    log_threshold_k = np.log(options['overlap_threshold']) - np.log(N_k)
+    links = []
+    for start, stop, u_block in context.iter_u_kn():
+        k, n = np.nonzero(f_k[:, np.newaxis] - u_block - log_denominator_n[start:stop] >= log_threshold_k[:, np.newaxis])
+        links.append(np.unique(state_n[start + n] * n_states + k))
+    links = np.concatenate(links)
+    graph = scipy.sparse.csr_matrix((np.ones(len(links)), (links // n_states, links % n_states)), shape=(n_states, n_states))
+    order = scipy.sparse.csgraph.reverse_cuthill_mckee(graph, symmetric_mode=False)
+    cluster_size = max(int(options['cluster_size']), 1)
+    halo = cluster_size if options['halo'] is None else max(int(options['halo']), 0)
+    starts = range(0, n_states, cluster_size)
+    clusters = [np.sort(order[start:start + cluster_size]) for start in starts]
+    n_clusters = len(clusters)
+    cluster_k = np.empty(n_states, dtype=np.int64)
+    for cluster, states in enumerate(clusters):
+        cluster_k[states] = cluster
+
+    # Solve each cluster, with its halo, using the samples drawn from those states.
+    samples_n = np.argsort(state_n, kind='mergesort')
+    sample_starts = np.searchsorted(state_n[samples_n], np.arange(n_states + 1))
+    jobs = []
+    for start in starts:
+        states = np.sort(order[max(start - halo, 0):start + cluster_size + halo])
+        samples = np.concatenate([samples_n[sample_starts[k]:sample_starts[k + 1]] for k in states])
+        protocol = tuple(dict(step, options=dict(step.get('options', dict()))) for step in options['cluster_protocol'])
+        job_options = dict(subsampling_schedule=(), components=np.zeros(len(states), dtype=np.int64),
+                           counts_n=None if context.counts_n is None else context.counts_n[samples],
+                           n_threads=context.n_threads)
+        jobs.append((context.u_kn_block(states, samples), N_k[states], f_k[states], protocol, job_options))
+    if options['n_processes'] == 1:
+        for job in jobs:
+            job[4]['workspace'] = context.workspace
+        f_k_clusters = [_solve_component(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(options['n_processes'])
+        try:
+            f_k_clusters = pool.map(_solve_component, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    del jobs
+
+    # Keep the free energies of the states of each cluster relative to its first state, and start from the current offsets.
+    f_cluster_k = np.empty(n_states, dtype=np.float64)
+    for start, states, f_k_cluster in zip(starts, clusters, f_k_clusters):
+        solved_states = np.sort(order[max(start - halo, 0):start + cluster_size + halo])
+        f_k_cluster = f_k_cluster[np.searchsorted(solved_states, states)]
+        f_cluster_k[states] = f_k_cluster - f_k_cluster[0]
+    first_states = np.array([states[0] for states in clusters])
+    a_c = f_k[first_states]
+    f_old = f_k
+    f_k = f_cluster_k + a_c[cluster_k]
+    f_k = f_k - f_k[0]
+    div = np.abs(f_k[1:])  # what we will divide by to get relative difference
+    zeroed = np.abs(f_k[1:]) < np.min([10**-8, tol])
+    div[zeroed] = 1.0  # for these values, use absolute values.
+    max_delta = np.max(np.abs(f_k[1:] - f_old[1:]) / div)
+    report(0, f_k, step='clusters', gradient_norm=np.linalg.norm(context.gradient(f_k)), max_delta=max_delta,
+           clusters=n_clusters)
+    if options['verbose']:
+        print("Solved %d clusters of at most %d states" % (n_clusters, cluster_size))
+
+    # Reduced potentials of the mixtures of the states in each cluster, with the rows grouped by cluster.
+    N_c = np.bincount(cluster_k, weights=N_k, minlength=n_clusters)
+    rows_k = np.argsort(cluster_k, kind='mergesort')
+    row_starts = np.searchsorted(cluster_k[rows_k], np.arange(n_clusters))
+    offset_k = (f_cluster_k + np.log(N_k) - np.log(N_c[cluster_k]))[rows_k]
+    v_cn = np.empty((n_clusters, n_samples), dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for start, stop, u_block in context.iter_u_kn():
+            x_kn = offset_k[:, np.newaxis] - u_block[rows_k]
+            x_max = np.maximum.reduceat(x_kn, row_starts, axis=0)
+            x_max[~np.isfinite(x_max)] = 0.0
+            x_kn -= x_max[cluster_k[rows_k]]
+            np.exp(x_kn, out=x_kn)
+            v_cn[:, start:stop] = -x_max - np.log(np.add.reduceat(x_kn, row_starts, axis=0))
+
+    protocol = tuple(dict(step, options=dict(step.get('options', dict()))) for step in options['coarse_protocol'])
+    a_c, _ = solve_mbar(v_cn, N_c, a_c - a_c[0], solver_protocol=protocol, n_threads=context.n_threads,
+                        counts_n=context.counts_n, overwrite_u_kn=True)
+    del v_cn
+    f_old = f_k
+    f_k = f_cluster_k + a_c[cluster_k]
+    f_k = f_k - f_k[0]
+    div = np.abs(f_k[1:])  # what we will divide by to get relative difference
+    zeroed = np.abs(f_k[1:]) < np.min([10**-8, tol])
+    div[zeroed] = 1.0  # for these values, use absolute values.
+    max_delta = np.max(np.abs(f_k[1:] - f_old[1:]) / div)
+    report(1, f_k, step='coarse', gradient_norm=np.linalg.norm(context.gradient(f_k)), max_delta=max_delta,
+           clusters=n_clusters)
+    if options['verbose']:
+        print("Solved for the offsets between clusters; max_delta = {:e}".format(max_delta))
     return f_k
 
 
-def precondition_u_kn(u_kn, N_k, f_k):
+def precondition_u_kn(u_kn, N_k, f_k, n_threads=1, out=None, validate=True):
     """Subtract a sample-dependent constant from u_kn to improve precision
 
     Parameters
@@ -360,6 +1879,12 @@ def precondition_u_kn(u_kn, N_k, f_k):
         The number of samples in each state
     f_k : np.ndarray, shape=(n_states), dtype='float'
         The reduced free energies of each state
+    n_threads : int, optional, default=1
+        Number of threads to use; see `blocked_logsumexp()`.
+    out : np.ndarray, shape=(n_states, n_samples), dtype='float', optional, default=None
+        Array to store the result in, which may be u_kn itself.  If None, a new array is returned.
+    validate : bool, optional, default=True
+        If False, the inputs are trusted to have been checked by `validate_inputs()` already.
 
     Returns
     -------
@@ -373,14 +1898,493 @@ def precondition_u_kn(u_kn, N_k, f_k):
     additive constant, but its derivatives remain unchanged.  We choose
     x_n such that the current objective function value is zero, which
     should give maximum precision in the objective function.
+
+    With single-precision u_kn, the result is rounded to single precision;
+    `MBARContext.precondition()` keeps x_n in double precision instead.
     """
-    u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
-    u_kn = u_kn - u_kn.min(0)
-    u_kn += (logsumexp(f_k - u_kn.T, b=N_k, axis=1)) - N_k.dot(f_k) / float(N_k.sum())
+    if validate:
+        u_kn, N_k, f_k = validate_inputs(u_kn, N_k, f_k)
+    u_kn = np.subtract(u_kn, u_kn.min(0), out=out)
+    u_kn += blocked_logsumexp(u_kn, axis=0, b=N_k[:, np.newaxis], offset=f_k[:, np.newaxis], negate=True, n_threads=n_threads) - N_k.dot(f_k) / float(N_k.sum())
     return u_kn
 
 
-def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1E-12, options=None):
+def default_subsampling_schedule(N_k, minimum_samples=None, minimum_per_state=100, factor=5.0, maximum_fraction=0.5):
+    """Choose the subsampling fractions of a coarse-to-fine solve from the number of samples.
+
+    Parameters
+    ----------
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    minimum_samples : int, optional, default=SUBSAMPLING_MINIMUM_SAMPLES
+        Problems with fewer samples than this are solved directly, with no subsampled levels.
+    minimum_per_state : int, optional, default=100
+        The coarsest level keeps about this many samples per state with samples.
+    factor : float, optional, default=5.0
+        Ratio between the fractions of successive levels.
+    maximum_fraction : float, optional, default=0.5
+        Levels are added while their fraction is below this; the full data follows them.
+
+    Returns
+    -------
+    fractions : tuple(float)
+        Increasing fractions of the samples of each state to solve on before the full data.
+
+    Notes
+    -----
+    The coarsest fraction is 1% of the samples, raised to at most 5% if that would
+    leave fewer than `minimum_per_state` samples per state; e.g. (0.01, 0.05, 0.25).
+    """
+    if minimum_samples is None:
+        minimum_samples = SUBSAMPLING_MINIMUM_SAMPLES
+    N_k = np.asarray(N_k)
+    n_samples = N_k.sum()
+    if n_samples < minimum_samples:
+        return ()
+    fraction = min(max(0.01, minimum_per_state * np.sum(N_k > 0) / float(n_samples)), 0.05)
+    fractions = []
+    while fraction < maximum_fraction:
+        fractions.append(fraction)
+        fraction *= factor
+    return tuple(fractions)
+
+
+def stratified_subsample(N_k, fraction, x_kindices=None, minimum_per_state=100, counts_n=None):
+    """Select evenly spaced samples from each state, keeping `fraction` of the samples of each.
+
+    Parameters
+    ----------
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    fraction : float
+        Fraction of the samples of each state to keep
+    x_kindices : np.ndarray, shape=(n_samples), dtype='int', optional, default=None
+        State each sample was drawn from.  If None, the samples are assumed to be
+        ordered by state, N_k[0] from the first and so on.
+    minimum_per_state : int, optional, default=100
+        Each state keeps at least this many samples, or all of them if it has fewer.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample, counted in N_k.  Requires x_kindices.
+
+    Returns
+    -------
+    n : np.ndarray, dtype='int'
+        Sorted indices of the selected samples
+    N_k_subsample : np.ndarray, shape=(n_states), dtype='int'
+        The number of selected samples from each state, counted with their multiplicities
+    """
+    N_k = np.asarray(N_k)
+    if x_kindices is None:
+        if counts_n is not None:
+            raise ParameterError("x_kindices is required to subsample samples with multiplicities counts_n")
+        strata_n = np.repeat(np.arange(len(N_k)), N_k.astype(np.int64))
+    else:
+        strata_n = np.asarray(x_kindices)
+    n_columns_k = np.bincount(strata_n, minlength=len(N_k))
+    if counts_n is None:
+        if len(n_columns_k) != len(N_k) or np.any(n_columns_k != N_k):
+            raise ParameterError("x_kindices must assign N_k[k] of the samples to each state k")
+    elif not np.allclose(np.bincount(strata_n, weights=counts_n, minlength=len(N_k)), N_k):
+        raise ParameterError("x_kindices and counts_n must assign N_k[k] of the samples to each state k")
+    order_n = np.argsort(strata_n, kind='mergesort')
+    starts_k = np.concatenate(([0], np.cumsum(n_columns_k)[:-1]))
+    b_k = np.clip(np.round(fraction * n_columns_k).astype(np.int64), np.minimum(n_columns_k, minimum_per_state), n_columns_k)
+    n = np.sort(np.concatenate([order_n[start + (np.arange(b) * count) // max(b, 1)]
+                                for (start, count, b) in zip(starts_k, n_columns_k, b_k)]))
+    if counts_n is None:
+        return n, b_k
+    return n, np.bincount(strata_n[n], weights=counts_n[n], minlength=len(N_k))
+
+
+def _sample_states(N_k, x_kindices=None, counts_n=None):
+    """State each sample was drawn from: x_kindices, or, if None, the samples are ordered by state.
+
+    Samples with zero multiplicity may be assigned to any state.
+    """
+    if x_kindices is not None:
+        state_n = np.asarray(x_kindices, dtype=np.int64)
+    elif counts_n is None:
+        state_n = np.repeat(np.arange(len(N_k)), np.asarray(N_k).astype(np.int64))
+    else:
+        # The counts of the first samples add up to N_k[0], and so on; compare the middle of each sample's range.
+        ends_n = np.cumsum(counts_n)
+        state_n = np.searchsorted(np.cumsum(N_k), ends_n - 0.5 * np.asarray(counts_n), side='right').astype(np.int64)
+    return np.minimum(state_n, len(N_k) - 1)
+
+
+def state_components(u_kn, N_k, x_kindices=None, counts_n=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Split the states into groups whose free energy differences are determined by the samples.
+
+    A state i is linked to a state k if a sample drawn from i has a finite reduced potential in k.
+    States that are not connected by links in either direction share no samples with finite
+    reduced potentials, so their free energy differences are undefined, and the MBAR equations
+    (and the weights W_nk) separate into one set for each connected component.  A state without
+    samples joins the component with the most samples that have finite reduced potentials in it.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies, read in blocks of chunk_size samples.
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    x_kindices : np.ndarray, shape=(n_samples), dtype='int', optional, default=None
+        State each sample was drawn from.  If None, the samples are assumed to be ordered by state.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample, counted in N_k.
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+        Number of samples read at a time.
+
+    Returns
+    -------
+    n_components : int
+        The number of components.
+    components_k : np.ndarray, shape=(n_states), dtype='int'
+        Component of each state, numbered in the order of their first states, or -1 for
+        states without samples in which no sample has a finite reduced potential.
+
+    Notes
+    -----
+    Rather than a dense n_states x n_states table of links, the distinct links found in a block of
+    u_kn are merged into the components found so far once there are more than n_states of them.
+    """
+    N_k = np.asarray(N_k, dtype=np.float64)
+    n_states, n_samples = u_kn.shape
+    state_n = _sample_states(N_k, x_kindices, counts_n)
+    sampled_k = N_k > 0
+    # roots_k[k] is the first state of the component of state k among the links merged so far.  Links
+    # are recorded from the root of their origin, so they are few once most states have been joined.
+    roots_k = np.arange(n_states)
+    links = [(np.zeros(0, dtype=np.int64),) * 3]  # (origins, states, number of samples) of the links not merged yet
+    n_new_links = 0
+    for start in range(0, n_samples, chunk_size):
+        finite = np.isfinite(np.asarray(u_kn[:, start:start + chunk_size]))
+        origins_n = roots_k[state_n[start:start + chunk_size]]
+        if counts_n is not None:
+            finite &= np.asarray(counts_n[start:start + chunk_size]) > 0  # Samples that were left out link nothing.
+        if finite.all():
+            # Every state is linked to every origin, so linking them all to one origin is enough.
+            origins = np.unique(origins_n)
+            links.append((np.concatenate([origins, np.repeat(origins[0], n_states)]),
+                          np.concatenate([np.repeat(origins[0], len(origins)), np.arange(n_states)]),
+                          np.concatenate([np.zeros(len(origins), dtype=np.int64), np.repeat(len(origins_n), n_states)])))
+            n_new_links += len(origins) + n_states
+        else:
+            rows_per_block = max(1, LOGSUMEXP_BLOCK_SIZE // len(origins_n))
+            for first in range(0, n_states, rows_per_block):
+                k, n = np.nonzero(finite[first:first + rows_per_block])
+                codes, counts = np.unique(origins_n[n] * n_states + first + k, return_counts=True)
+                links.append((codes // n_states, codes % n_states, counts))
+                n_new_links += len(codes)
+                if n_new_links > n_states:
+                    roots_k, links = _merge_links(roots_k, sampled_k, links)
+                    origins_n = roots_k[state_n[start:start + chunk_size]]
+                    n_new_links = 0
+    roots_k, links = _merge_links(roots_k, sampled_k, links)
+
+    # Components are numbered in the order of their first states.  A state without samples joins the
+    # component with the most samples that have finite reduced potentials in it.
+    roots = np.unique(roots_k[sampled_k])
+    components_k = -np.ones(n_states, dtype=np.int64)
+    components_k[sampled_k] = np.searchsorted(roots, roots_k[sampled_k])
+    origins_l, states_l, counts_l = links[0]
+    for k in np.where(~sampled_k)[0]:
+        linked = states_l == k
+        if linked.any():
+            components_k[k] = np.searchsorted(roots, origins_l[linked][np.argmax(counts_l[linked])])
+    return len(roots), components_k
+
+
+def _merge_links(roots_k, sampled_k, links):
+    """Join the components of roots_k along the links into states with samples.
+
+    Links into states without samples add no equations, so they do not join components; they are
+    returned as the only remaining links, moved to the new roots and summed.
+    """
+    n_states = len(roots_k)
+    origins_l, states_l, counts_l = [np.concatenate(arrays) for arrays in zip(*links)]
+    into_sampled = sampled_k[states_l]
+    rows = np.concatenate([origins_l[into_sampled], np.arange(n_states)])
+    columns = np.concatenate([states_l[into_sampled], roots_k])
+    graph = scipy.sparse.coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, columns)), shape=(n_states, n_states))
+    _, labels = scipy.sparse.csgraph.connected_components(graph, directed=True, connection='weak')
+    _, first_states = np.unique(labels, return_index=True)
+    roots_k = first_states[labels]
+
+    codes, inverse = np.unique(roots_k[origins_l[~into_sampled]] * n_states + states_l[~into_sampled], return_inverse=True)
+    counts = np.bincount(inverse.ravel(), weights=counts_l[~into_sampled], minlength=len(codes)).astype(np.int64)
+    return roots_k, [(codes // n_states, codes % n_states, counts)]
+
+
+def state_divergences(u_kn, N_k, x_kindices=None, counts_n=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Estimate how poorly each pair of states overlaps, without knowing their free energies.
+
+    The symmetrized Kullback-Leibler divergence between states i and k, in units of kT,
+
+        J_ik = <u_k - u_i>_i + <u_i - u_k>_k
+
+    is the sum of the mean forward and reverse works between them, so it needs neither
+    free energy; it vanishes for identical states and grows as they overlap less.  BAR between
+    i and k is typically precise while J_ik is at most a few kT.  Estimating all of them takes a
+    single pass over u_kn, O(K N), plus O(K^2).
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies, read in blocks of chunk_size samples.
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    x_kindices : np.ndarray, shape=(n_samples), dtype='int', optional, default=None
+        State each sample was drawn from.  If None, the samples are assumed to be ordered by state.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample, counted in N_k.
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+        Number of samples read at a time.
+
+    Returns
+    -------
+    divergences_kk : np.ndarray, shape=(n_states, n_states), dtype='float'
+        J_ik for each pair of states; infinite if either state has no samples, or if a sample
+        of one has an infinite reduced potential in the other.
+    """
+    N_k = np.asarray(N_k, dtype=np.float64)
+    n_states, n_samples = u_kn.shape
+    state_n = _sample_states(N_k, x_kindices, counts_n)
+    weights_n = np.ones(n_samples) if counts_n is None else np.asarray(counts_n, dtype=np.float64)
+    # sums_kk[i, k] is the sum of u_kn[k] over the samples drawn from state i.
+    sums_kk = np.zeros((n_states, n_states), dtype=np.float64)
+    for start in range(0, n_samples, chunk_size):
+        u_block = np.asarray(u_kn[:, start:start + chunk_size], dtype=np.float64)
+        n = np.where(weights_n[start:start + chunk_size] > 0)[0]  # Samples that were left out add nothing.
+        origins = scipy.sparse.csr_matrix((weights_n[start + n], (state_n[start + n], n)),
+                                          shape=(n_states, u_block.shape[1]))
+        sums_kk += origins.dot(u_block.T)
+
+    divergences_kk = np.empty((n_states, n_states), dtype=np.float64)
+    divergences_kk.fill(np.inf)
+    sampled = np.where(N_k > 0)[0]
+    with np.errstate(invalid='ignore'):
+        means_kk = sums_kk[np.ix_(sampled, sampled)] / N_k[sampled, np.newaxis]
+        works_kk = means_kk - np.diag(means_kk)[:, np.newaxis]
+        divergences_kk[np.ix_(sampled, sampled)] = works_kk + works_kk.T
+    divergences_kk[np.isnan(divergences_kk)] = np.inf
+    return divergences_kk
+
+
+def overlap_spanning_tree(u_kn, N_k, x_kindices=None, counts_n=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Link the states with samples by the tree of pairs that overlap best, as estimated by `state_divergences()`.
+
+    Parameters
+    ----------
+    u_kn, N_k, x_kindices, counts_n, chunk_size
+        As for `state_divergences()`.
+
+    Returns
+    -------
+    edges : list of (int, int)
+        The pairs (k, l) of states of a minimum spanning tree of the divergences (a forest if
+        some states are not linked by finite ones), ordered so that k is the first state of its
+        tree or appears as l in an earlier pair.  Following the pairs in order visits every state
+        with samples, from the first state of each tree.
+    """
+    divergences_kk = state_divergences(u_kn, N_k, x_kindices=x_kindices, counts_n=counts_n, chunk_size=chunk_size)
+    sampled = np.where(np.asarray(N_k) > 0)[0]
+    divergences_kk = divergences_kk[np.ix_(sampled, sampled)]
+    linked = np.isfinite(divergences_kk)
+    np.fill_diagonal(linked, False)
+    # csgraph reads zero weights as missing edges; a common shift of the weights does not change the tree.
+    tree = scipy.sparse.csgraph.minimum_spanning_tree(
+        scipy.sparse.csr_matrix(np.where(linked, np.maximum(divergences_kk, 0.0) + 1.0, 0.0)))
+    n_trees, labels = scipy.sparse.csgraph.connected_components(tree, directed=False)
+    edges = []
+    for label in range(n_trees):
+        root = np.where(labels == label)[0][0]
+        order, predecessors = scipy.sparse.csgraph.breadth_first_order(tree, root, directed=False)
+        edges.extend((int(sampled[predecessors[l]]), int(sampled[l])) for l in order[1:])
+    return edges
+
+
+def duplicate_states(u_kn, counts_n=None, tolerance=1.0e-7, chunk_size=DEFAULT_CHUNK_SIZE, seed=0):
+    """Find the states whose reduced potentials agree on all samples, to within a tolerance.
+
+    States k and l are duplicates if sum_n counts_n (u_kn[k] - u_kn[l])^2 < tolerance, where equal
+    infinite reduced potentials agree.  Rather than comparing all pairs, O(K^2 N), each state is
+    sketched by the projection p_k of its finite reduced potentials on a random vector r.  Duplicates
+    have the same number of infinite reduced potentials and |p_k - p_l| < sqrt(tolerance) |r|, so
+    only runs of states that are adjacent in the order of their sketches are compared.  The first
+    state of a run is compared with the rest, its duplicates are grouped with it, and the same is
+    done for the states that remain.  This costs O(K N) to sketch and O(N) per comparison, so
+    O(K N) in all unless many states have nearly the same sketch without being duplicates.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies, read in blocks of chunk_size samples.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample.
+    tolerance : float, optional, default=1.0e-7
+        Largest sum of the squared differences of the reduced potentials of duplicates.
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+        Number of samples read at a time.
+    seed : int, optional, default=0
+        Seed of the random projection.
+
+    Returns
+    -------
+    representatives_k : np.ndarray, shape=(n_states), dtype='int'
+        The first state of the group of duplicates of each state; k itself if it has none.
+    """
+    n_states, n_samples = u_kn.shape
+    scale_n = np.ones(n_samples) if counts_n is None else np.sqrt(np.asarray(counts_n, dtype=np.float64))
+    r_n = np.random.RandomState(seed).standard_normal(n_samples) * scale_n
+    sketches_k = np.zeros(n_states, dtype=np.float64)
+    n_infinite_k = np.zeros(n_states, dtype=np.int64)
+    for start in range(0, n_samples, chunk_size):
+        u_block = np.asarray(u_kn[:, start:start + chunk_size], dtype=np.float64)
+        finite = np.isfinite(u_block)
+        n_infinite_k += u_block.shape[1] - finite.sum(1)
+        sketches_k += np.where(finite, u_block, 0.0).dot(r_n[start:start + chunk_size])
+    # Allow for rounding in the sketches, which are sums of n_samples terms.
+    window = np.sqrt(tolerance) * np.linalg.norm(r_n) + n_samples * np.finfo(np.float64).eps * np.abs(sketches_k).max()
+
+    order = np.lexsort((sketches_k, n_infinite_k))
+    breaks = np.where((np.diff(n_infinite_k[order]) != 0) | (np.diff(sketches_k[order]) > window))[0] + 1
+    representatives_k = np.arange(n_states)
+    for run in np.split(order, breaks):
+        run = np.sort(run)
+        while len(run) > 1:
+            # Compare the first remaining state of the run with the others.
+            squared_differences = np.zeros(len(run) - 1, dtype=np.float64)
+            for start in range(0, n_samples, chunk_size):
+                u_block = np.asarray(u_kn[np.ix_(run, np.arange(start, min(start + chunk_size, n_samples)))],
+                                     dtype=np.float64)
+                same = u_block[1:] == u_block[0]  # Also true for equal infinite values.
+                with np.errstate(invalid='ignore'):
+                    differences = np.where(same, 0.0, u_block[1:] - u_block[0]) * scale_n[start:start + chunk_size]
+                squared_differences += np.sum(differences ** 2, axis=1)
+            duplicates = squared_differences < tolerance
+            representatives_k[run[1:][duplicates]] = run[0]
+            run = run[1:][~duplicates]
+    return representatives_k
+
+
+def hash_mbar_inputs(u_kn, N_k, counts_n=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Return a hex digest identifying the data of an MBAR solve, independent of its dtype and memory layout.
+
+    Parameters
+    ----------
+    u_kn : np.ndarray, shape=(n_states, n_samples), dtype='float'
+        The reduced potential energies.  It is read in blocks of chunk_size samples,
+        so it can be memory-mapped.
+    N_k : np.ndarray, shape=(n_states), dtype='int'
+        The number of samples in each state
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample; see `MBARContext`.
+    chunk_size : int, optional, default=DEFAULT_CHUNK_SIZE
+        Number of samples hashed at a time.
+
+    Returns
+    -------
+    digest : str
+        SHA-1 digest of u_kn, N_k and counts_n, converted to float64.
+    """
+    digest = hashlib.sha1()
+    n_states, n_samples = u_kn.shape
+    digest.update(np.array([n_states, n_samples], dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(N_k, dtype=np.float64).tobytes())
+    for start in range(0, n_samples, chunk_size):
+        digest.update(np.ascontiguousarray(u_kn[:, start:start + chunk_size], dtype=np.float64).tobytes())
+    if counts_n is not None:
+        digest.update(np.ascontiguousarray(counts_n, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class SolverCheckpoint(object):
+    """Periodically save the progress of `solve_mbar_for_all_states()` to a file, so that an interrupted solve can be resumed.
+
+    The file, written with `np.savez()` and replaced atomically (see `save()`), holds the current free energies 'f_k'
+    of all states, the subsampling 'level' being solved ('n_levels', the length of the subsampling schedule,
+    for the full data), the 'protocol_step' of that level to run next or being run and its 'iteration',
+    and the 'input_hash' of the data (see `hash_mbar_inputs()`).
+
+    Parameters
+    ----------
+    filename : str
+        Path of the checkpoint file.  It is overwritten by every save.
+    interval : int, optional, default=10
+        Number of solver iterations between saves.  The progress is also saved after every
+        solver step (the only saves for the scipy methods, which do not report their iterations)
+        and every subsampling level.
+    """
+
+    def __init__(self, filename, interval=10):
+        if interval < 1:
+            raise ParameterError("Checkpoint interval must be at least one iteration, not %r" % interval)
+        self.filename = filename
+        self.interval = interval
+        self.input_hash = None
+        self.n_levels = 0
+
+    def save(self, f_k, level, protocol_step, iteration=0):
+        """Write the checkpoint file.
+
+        On Python 2 under Windows, where files cannot be renamed over existing ones, the previous
+        checkpoint is removed first, so the save is not atomic there.
+        """
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            np.savez(f, f_k=f_k, level=level, n_levels=self.n_levels, protocol_step=protocol_step,
+                     iteration=iteration, input_hash=str(self.input_hash))
+        # A checkpoint interrupted while it is written leaves the previous one intact.
+        if hasattr(os, 'replace'):
+            os.replace(temporary_filename, self.filename)
+        else:
+            if os.name == 'nt' and os.path.exists(self.filename):
+                os.remove(self.filename)
+            os.rename(temporary_filename, self.filename)
+
+    @staticmethod
+    def load(filename):
+        """Read a checkpoint file written by `save()` into a dict."""
+        with np.load(filename) as data:
+            return dict(f_k=np.array(data['f_k'], dtype=np.float64), level=int(data['level']),
+                        n_levels=int(data['n_levels']), protocol_step=int(data['protocol_step']),
+                        iteration=int(data['iteration']), input_hash=str(data['input_hash']))
+
+    def callback(self, f_k, states, level, callback=None):
+        """Return a telemetry callback for `solve_mbar()` that saves the progress of `level`.
+
+        The free energies of `states` are taken from the records, the rest from `f_k`.
+        Records are then passed on to `callback`, if it is given.
+        """
+        iterations = [0]
+
+        def checkpoint_callback(record):
+            f_k_checkpoint = np.array(f_k)
+            f_k_checkpoint[states] = record['f_k']
+            if record['event'] == 'step':
+                self.save(f_k_checkpoint, level, record['protocol_step'] + 1)
+            else:
+                iterations[0] += 1
+                if iterations[0] % self.interval == 0:
+                    self.save(f_k_checkpoint, level, record['protocol_step'], record['iteration'])
+            if callback is not None:
+                callback(record)
+        return checkpoint_callback
+
+
+def _tagged(callback, **tags):
+    """Return a callback that adds `tags` to each telemetry record before passing it on, or None."""
+    if callback is None:
+        return None
+
+    def tagged_callback(record):
+        record.update(tags)
+        callback(record)
+    return tagged_callback
+
+
+def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1E-12, options=None, linear_space=False, context=None,
+                    n_threads=1, counts_n=None, workspace=None, callback=None, time_budget=None):
     """Solve MBAR self-consistent equations using some form of equation solver.
 
     Parameters
@@ -394,7 +2398,15 @@ def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1
         The reduced free energies for the nonempty states
     method : str, optional, default="hybr"
         The optimization routine to use.  This can be any of the methods
-        available via scipy.optimize.minimize() or scipy.optimize.root().
+        available via scipy.optimize.minimize() or scipy.optimize.root(),
+        "adaptive" (see `adaptive()`), "hessian-free" (see
+        `hessian_free_newton()`), which never forms the K x K Hessian,
+        "anderson" (see `anderson()`), an accelerated self-consistent iteration,
+        "chord" (see `chord_newton()`), Newton iteration with a fixed Hessian,
+        "stochastic" (see `stochastic()`), which approximately solves from
+        minibatches of samples, or "hierarchical" (see `hierarchical()`), which
+        approximately solves clusters of states separately; the last two should
+        be followed by another method.
     tol : float, optional, default=1E-14
         The convergance tolerance for minimize() or root()
     verbose: bool
@@ -402,6 +2414,29 @@ def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1
     options: dict, optional, default=None
         Optional dictionary of algorithm-specific parameters.  See
         scipy.optimize.root or scipy.optimize.minimize for details.
+    linear_space : bool, optional, default=False
+        If True, precompute Q_kn = exp(-u_kn) once (see `LinearMBARContext`)
+        so that each iteration is a pair of matrix-vector products rather than
+        K x N evaluations of exp().  Evaluations that would lose precision in
+        linear space automatically fall back to log space.
+    context : MBARContext, optional, default=None
+        Evaluation context for u_kn_nonzero and N_k_nonzero, e.g. a
+        `ChunkedMBARContext` for data streamed from disk.  It is
+        preconditioned in place with the current f_k.  If None, a new
+        context is built from a preconditioned copy of u_kn_nonzero.
+    n_threads : int, optional, default=1
+        Number of threads used by the contexts built here; see `blocked_logsumexp()`.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample in the contexts built here; see `MBARContext`.
+    workspace : SolverWorkspace, optional, default=None
+        Buffers of the contexts built here; see `MBARContext`.
+    callback : callable, optional, default=None
+        Called with a telemetry record (dict) after every iteration of the pymbar
+        methods, and with a record of the whole step when it is done; see Notes.
+    time_budget : float, optional, default=None
+        If given, the solver is stopped after this many seconds (at the end of an iteration, or of
+        an evaluation for the scipy methods), and the iterate with the lowest gradient norm seen so
+        far is returned; see `estimate_error()` to judge whether it is good enough.
 
     Returns
     -------
@@ -413,6 +2448,20 @@ def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1
 
     Notes
     -----
+    The telemetry records passed to `callback` have an 'event' of 'iteration' or 'step'.
+    Both have 'wall_time' (seconds), and 'kernel_times' and 'evaluation_counts', the
+    parts of `MBARContext.kernel_times` and `MBARContext.evaluation_counts` incurred
+    during the iteration or step, and 'f_k', the current estimate (in the reduced
+    coordinates with f_k[0] = 0).  Iteration records also have the 'iteration' number,
+    the 'step' taken (e.g. 'SCI' or 'NR' in `adaptive()`), the 'gradient_norm' at the
+    new f_k (or the 'residual_norm' in `anderson()`) and 'max_delta', the largest
+    relative change of f_k, which is compared with tol; see each method for its other
+    entries.  Step records have the 'method', 'tol', 'n_states', 'n_samples', the list
+    of the 'iterations' records (empty for the scipy methods), 'n_iterations',
+    'gradient_norm' at the result, whether the step 'converged' (never for 'hierarchical',
+    which does not test tol), and whether its time budget was exhausted ('budget_exhausted').
+
+
     This function requires that N_k_nonzero > 0--that is, you should have
     already dropped all the states for which you have no samples.
     Internally, this function works in a reduced coordinate system defined
@@ -422,30 +2471,100 @@ def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1
     For fast but precise convergence, we recommend calling this function
     multiple times to polish the result.  `solve_mbar()` facilitates this.
     """
-    u_kn_nonzero, N_k_nonzero, f_k_nonzero = validate_inputs(u_kn_nonzero, N_k_nonzero, f_k_nonzero)
-    f_k_nonzero = f_k_nonzero - f_k_nonzero[0]  # Work with reduced dimensions with f_k[0] := 0
-    u_kn_nonzero = precondition_u_kn(u_kn_nonzero, N_k_nonzero, f_k_nonzero)
+    if context is None:
+        u_kn_nonzero, N_k_nonzero, f_k_nonzero = validate_inputs(u_kn_nonzero, N_k_nonzero, f_k_nonzero)
+        f_k_nonzero = f_k_nonzero - f_k_nonzero[0]  # Work with reduced dimensions with f_k[0] := 0
+        single_precision = u_kn_nonzero.dtype == np.float32
+        if not single_precision:
+            u_kn_nonzero = precondition_u_kn(u_kn_nonzero, N_k_nonzero, f_k_nonzero, n_threads=n_threads, validate=False)
+        # A single evaluation context is shared by all of the functions below.
+        if linear_space:
+            context = LinearMBARContext(u_kn_nonzero, N_k_nonzero, n_threads=n_threads, counts_n=counts_n,
+                                        workspace=workspace, overwrite_u_kn=True, validate=False)
+        else:
+            context = MBARContext(u_kn_nonzero, N_k_nonzero, n_threads=n_threads, counts_n=counts_n,
+                                  workspace=workspace, overwrite_u_kn=True, validate=False)
+        if single_precision:
+            context.precondition(f_k_nonzero)  # Keeps the shift in double precision; see `MBARContext`.
+    else:
+        N_k_nonzero = context.N_k
+        f_k_nonzero = ensure_type(f_k_nonzero, 'float', 1, "f_k", shape=(context.n_states,))
+        f_k_nonzero = f_k_nonzero - f_k_nonzero[0]  # Work with reduced dimensions with f_k[0] := 0
+        context.precondition(f_k_nonzero)
+
+    start = _timer()
+    kernel_times = collections.Counter(context.kernel_times)
+    evaluation_counts = collections.Counter(context.evaluation_counts)
+    iterations = []
+    budget = None if time_budget is None else _TimeBudget(time_budget, context)
+    if (callback is not None or budget is not None) and method in ITERATIVE_SOLVER_METHODS:
+        solver_callback = options.get('callback') if options is not None else None
+
+        def record_iteration(record):
+            iterations.append(record)
+            if callback is not None:
+                callback(record)
+            if solver_callback is not None:
+                solver_callback(record)
+            if budget is not None and record['step'] != 'rejected':
+                budget.observe(record['f_k'], record.get('gradient_norm'))
+        options = dict(options if options is not None else dict(), callback=record_iteration)
 
     pad = lambda x: np.pad(x, (1, 0), mode='constant')  # Helper function inserts zero before first element
-    unpad_second_arg = lambda obj, grad: (obj, grad[1:])  # Helper function drops first element of gradient
 
     # Create objective functions / nonlinear equations to send to scipy.optimize, fixing f_0 = 0
-    grad = lambda x: mbar_gradient(u_kn_nonzero, N_k_nonzero, pad(x))[1:]  # Objective function gradient
-    grad_and_obj = lambda x: unpad_second_arg(*mbar_objective_and_gradient(u_kn_nonzero, N_k_nonzero, pad(x)))  # Objective function gradient and objective function
-    hess = lambda x: mbar_hessian(u_kn_nonzero, N_k_nonzero, pad(x))[1:][:, 1:]  # Hessian of objective function
-
+    def grad(x):  # Objective function gradient
+        g = context.gradient(pad(x))
+        if budget is not None:
+            budget.observe(pad(x), np.linalg.norm(g))
+        return g[1:]
+
+    def grad_and_obj(x):  # Objective function and its gradient
+        obj, g = context.objective_and_gradient(pad(x))
+        if budget is not None:
+            budget.observe(pad(x), np.linalg.norm(g))
+        return obj, g[1:]
+    hess = lambda x: context.hessian(pad(x))[1:][:, 1:]  # Hessian of objective function
+
+    budget_exhausted = False
     with warnings.catch_warnings(record=True) as w:
-        if method in ["L-BFGS-B", "dogleg", "CG", "BFGS", "Newton-CG", "TNC", "trust-ncg", "SLSQP"]:
-            if method in ["L-BFGS-B", "CG"]:
-                hess = None  # To suppress warning from passing a hessian function.
-            results = scipy.optimize.minimize(grad_and_obj, f_k_nonzero[1:], jac=True, hess=hess, method=method, tol=tol, options=options)
-            f_k_nonzero = pad(results["x"])
-        elif method == 'adaptive':
-            results = adaptive(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options)
-            f_k_nonzero = results # they are the same for adaptive, until we decide to return more.
-        else:
-            results = scipy.optimize.root(grad, f_k_nonzero[1:], jac=hess, method=method, tol=tol, options=options)
-            f_k_nonzero = pad(results["x"])
+        try:
+            if budget is not None:
+                budget.observe(f_k_nonzero)
+            if method in ["L-BFGS-B", "dogleg", "CG", "BFGS", "Newton-CG", "TNC", "trust-ncg", "SLSQP"]:
+                if method in ["L-BFGS-B", "CG"]:
+                    hess = None  # To suppress warning from passing a hessian function.
+                results = scipy.optimize.minimize(grad_and_obj, f_k_nonzero[1:], jac=True, hess=hess, method=method, tol=tol, options=options)
+                f_k_nonzero = pad(results["x"])
+            elif method == 'adaptive':
+                results = adaptive(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options, context=context)
+                f_k_nonzero = results # they are the same for adaptive, until we decide to return more.
+            elif method == 'hessian-free':
+                results = hessian_free_newton(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options, context=context)
+                f_k_nonzero = results
+            elif method == 'anderson':
+                results = anderson(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options, context=context)
+                f_k_nonzero = results
+            elif method == 'chord':
+                results = chord_newton(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options, context=context)
+                f_k_nonzero = results
+            elif method == 'stochastic':
+                results = stochastic(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options, context=context)
+                f_k_nonzero = results
+            elif method == 'hierarchical':
+                results = hierarchical(u_kn_nonzero, N_k_nonzero, f_k_nonzero, tol=tol, options=options, context=context)
+                f_k_nonzero = results
+            else:
+                results = scipy.optimize.root(grad, f_k_nonzero[1:], jac=hess, method=method, tol=tol, options=options)
+                f_k_nonzero = pad(results["x"])
+        except _TimeBudgetExhausted:
+            budget_exhausted = True
+            f_k_nonzero = budget.f_k - budget.f_k[0]
+            if method in ITERATIVE_SOLVER_METHODS:
+                results = f_k_nonzero
+            else:
+                results = scipy.optimize.OptimizeResult(x=f_k_nonzero[1:], success=False, status=-1,
+                                                        message="Time budget exhausted")
 
     # If there were runtime warnings, show the messages
     if len(w) > 0:
@@ -458,14 +2577,31 @@ def solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, method="hybr", tol=1
             can_ignore = False  # If any warning is not just unknown options, can ]not skip check
         if not can_ignore:
             # Ensure MBAR solved correctly
-            w_nk_check = mbar_W_nk(u_kn_nonzero, N_k_nonzero, f_k_nonzero)
-            check_w_normalized(w_nk_check, N_k_nonzero)
+            context.check_weights_normalized(f_k_nonzero)
             print("MBAR weights converged within tolerance, despite the SciPy Warnings. Please validate your results.")
 
+    if callback is not None:
+        record = dict(event='step', method=method, tol=tol, n_states=context.n_states, n_samples=context.n_samples,
+                      wall_time=_timer() - start, kernel_times=dict(context.kernel_times - kernel_times),
+                      evaluation_counts=dict(context.evaluation_counts - evaluation_counts), iterations=iterations)
+        if method in ITERATIVE_SOLVER_METHODS:
+            record['n_iterations'] = len(iterations)
+            # hierarchical() only provides a starting point: its changes of f_k are not compared with tol.
+            record['converged'] = bool(method != 'hierarchical' and len(iterations) > 0 and
+                                       iterations[-1]['max_delta'] < tol)
+        else:
+            record['n_iterations'] = results.get('nit', results.get('nfev'))
+            record['converged'] = bool(results.get('success', False))
+        record['gradient_norm'] = np.linalg.norm(context.gradient(f_k_nonzero))
+        record['budget_exhausted'] = budget_exhausted
+        record['f_k'] = np.array(f_k_nonzero)
+        callback(record)
+
     return f_k_nonzero, results
 
 
-def solve_mbar(u_kn_nonzero, N_k_nonzero, f_k_nonzero, solver_protocol=None):
+def solve_mbar(u_kn_nonzero, N_k_nonzero, f_k_nonzero, solver_protocol=None, context=None, n_threads=1, counts_n=None,
+               workspace=None, overwrite_u_kn=False, callback=None, time_budget=None):
     """Solve MBAR self-consistent equations using some sequence of equation solvers.
 
     Parameters
@@ -479,7 +2615,26 @@ def solve_mbar(u_kn_nonzero, N_k_nonzero, f_k_nonzero, solver_protocol=None):
         The reduced free energies for the nonempty states
     solver_protocol: tuple(dict()), optional, default=None
         Optional list of dictionaries of steps in solver protocol.
-        If None, a default protocol will be used.
+        If None, a default protocol will be used.  Steps whose method is None
+        use DEFAULT_SOLVER_METHOD, or DEFAULT_LARGE_N_STATES_SOLVER_METHOD
+        when there are at least LARGE_N_STATES states.
+    context : MBARContext, optional, default=None
+        Evaluation context shared by all steps, see `solve_mbar_once()`.
+    n_threads : int, optional, default=1
+        Number of threads to use, unless a step of solver_protocol sets its own.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample, if no context is given; see `MBARContext`.
+    workspace : SolverWorkspace, optional, default=None
+        Buffers shared by all steps, if no context is given; see `MBARContext`.
+    overwrite_u_kn : bool, optional, default=False
+        If True and no context is given, u_kn_nonzero is preconditioned in place rather than copied.
+    callback : callable, optional, default=None
+        Called with the telemetry records of each step, see `solve_mbar_once()`, with
+        the index of the step in solver_protocol added as 'protocol_step'.
+    time_budget : float, optional, default=None
+        If given, the whole protocol is stopped after this many seconds: the step that is running
+        returns its iterate with the lowest gradient norm (see `solve_mbar_once()`), and the
+        remaining steps are skipped.
 
     Returns
     -------
@@ -502,23 +2657,65 @@ def solve_mbar(u_kn_nonzero, N_k_nonzero, f_k_nonzero, solver_protocol=None):
     converged results.  Generally, a single call to solve_mbar_once()
     will not give fully converged answers because of limited numerical precision.
     Each call to `solve_mbar_once()` re-conditions the nonlinear
-    equations using the current guess.
+    equations using the current guess.  Unless a step uses `linear_space`,
+    all steps share one `MBARContext`, so u_kn_nonzero is copied at most once.
+    Single-precision u_kn_nonzero is not copied, and the protocol is followed by
+    one Newton step in double precision from its result.
     """
+    n_states = len(N_k_nonzero) if context is None else context.n_states
+    if n_states >= LARGE_N_STATES:
+        default_method = DEFAULT_LARGE_N_STATES_SOLVER_METHOD
+    else:
+        default_method = DEFAULT_SOLVER_METHOD
     if solver_protocol is None:
-        solver_protocol = DEFAULT_SOLVER_PROTOCOL
+        solver_protocol = (dict(method=default_method),)
+    # The methods fill in their default options, so work on copies of the caller's steps.
+    solver_protocol = tuple(dict(step, options=dict(step.get('options') or dict())) for step in solver_protocol)
     for protocol in solver_protocol:
-        if protocol['method'] is None:
-            protocol['method'] = DEFAULT_SOLVER_METHOD
+        if protocol.get('method') is None:
+            protocol['method'] = default_method
+
+    shared_context = context is None and not any(step.get('linear_space', False) for step in solver_protocol)
+    if shared_context:
+        context = MBARContext(u_kn_nonzero, N_k_nonzero, n_threads=n_threads, counts_n=counts_n, workspace=workspace,
+                              overwrite_u_kn=overwrite_u_kn)
 
+    if time_budget is not None:
+        deadline = _timer() + time_budget
     all_results = []
     for k, options in enumerate(solver_protocol):
-        f_k_nonzero, results = solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, **options)
+        step_options = dict(n_threads=n_threads)
+        step_options.update(options)
+        if time_budget is not None:
+            step_options['time_budget'] = deadline - _timer()
+            if step_options['time_budget'] <= 0 and k > 0:
+                break
+        if shared_context:
+            context.n_threads = step_options['n_threads']
+        f_k_nonzero, results = solve_mbar_once(u_kn_nonzero, N_k_nonzero, f_k_nonzero, context=context, counts_n=counts_n,
+                                               workspace=workspace, callback=_tagged(callback, protocol_step=k),
+                                               **step_options)
         all_results.append(results)
-        all_results.append(("Final gradient norm: %.3g" % np.linalg.norm(mbar_gradient(u_kn_nonzero, N_k_nonzero, f_k_nonzero))))
+        if context is None:
+            gradient = MBARContext(u_kn_nonzero, N_k_nonzero, n_threads=n_threads, counts_n=counts_n,
+                                   workspace=workspace).gradient(f_k_nonzero)
+        else:
+            gradient = context.gradient(f_k_nonzero)
+        all_results.append(("Final gradient norm: %.3g" % np.linalg.norm(gradient)))
+
+    single_precision = (np.asarray(u_kn_nonzero) if context is None else context.u_kn).dtype == np.float32
+    if single_precision and len(all_results) > 0 and (time_budget is None or _timer() < deadline):
+        if context is None:
+            context = MBARContext(u_kn_nonzero, N_k_nonzero, n_threads=n_threads, counts_n=counts_n, workspace=workspace)
+        f_k_nonzero = _double_precision_polish(context, f_k_nonzero)
+        all_results.append(("Final gradient norm after double-precision polish: %.3g"
+                            % np.linalg.norm(context.gradient(f_k_nonzero))))
     return f_k_nonzero, all_results
 
 
-def solve_mbar_for_all_states(u_kn, N_k, f_k, solver_protocol):
+def solve_mbar_for_all_states(u_kn, N_k, f_k, solver_protocol, chunk_size=None, n_threads=1, subsampling_schedule=None,
+                              subsampling_protocol=None, x_kindices=None, counts_n=None, workspace=None, callback=None,
+                              checkpoint=None, resume_from=None, time_budget=None, components=None, n_processes=1):
     """Solve for free energies of states with samples, then calculate for
     empty states.
 
@@ -533,6 +2730,51 @@ def solve_mbar_for_all_states(u_kn, N_k, f_k, solver_protocol):
     solver_protocol: tuple(dict()), optional, default=None
         Sequence of dictionaries of steps in solver protocol for final
         stage of refinement.
+    chunk_size : int, optional, default=None
+        If given, u_kn (typically an np.memmap) is never copied as a whole,
+        but streamed in blocks of chunk_size samples; see `ChunkedMBARContext`.
+    n_threads : int, optional, default=1
+        Number of threads used by the K x N reductions; see `blocked_logsumexp()`.
+    subsampling_schedule : tuple(float) or 'auto', optional, default=None
+        Fractions of the samples of each state to solve on, in order, before the
+        full data, each level starting from the free energies of the last.  If 'auto',
+        it is chosen by `default_subsampling_schedule()`.  If None or (), the full data
+        is solved directly.  Every level after the first is started with fixed-Hessian
+        Newton steps (see `chord_newton()`).  If no step of solver_protocol chooses its
+        method, the full data is also started with them, and the steps then use
+        COARSE_TO_FINE_SOLVER_METHOD; otherwise solver_protocol is run as given.
+    subsampling_protocol : tuple(dict()), optional, default=None
+        Solver protocol for the first (coarsest) level.  If None, DEFAULT_SUBSAMPLING_PROTOCOL is used.
+    x_kindices : np.ndarray, shape=(n_samples), dtype='int', optional, default=None
+        State each sample was drawn from, to stratify the subsamples; see `stratified_subsample()`.
+    counts_n : np.ndarray, shape=(n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample, counted in N_k; see `MBARContext`.  Without x_kindices,
+        no subsampled levels are used.
+    workspace : SolverWorkspace, optional, default=None
+        Buffers shared by all levels and steps; see `MBARContext`.  u_kn itself is never modified.
+    callback : callable, optional, default=None
+        Called with the telemetry records of every level and step, see `solve_mbar()`, with the
+        'fraction' of the samples they were computed from added (1.0 for the full data).
+    checkpoint : SolverCheckpoint, optional, default=None
+        If given, the progress of the solve is saved to its file as it goes.
+    resume_from : str, optional, default=None
+        Checkpoint file written by an interrupted solve of the same data with the same subsampling
+        schedule and solver protocols.  The solve continues from its free energies, skipping the
+        subsampling levels and full-data protocol steps that were completed; an interrupted
+        subsampling level is solved again.  f_k is ignored.
+    time_budget : float, optional, default=None
+        If given, solving is stopped after this many seconds, returning the best iterate of the
+        level that was running (see `solve_mbar()`); the remaining levels are skipped.
+        Several components share the budget, each getting the time left when it starts.
+    components : np.ndarray, shape=(n_states), dtype='int', optional, default=None
+        Component of each state, see `state_components()`, which computes them if None.
+        Each component is solved on its own, from the samples drawn from its states, and
+        its free energies are relative to its first state.  The free energies of states in
+        no component (-1) are infinite.
+    n_processes : int or None, optional, default=1
+        Number of processes solving the components in parallel, or None for one per CPU.
+        Unless it is 1, callback is not called for their records.  Checkpoints are not
+        supported for several components.
 
     Returns
     -------
@@ -540,19 +2782,375 @@ def solve_mbar_for_all_states(u_kn, N_k, f_k, solver_protocol):
         The free energies of states
     """
     states_with_samples = np.where(N_k > 0)[0]
+    if components is None and len(states_with_samples) > 1:
+        n_components, components = state_components(u_kn, N_k, x_kindices=x_kindices, counts_n=counts_n,
+                                                    chunk_size=chunk_size or DEFAULT_CHUNK_SIZE)
+    else:
+        n_components = 1 if components is None else int(np.max(components)) + 1
+    if n_components > 1:
+        if checkpoint is not None or resume_from is not None:
+            raise ParameterError("Checkpoints are not supported for states in %d disconnected components" % n_components)
+        return _solve_components(u_kn, N_k, f_k, solver_protocol, components, n_processes, callback,
+                                 dict(chunk_size=chunk_size, n_threads=n_threads, subsampling_schedule=subsampling_schedule,
+                                      subsampling_protocol=subsampling_protocol, time_budget=time_budget),
+                                 x_kindices=x_kindices, counts_n=counts_n, workspace=workspace)
+    if subsampling_schedule is None:
+        subsampling_schedule = ()
+    elif isinstance(subsampling_schedule, six.string_types) and subsampling_schedule == 'auto':
+        if counts_n is None:
+            subsampling_schedule = default_subsampling_schedule(N_k)
+        elif x_kindices is None:
+            subsampling_schedule = ()
+        else:
+            # The cost of a solve is set by the number of samples stored, not by their multiplicities.
+            subsampling_schedule = default_subsampling_schedule(np.bincount(x_kindices, minlength=len(N_k)))
+
+    if time_budget is not None:
+        deadline = _timer() + time_budget
+    remaining_time = lambda: None if time_budget is None else deadline - _timer()
+    n_levels = len(subsampling_schedule)
+    resume_level, resume_step = 0, 0
+    if checkpoint is not None or resume_from is not None:
+        input_hash = hash_mbar_inputs(u_kn, N_k, counts_n=counts_n, chunk_size=chunk_size or DEFAULT_CHUNK_SIZE)
+    if resume_from is not None:
+        state = SolverCheckpoint.load(resume_from)
+        if state['input_hash'] != input_hash:
+            raise ParameterError("Checkpoint %s was written for different u_kn, N_k or counts_n" % resume_from)
+        if state['n_levels'] != n_levels:
+            raise ParameterError("Checkpoint %s was written with a subsampling schedule of %d levels, not %d" %
+                                 (resume_from, state['n_levels'], n_levels))
+        f_k = state['f_k']
+        resume_level, resume_step = state['level'], state['protocol_step']
+    if checkpoint is not None:
+        checkpoint.input_hash = input_hash
+        checkpoint.n_levels = n_levels
+
+    def level_callback(level, fraction):
+        tagged_callback = _tagged(callback, fraction=fraction)
+        if checkpoint is None:
+            return tagged_callback
+        return checkpoint.callback(f_k, states_with_samples, level, tagged_callback)
+
+    if len(states_with_samples) > 1 and n_levels > 0:
+        hessian = None
+        for level, fraction in enumerate(subsampling_schedule):
+            if level < resume_level:
+                continue
+            if time_budget is not None and remaining_time() <= 0:
+                break
+            n, N_k_subsample = stratified_subsample(N_k, fraction, x_kindices=x_kindices, counts_n=counts_n)
+            N_k_subsample = N_k_subsample[states_with_samples]
+            # Only the selected columns are read, so this also works for memory-mapped u_kn.
+            u_kn_subsample = np.asarray(u_kn[np.ix_(states_with_samples, n)], dtype=np.float64)
+            if hessian is None:
+                protocol = subsampling_protocol
+                if protocol is None:
+                    protocol = tuple(dict(step) for step in DEFAULT_SUBSAMPLING_PROTOCOL)
+            else:
+                # Finer levels start close to their solution: fixed-Hessian steps with the Hessian of
+                # the previous level, scaled to this sample size, cost one gradient evaluation each.
+                hessian = hessian * (N_k_subsample.sum() / hessian_samples)
+                protocol = (dict(method='chord', tol=SUBSAMPLING_TOLERANCE, options=dict(hessian=hessian)),)
+            subsample_context = MBARContext(u_kn_subsample, N_k_subsample, n_threads=n_threads,
+                                            counts_n=None if counts_n is None else counts_n[n], workspace=workspace,
+                                            overwrite_u_kn=True, validate=False)
+            f_k[states_with_samples], _ = solve_mbar(u_kn_subsample, N_k_subsample, f_k[states_with_samples],
+                                                     solver_protocol=protocol, context=subsample_context,
+                                                     callback=level_callback(level, fraction),
+                                                     time_budget=remaining_time())
+            if checkpoint is not None:
+                checkpoint.save(f_k, level + 1, 0)
+            if level + 1 < n_levels and (time_budget is None or remaining_time() > 0):
+                hessian = _hessian(subsample_context, f_k[states_with_samples] - f_k[states_with_samples[0]])
+                hessian_samples = float(N_k_subsample.sum())
+        if all(step.get('method') is None for step in solver_protocol):
+            # On the full data, a single Hessian at the warm start is accurate enough for near-quadratic
+            # convergence, and Anderson iteration then confirms or finishes convergence without another.
+            solver_protocol = tuple(dict(step, method=COARSE_TO_FINE_SOLVER_METHOD) for step in solver_protocol)
+            solver_protocol = (dict(method='chord'),) + solver_protocol
+    full_data_callback = level_callback(n_levels, 1.0)
+    if resume_level == n_levels and resume_step > 0:
+        solver_protocol = tuple(solver_protocol)[resume_step:]
+        if full_data_callback is not None:
+            remaining_steps_callback = full_data_callback
+
+            def full_data_callback(record):
+                # Steps keep their numbers in the whole protocol, as in the checkpoint.
+                record['protocol_step'] += resume_step
+                remaining_steps_callback(record)
 
     if len(states_with_samples) == 1:
         f_k_nonzero = np.array([0.0])
+    elif len(solver_protocol) == 0 or (time_budget is not None and remaining_time() <= 0):
+        f_k_nonzero = f_k[states_with_samples]
+    elif chunk_size is not None:
+        context = ChunkedMBARContext(u_kn, N_k[states_with_samples], chunk_size=chunk_size, states=states_with_samples,
+                                     n_threads=n_threads, counts_n=counts_n, workspace=workspace)
+        f_k_nonzero, all_results = solve_mbar(u_kn, N_k[states_with_samples], f_k[states_with_samples],
+                                              solver_protocol=solver_protocol, context=context,
+                                              callback=full_data_callback, time_budget=remaining_time())
+    elif len(states_with_samples) == len(N_k):
+        # Copied once, by the first preconditioning.
+        f_k_nonzero, all_results = solve_mbar(u_kn, N_k, f_k, solver_protocol=solver_protocol, n_threads=n_threads,
+                                              counts_n=counts_n, workspace=workspace, callback=full_data_callback,
+                                              time_budget=remaining_time())
     else:
+        # Indexing already made a copy, which can be preconditioned in place.
         f_k_nonzero, all_results = solve_mbar(u_kn[states_with_samples], N_k[states_with_samples],
-                                              f_k[states_with_samples], solver_protocol=solver_protocol)
+                                              f_k[states_with_samples], solver_protocol=solver_protocol,
+                                              n_threads=n_threads, counts_n=counts_n, workspace=workspace,
+                                              overwrite_u_kn=True, callback=full_data_callback,
+                                              time_budget=remaining_time())
 
     f_k[states_with_samples] = f_k_nonzero
 
     # Update all free energies because those from states with zero samples are not correctly computed by solvers.
-    f_k = self_consistent_update(u_kn, N_k, f_k)
+    if chunk_size is not None:
+        f_k = ChunkedMBARContext(u_kn, N_k, chunk_size=chunk_size, n_threads=n_threads, counts_n=counts_n,
+                                 workspace=workspace).self_consistent_update(f_k)
+    else:
+        f_k = MBARContext(u_kn, N_k, n_threads=n_threads, counts_n=counts_n,
+                          workspace=workspace).self_consistent_update(f_k)
     # This is necessary because state 0 might have had zero samples,
     # but we still want that state to be the reference with free energy 0.
     f_k -= f_k[0]
 
     return f_k
+
+
+def _solve_component(arguments):
+    """Solve one component for `_solve_components()`, possibly in another process.
+
+    A 'deadline' in the options (from `time.time()`) is turned into the time budget left when the solve starts.
+    """
+    u_kn, N_k, f_k, solver_protocol, options = arguments
+    if 'deadline' in options:
+        options = dict(options)
+        deadline = options.pop('deadline')
+        options['time_budget'] = max(deadline - time.time(), 0.0)
+    return solve_mbar_for_all_states(u_kn, N_k, f_k, solver_protocol, **options)
+
+
+def _solve_components(u_kn, N_k, f_k, solver_protocol, components, n_processes, callback, options,
+                      x_kindices=None, counts_n=None, workspace=None):
+    """Solve each component of the states separately, see `solve_mbar_for_all_states()`."""
+    state_n = _sample_states(N_k, x_kindices, counts_n)
+    n_components = int(np.max(components)) + 1
+    options = dict(options)
+    time_budget = options.pop('time_budget', None)
+    if time_budget is not None:
+        # The components share the budget: each one gets what is left when it starts.
+        options['deadline'] = time.time() + time_budget
+
+    def jobs():
+        # Generated as they are solved, so that only the blocks of u_kn being solved are in memory.
+        for component in range(n_components):
+            states = np.where(components == component)[0]
+            samples = np.where(components[state_n] == component)[0]
+            f_k_component = np.asarray(f_k[states], dtype=np.float64)
+            # An initial guess from outside the component (e.g. BAR across it) may be infinite.
+            f_k_component[~np.isfinite(f_k_component)] = 0.0
+            component_options = dict(options, components=np.zeros(len(states), dtype=np.int64),
+                                     x_kindices=np.searchsorted(states, state_n[samples]),
+                                     counts_n=None if counts_n is None else counts_n[samples])
+            if n_processes == 1:
+                component_options.update(workspace=workspace, callback=_tagged(callback, component=component))
+            # Each solve fills in the default methods of its own protocol.
+            protocol = tuple(dict(step, options=dict(step.get('options', dict()))) for step in solver_protocol)
+            # Sample labels given to the methods (see `stochastic()` and `hierarchical()`) number the states with samples.
+            labels_n = np.searchsorted(states[N_k[states] > 0], state_n[samples])
+            for step in protocol:
+                if 'x_kindices' in step['options']:
+                    step['options']['x_kindices'] = labels_n
+            yield (np.asarray(u_kn[np.ix_(states, samples)], dtype=np.float64), N_k[states], f_k_component,
+                   protocol, component_options)
+
+    if n_processes == 1:
+        f_k_components = [_solve_component(job) for job in jobs()]
+    else:
+        pool = multiprocessing.Pool(n_processes)
+        try:
+            # imap() hands the jobs to the workers as they become free, instead of building them all first.
+            f_k_components = list(pool.imap(_solve_component, jobs()))
+        finally:
+            pool.close()
+            pool.join()
+
+    f_k = np.empty(len(N_k), dtype=np.float64)
+    f_k.fill(np.inf)
+    for component, f_k_component in enumerate(f_k_components):
+        f_k[components == component] = f_k_component
+    return f_k
+
+
+def _batch_gradient(u_bkn, log_N_bk, N_bk, f_bk, counts_bn):
+    """Log-denominators, weights W_bkn (per copy of each sample) and gradients of a stack of MBAR problems."""
+    log_denominator_bn = logsumexp(f_bk[:, :, np.newaxis] + log_N_bk[:, :, np.newaxis] - u_bkn, axis=1)
+    W_bkn = np.exp(f_bk[:, :, np.newaxis] - u_bkn - log_denominator_bn[:, np.newaxis, :])
+    if counts_bn is None:
+        weight_sums_bk = W_bkn.sum(2)
+    else:
+        weight_sums_bk = np.matmul(W_bkn, counts_bn[:, :, np.newaxis])[:, :, 0]
+    return log_denominator_bn, W_bkn, -1 * N_bk * (1.0 - weight_sums_bk), weight_sums_bk
+
+
+def solve_mbar_batch(u_bkn, N_bk, f_bk=None, tol=1.0e-12, options=None, counts_bn=None):
+    """Solve a stack of independent MBAR problems of the same shape together.
+
+    The adaptive Newton-Raphson / self-consistent iteration of `adaptive()` is run on all
+    problems at once, as array operations over the stack: the Hessians of all problems
+    are formed by one batched matrix product and solved by one batched linear solve.
+    Each problem stops being updated once it has converged.
+
+    Parameters
+    ----------
+    u_bkn : np.ndarray, shape=(n_problems, n_states, n_samples) or (n_states, n_samples), dtype='float'
+        The reduced potential energies of each problem; a 2D u_kn is shared by all problems,
+        e.g. bootstrap replicates given by counts_bn.
+    N_bk : np.ndarray, shape=(n_problems, n_states) or (n_states), dtype='int'
+        The number of samples in each state of each problem.  States may be empty.
+    f_bk : np.ndarray, shape=(n_problems, n_states), dtype='float', optional, default=None
+        Initial free energies; if None, zeros.
+    tol : float, optional, default=1.0e-12
+        Relative tolerance for convergence, as in `adaptive()`.
+    options : dict, optional, default=None
+        maximum_iterations (int) - maximum number of iterations (default 250)
+        gamma (float between 0 and 1) - incrementor for Newton-Raphson steps (default 1.0)
+        verbose (boolean) - verbosity level for debug output
+    counts_bn : np.ndarray, shape=(n_problems, n_samples), dtype='float', optional, default=None
+        Multiplicity of each sample in each problem; see `MBARContext`.
+
+    Returns
+    -------
+    f_bk : np.ndarray, shape=(n_problems, n_states), dtype='float'
+        The free energies of all states of each problem, relative to state 0.
+
+    Notes
+    -----
+    The working memory is a few n_problems x n_states x n_samples arrays, so this is meant for
+    many small to medium problems; solve large ones with `solve_mbar()`.
+    """
+    if options is None:
+        options = dict()
+    options.setdefault('verbose', False)
+    options.setdefault('maximum_iterations', 250)
+    options.setdefault('gamma', 1.0)
+    gamma = options['gamma']
+
+    u_bkn = np.asarray(u_bkn, dtype=np.float64)
+    if counts_bn is not None:
+        counts_bn = np.atleast_2d(np.asarray(counts_bn, dtype=np.float64))
+        if np.any(counts_bn < 0):
+            raise ParameterError("counts_bn must be nonnegative")
+    if u_bkn.ndim == 2:
+        n_problems = len(N_bk) if np.ndim(N_bk) == 2 else (1 if counts_bn is None else len(counts_bn))
+        u_bkn = np.broadcast_to(u_bkn, (n_problems,) + u_bkn.shape)
+    if u_bkn.ndim != 3:
+        raise ParameterError("u_bkn must be ndim 3. You supplied %s" % u_bkn.ndim)
+    n_problems, n_states, n_samples = u_bkn.shape
+    N_bk = np.array(np.broadcast_to(N_bk, (n_problems, n_states)), dtype=np.float64)
+    if counts_bn is not None:
+        counts_bn = np.array(np.broadcast_to(counts_bn, (n_problems, n_samples)))
+        if not np.allclose(N_bk.sum(1), counts_bn.sum(1)):
+            raise ParameterError("The sum of N_bk over states must equal the sum of counts_bn for each problem.")
+    elif np.any(N_bk.sum(1) != n_samples):
+        raise ParameterError("The sum of N_bk over states must equal the number of samples of each problem.")
+    if f_bk is None:
+        f_bk = np.zeros((n_problems, n_states), dtype=np.float64)
+    else:
+        f_bk = np.array(np.broadcast_to(f_bk, (n_problems, n_states)), dtype=np.float64)
+
+    sampled_bk = N_bk > 0
+    with np.errstate(divide='ignore'):
+        log_N_bk = np.log(N_bk)
+    # Free energies are relative to the first sampled state of each problem while iterating.
+    reference_b = np.argmax(sampled_bk, axis=1)
+    problems = np.arange(n_problems)
+    f_bk -= f_bk[problems, reference_b][:, np.newaxis]
+    # The Hessian of the sampled states is singular along (1, ..., 1).  Adding N_k N_l / N removes the
+    # null space without changing the gauge-fixed Newton step, since the gradient sums to zero.
+    # Empty states have zero gradient and get a unit diagonal, so they are left alone.
+    regularization_bkl = N_bk[:, :, np.newaxis] * N_bk[:, np.newaxis, :] / N_bk.sum(1)[:, np.newaxis, np.newaxis]
+    regularization_bkl[:, np.arange(n_states), np.arange(n_states)] += ~sampled_bk
+
+    def evaluate(index, f):
+        return _batch_gradient(u_bkn[index], log_N_bk[index], N_bk[index], f,
+                               None if counts_bn is None else counts_bn[index])
+
+    active = np.ones(n_problems, dtype=bool)
+    sci_iter_b = np.zeros(n_problems, dtype=np.int64)
+    max_delta_b = np.zeros(n_problems, dtype=np.float64)
+    log_denominator_bn, W_bkn, g_bk, weight_sums_bk = evaluate(slice(None), f_bk)
+    if options['verbose']:
+        print("Determining dimensionless free energies of %d problems by batched Newton-Raphson / "
+              "self-consistent iteration." % n_problems)
+    for iteration in range(options['maximum_iterations']):
+        index = np.where(active)[0]
+        if len(index) == n_problems:
+            index = slice(None)  # Avoids copying u_bkn while every problem is active.
+        f = f_bk[index]
+        N = N_bk[index]
+
+        # Newton-Raphson step from batched Hessians.
+        WcW_bkl = W_bkn if counts_bn is None else W_bkn * counts_bn[index][:, np.newaxis, :]
+        H_bkl = -1 * np.matmul(WcW_bkl, W_bkn.transpose(0, 2, 1))
+        H_bkl *= N[:, :, np.newaxis]
+        H_bkl *= N[:, np.newaxis, :]
+        H_bkl[:, np.arange(n_states), np.arange(n_states)] += weight_sums_bk * N
+        H_bkl += regularization_bkl[index]
+        Hinvg = np.linalg.solve(H_bkl, g_bk[:, :, np.newaxis])[:, :, 0]
+        f_nr = f - gamma * Hinvg
+
+        # Self-consistent update, from the log-denominators already computed.
+        counts = None if counts_bn is None else counts_bn[index][:, np.newaxis, :]
+        f_sci = -logsumexp(-u_bkn[index] - log_denominator_bn[:, np.newaxis, :], axis=2, b=counts)
+
+        reference = reference_b[index]
+        rows = np.arange(len(f))
+        f_nr -= f_nr[rows, reference][:, np.newaxis]
+        f_sci -= f_sci[rows, reference][:, np.newaxis]
+        f_sci[~sampled_bk[index]] = f[~sampled_bk[index]]
+        nr = evaluate(index, f_nr)
+        sci = evaluate(index, f_sci)
+        gnorm_nr = np.einsum('bk,bk->b', nr[2], nr[2])
+        gnorm_sci = np.einsum('bk,bk->b', sci[2], sci[2])
+
+        # Whichever point has the lower gradient norm is kept, problem by problem, as in adaptive().
+        use_sci = (gnorm_sci < gnorm_nr) | (sci_iter_b[index] < 2)
+        sci_iter_b[index] += use_sci
+        f_new = np.where(use_sci[:, np.newaxis], f_sci, f_nr)
+        log_denominator_bn, W_bkn, g_bk, weight_sums_bk = [np.where(use_sci.reshape((-1,) + (1,) * (a.ndim - 1)), a, b)
+                                                           for a, b in zip(sci, nr)]
+
+        div = np.abs(f_new)
+        div[div < min(1.0e-8, tol)] = 1.0
+        delta = np.abs(f_new - f) / div
+        delta[rows, reference] = 0.0
+        max_delta = delta.max(1)
+        f_bk[index] = f_new
+        max_delta_b[index] = max_delta
+
+        converged = np.isnan(max_delta) | (max_delta < tol)
+        if np.any(converged):
+            still_active = ~converged
+            active[np.where(active)[0][converged]] = False
+            log_denominator_bn, W_bkn, g_bk, weight_sums_bk = (log_denominator_bn[still_active], W_bkn[still_active],
+                                                               g_bk[still_active], weight_sums_bk[still_active])
+        if options['verbose']:
+            print("Iteration %d: %d of %d problems still iterating" % (iteration, active.sum(), n_problems))
+        if not np.any(active):
+            break
+
+    if np.any(active):
+        print('WARNING: %d of %d problems did not converge to within specified tolerance.' % (active.sum(), n_problems))
+        print('max_delta = {:e}, tol = {:e}, maximum_iterations = {:d}'.format(max_delta_b[active].max(), tol,
+                                                                               options['maximum_iterations']))
+
+    # Free energies of empty states follow from one self-consistent update, as in solve_mbar_for_all_states().
+    if not np.all(sampled_bk):
+        log_denominator_bn = evaluate(slice(None), f_bk)[0]
+        counts = None if counts_bn is None else counts_bn[:, np.newaxis, :]
+        f_empty = -logsumexp(-u_bkn - log_denominator_bn[:, np.newaxis, :], axis=2, b=counts)
+        f_bk[~sampled_bk] = f_empty[~sampled_bk]
+    f_bk -= f_bk[:, :1]
+    return f_bk
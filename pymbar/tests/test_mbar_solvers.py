@@ -1,7 +1,8 @@
+import functools
 import numpy as np
 import pymbar
 import warnings
-from pymbar.utils_for_testing import eq, suppress_derivative_warnings_for_tests
+from pymbar.utils_for_testing import eq, ok_, suppress_derivative_warnings_for_tests
 import scipy.misc
 from nose import SkipTest
 
@@ -88,3 +89,598 @@ def test_protocols():
             fe_sigma = results['dDelta_f'][0,1:]
             z = (fe - fa) / fe_sigma
             eq(z / z_scale_factor, np.zeros(len(z)), decimal=0)
+
+
+def test_context_matches_functions():
+    """The cached evaluation context agrees with the stand-alone solver functions."""
+    name, u_kn, N_k, s_n = load_oscillators(20, 50)
+    f_k = np.random.normal(size=len(N_k))
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k)
+    for _ in range(2):  # Second pass is served from the cache.
+        eq(context.gradient(f_k), pymbar.mbar_solvers.mbar_gradient(u_kn, N_k, f_k))
+        eq(context.hessian(f_k), pymbar.mbar_solvers.mbar_hessian(u_kn, N_k, f_k))
+        eq(context.log_W_nk(f_k), pymbar.mbar_solvers.mbar_log_W_nk(u_kn, N_k, f_k))
+        eq(context.self_consistent_update(f_k), pymbar.mbar_solvers.self_consistent_update(u_kn, N_k, f_k))
+        obj, grad = context.objective_and_gradient(f_k)
+        obj0, grad0 = pymbar.mbar_solvers.mbar_objective_and_gradient(u_kn, N_k, f_k)
+        eq(obj, obj0)
+        eq(grad, grad0)
+
+
+def test_linear_space_context():
+    """The linear-space context agrees with log space, falling back where linear space would underflow."""
+    name, u_kn, N_k, s_n = load_oscillators(20, 50)
+    f_k = np.random.normal(size=len(N_k))
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k)
+    linear_context = pymbar.mbar_solvers.LinearMBARContext(u_kn, N_k)
+    eq(linear_context.gradient(f_k), context.gradient(f_k))
+    eq(linear_context.hessian(f_k), context.hessian(f_k))
+    eq(linear_context.self_consistent_update(f_k), context.self_consistent_update(f_k))
+    eq(linear_context.n_log_space_fallbacks, 0)
+
+    # Samples that only the last state covers, at a free energy far below the others, underflow in linear space.
+    u_kn = np.random.normal(size=(3, 30))
+    u_kn[2, 20:] -= 3000.0
+    N_k = np.array([10, 10, 10])
+    f_k = np.array([0.0, 1.0, -3000.0])
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k)
+    linear_context = pymbar.mbar_solvers.LinearMBARContext(u_kn, N_k)
+    eq(linear_context.gradient(f_k), context.gradient(f_k))
+    ok_(linear_context.n_log_space_fallbacks > 0)
+
+    name, u_kn, N_k, s_n = load_oscillators(20, 50)
+
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar_linear = pymbar.MBAR(u_kn, N_k, solver_protocol=({'method': 'adaptive', 'linear_space': True},))
+    eq(mbar_linear.f_k, mbar.f_k, decimal=8)
+
+
+def test_hessian_free_newton():
+    """Hessian-vector products match the dense Hessian, and the Hessian-free solver matches adaptive."""
+    name, u_kn, N_k, s_n = load_oscillators(20, 50)
+    f_k = np.random.normal(size=len(N_k))
+    v_k = np.random.normal(size=len(N_k))
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k)
+    eq(context.hessian_vector_product(f_k, v_k), context.hessian(f_k).dot(v_k))
+
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar_hf = pymbar.MBAR(u_kn, N_k, solver_protocol=({'method': 'hessian-free'},))
+    eq(mbar_hf.f_k, mbar.f_k, decimal=8)
+
+
+def test_chunked_memmap():
+    """Solving over a memory-mapped u_kn in small blocks gives the in-memory result."""
+    import os
+    import tempfile
+    name, u_kn, N_k, s_n = load_oscillators(10, 50)
+    f_k = np.random.normal(size=len(N_k))
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k)
+    chunked_context = pymbar.mbar_solvers.ChunkedMBARContext(u_kn, N_k, chunk_size=37)
+    eq(chunked_context.gradient(f_k), context.gradient(f_k))
+    eq(chunked_context.hessian(f_k), context.hessian(f_k))
+    eq(chunked_context.log_W_nk(f_k), context.log_W_nk(f_k))
+
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'u_kn.npy')
+    np.save(filename, u_kn)
+    try:
+        mbar = pymbar.MBAR(u_kn, N_k)
+        mbar_chunked = pymbar.MBAR(filename, N_k, chunk_size=37)
+        eq(mbar_chunked.f_k, mbar.f_k, decimal=8)
+        eq(np.array(mbar_chunked.Log_W_nk), mbar.Log_W_nk, decimal=8)
+        del mbar_chunked
+    finally:
+        os.remove(filename)
+        os.rmdir(directory)
+
+
+def test_single_precision():
+    """Single-precision storage of u_kn and Log_W_nk reproduces double-precision estimates."""
+    name, u_kn, N_k, s_n = load_oscillators(10, 50)
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar32 = pymbar.MBAR(u_kn, N_k, dtype=np.float32)
+    ok_(mbar32.u_kn.dtype == np.float32)
+    ok_(mbar32.Log_W_nk.dtype == np.float32)
+    eq(mbar32.f_k, mbar.f_k, decimal=4)
+    # The solution is that of the stored data, found in double precision.
+    u_kn_stored = mbar32.u_kn.astype(np.float64) + mbar32.u_shift_n
+    eq(mbar32.f_k, pymbar.MBAR(u_kn_stored, N_k).f_k, decimal=12)
+    ok_(np.linalg.norm(pymbar.mbar_solvers.mbar_gradient(u_kn_stored, N_k, mbar32.f_k)) < 1e-10)
+
+    results = mbar.getFreeEnergyDifferences()
+    results32 = mbar32.getFreeEnergyDifferences()
+    eq(results32['Delta_f'], results['Delta_f'], decimal=4)
+    eq(results32['dDelta_f'], results['dDelta_f'], decimal=4)
+
+    A_n = u_kn[0]
+    results = mbar.computeExpectations(A_n)
+    results32 = mbar32.computeExpectations(A_n)
+    eq(results32['mu'], results['mu'], decimal=4)
+    eq(results32['sigma'], results['sigma'], decimal=4)
+
+
+def test_stochastic():
+    """Stratified minibatch iteration gets close to the solution, and the protocol finishes it."""
+    name, u_kn, N_k, s_n = load_oscillators(10, 500)
+    mbar = pymbar.MBAR(u_kn, N_k)
+    protocol = ({'method': 'stochastic', 'options': {'seed': 0, 'batch_fraction': 0.1, 'minimum_batch_size': 100}},)
+    mbar_stochastic = pymbar.MBAR(u_kn, N_k, solver_protocol=protocol)
+    eq(mbar_stochastic.f_k, mbar.f_k, decimal=4)
+
+    protocol = ({'method': 'stochastic', 'options': {'seed': 0}}, {'method': 'adaptive'})
+    mbar_stochastic = pymbar.MBAR(u_kn, N_k, solver_protocol=protocol)
+    eq(mbar_stochastic.f_k, mbar.f_k, decimal=8)
+
+    # The protocol is not tied to the first data set, and can be reused for another one.
+    ok_(protocol == ({'method': 'stochastic', 'options': {'seed': 0}}, {'method': 'adaptive'}))
+    name, u_kn, N_k, s_n = load_oscillators(5, 300)
+    eq(pymbar.MBAR(u_kn, N_k, solver_protocol=protocol).f_k, pymbar.MBAR(u_kn, N_k).f_k, decimal=8)
+
+
+def test_anderson():
+    """Anderson-accelerated self-consistent iteration matches adaptive, and is the default for many states."""
+    name, u_kn, N_k, s_n = load_oscillators(20, 50)
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar_anderson = pymbar.MBAR(u_kn, N_k, solver_protocol=({'method': 'anderson'},))
+    eq(mbar_anderson.f_k, mbar.f_k, decimal=8)
+
+    protocol = ({'method': None},)
+    N_k_large = np.ones(pymbar.mbar_solvers.LARGE_N_STATES)
+    records = []
+    pymbar.mbar_solvers.solve_mbar(np.zeros((len(N_k_large), len(N_k_large))), N_k_large, np.zeros(len(N_k_large)),
+                                   solver_protocol=protocol, callback=records.append)
+    ok_([record['method'] for record in records if record['event'] == 'step'] ==
+        [pymbar.mbar_solvers.DEFAULT_LARGE_N_STATES_SOLVER_METHOD])
+    # The caller's protocol is left as it was.
+    ok_(protocol == ({'method': None},))
+
+
+def test_subsampling():
+    """Coarse-to-fine solves on stratified subsamples converge to the direct solution."""
+    name, u_kn, N_k, s_n = load_oscillators(10, 500)
+    n, N_k_subsample = pymbar.mbar_solvers.stratified_subsample(N_k, 0.25, minimum_per_state=10)
+    eq(N_k_subsample, np.ones(len(N_k), dtype=np.int64) * 125)
+    eq(np.bincount(s_n[n]), N_k_subsample)
+    eq(pymbar.mbar_solvers.default_subsampling_schedule(N_k), ())
+    eq(pymbar.mbar_solvers.default_subsampling_schedule(N_k, minimum_samples=0, minimum_per_state=0), (0.01, 0.05, 0.25))
+
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar_subsampled = pymbar.MBAR(u_kn, N_k, subsampling_schedule=(0.05, 0.25))
+    eq(mbar_subsampled.f_k, mbar.f_k, decimal=8)
+    eq(pymbar.MBAR(u_kn, N_k, subsampling_schedule='auto').f_k, mbar.f_k, decimal=8)
+
+    # Only a protocol that leaves the methods to the solver is changed after the subsampled levels.
+    for protocol, methods in [(None, ['chord', 'anderson']), (({'method': 'adaptive'},), ['adaptive'])]:
+        records = []
+        subsampling_protocol = ({'method': None},)
+        mbar_subsampled = pymbar.MBAR(u_kn, N_k, solver_protocol=protocol, subsampling_schedule=(0.05, 0.25),
+                                      subsampling_protocol=subsampling_protocol, callback=records.append)
+        ok_([record['method'] for record in records if record['event'] == 'step' and record['fraction'] == 1.0] == methods)
+        eq(mbar_subsampled.f_k, mbar.f_k, decimal=8)
+        ok_(subsampling_protocol == ({'method': None},))
+
+
+def test_counts():
+    """Sample multiplicities give the same estimates as explicitly repeating the samples."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    counts_n = np.random.RandomState(0).randint(0, 4, size=len(s_n))
+    N_k_repeated = np.bincount(s_n, weights=counts_n, minlength=len(N_k))
+    A_n = u_kn[0] ** 2
+    mbar = pymbar.MBAR(np.repeat(u_kn, counts_n, axis=1), N_k_repeated)
+    for chunk_size in [None, 20]:
+        mbar_counts = pymbar.MBAR(u_kn, N_k_repeated, counts_n=counts_n, x_kindices=s_n, chunk_size=chunk_size)
+        eq(mbar_counts.f_k, mbar.f_k, decimal=8)
+        eq(mbar_counts.getFreeEnergyDifferences()['dDelta_f'], mbar.getFreeEnergyDifferences()['dDelta_f'], decimal=8)
+        for method in ['svd', 'svd-ew', 'approximate']:
+            eq(mbar_counts.computeExpectations(A_n, uncertainty_method=method)['sigma'],
+               mbar.computeExpectations(np.repeat(A_n, counts_n), uncertainty_method=method)['sigma'], decimal=8)
+        eq(mbar_counts.computeOverlap()['matrix'], mbar.computeOverlap()['matrix'], decimal=8)
+        eq(mbar_counts.computeEffectiveSampleNumber(), mbar.computeEffectiveSampleNumber(), decimal=6)
+
+    # The Hessian with multiplicities is that of the repeated samples, also away from the solution.
+    f_k = mbar.f_k + np.linspace(0, 1, len(N_k))
+    hessian = pymbar.mbar_solvers.MBARContext(np.repeat(u_kn, counts_n, axis=1), N_k_repeated).hessian(f_k)
+    for context in [pymbar.mbar_solvers.MBARContext(u_kn, N_k_repeated, counts_n=counts_n),
+                    pymbar.mbar_solvers.LinearMBARContext(u_kn, N_k_repeated, counts_n=counts_n),
+                    pymbar.mbar_solvers.ChunkedMBARContext(u_kn, N_k_repeated, chunk_size=20, counts_n=counts_n)]:
+        eq(context.hessian(f_k), hessian, decimal=8)
+
+
+def test_compress_duplicates():
+    """Merging identical samples leaves the estimates and the per-sample weights unchanged."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    repeats_n = np.random.RandomState(0).randint(1, 4, size=len(s_n))
+    u_kn, s_n = np.repeat(u_kn, repeats_n, axis=1), np.repeat(s_n, repeats_n)
+    N_k = np.bincount(s_n, minlength=len(N_k))
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar_compressed = pymbar.MBAR(u_kn, N_k, compress_duplicates=True)
+    eq(len(np.unique(mbar_compressed.sample_index_n)), len(repeats_n))
+    eq(mbar_compressed.f_k, mbar.f_k, decimal=8)
+    # The attributes describe the input samples.
+    eq(mbar_compressed.N, mbar.N)
+    eq(mbar_compressed.u_kn, mbar.u_kn)
+    eq(mbar_compressed.x_kindices, mbar.x_kindices)
+    ok_(mbar_compressed.counts_n is None)
+    eq(mbar_compressed.Log_W_nk, mbar.Log_W_nk, decimal=8)
+    eq(mbar_compressed.getWeights(), mbar.getWeights(), decimal=8)
+    eq(mbar_compressed.getFreeEnergyDifferences()['dDelta_f'], mbar.getFreeEnergyDifferences()['dDelta_f'], decimal=8)
+    for key in ['mu', 'sigma']:
+        eq(mbar_compressed.computeExpectations(u_kn[0] ** 2)[key], mbar.computeExpectations(u_kn[0] ** 2)[key], decimal=8)
+    eq(mbar_compressed.computePerturbedFreeEnergies(2 * u_kn[:2])['Delta_f'],
+       mbar.computePerturbedFreeEnergies(2 * u_kn[:2])['Delta_f'], decimal=8)
+    bin_n = s_n % 2
+    eq(mbar_compressed.computePMF(u_kn[0], bin_n, 2)['f_i'], mbar.computePMF(u_kn[0], bin_n, 2)['f_i'], decimal=8)
+
+    # Observables need not agree between copies: their expectations are still exact.
+    A_n = np.arange(len(s_n), dtype=np.float64)
+    eq(mbar_compressed.computeExpectations(A_n)['mu'], mbar.computeExpectations(A_n)['mu'], decimal=8)
+
+
+def test_factorized_u_kn():
+    """A factorized u_kn gives the same results as the dense matrix, and can be evaluated at new coefficients."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    coefficients_km = np.random.RandomState(0).uniform(0.5, 2.0, size=(len(N_k), 2))
+    descriptors_mn = np.array([u_kn[0], u_kn[-1]])
+    u_factorized = pymbar.utils.FactorizedReducedPotential(coefficients_km, descriptors_mn)
+    u_dense = np.asarray(u_factorized)
+    eq(u_dense, coefficients_km.dot(descriptors_mn))
+    eq(u_factorized[np.ix_([1, 3], [0, 5, 7])], u_dense[np.ix_([1, 3], [0, 5, 7])])
+    eq(u_factorized[2, 10:20], u_dense[2, 10:20])
+    # Indexing follows numpy: index arrays are paired, not combined into a block.
+    for key in [([1, 3, 4], [0, 5, 7]), (np.array([[0], [2]]), [1, 2]), (1, [4, 9]), (N_k > 0, 3), (4, 7)]:
+        eq(u_factorized[key], u_dense[key])
+
+    mbar = pymbar.MBAR(u_dense, N_k)
+    mbar_factorized = pymbar.MBAR(u_factorized, N_k, chunk_size=30)
+    eq(mbar_factorized.f_k, mbar.f_k, decimal=8)
+    eq(mbar_factorized.computeExpectations(descriptors_mn[0])['mu'], mbar.computeExpectations(descriptors_mn[0])['mu'],
+       decimal=8)
+    u_ln = u_factorized.with_coefficients([[1.0, 1.0], [1.5, 0.5]])
+    eq(mbar_factorized.computePerturbedFreeEnergies(u_ln)['Delta_f'],
+       mbar.computePerturbedFreeEnergies(np.asarray(u_ln))['Delta_f'], decimal=8)
+
+
+def test_fortran_order_u_kn():
+    """Sample-major (Fortran-ordered) u_kn is solved in place and gives the same free energies."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    u_kn_fortran = np.asfortranarray(u_kn)
+    ok_(np.shares_memory(pymbar.mbar_solvers.validate_inputs(u_kn_fortran, N_k, np.zeros(len(N_k)))[0],
+                         u_kn_fortran))
+    f_k = pymbar.mbar_solvers.solve_mbar(u_kn, N_k, np.zeros(len(N_k)))[0]
+    eq(pymbar.mbar_solvers.solve_mbar(u_kn_fortran, N_k, np.zeros(len(N_k)))[0], f_k, decimal=10)
+    eq(pymbar.MBAR(u_kn_fortran, N_k).f_k, pymbar.MBAR(u_kn, N_k).f_k, decimal=10)
+
+
+def test_workspace():
+    """Contexts sharing a workspace reuse its buffers without mixing up their weights."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    u_kn_original = u_kn.copy()
+    f_k = pymbar.MBAR(u_kn, N_k).f_k
+    workspace = pymbar.mbar_solvers.SolverWorkspace()
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k, workspace=workspace)
+    other = pymbar.mbar_solvers.MBARContext(u_kn[::-1], N_k[::-1], workspace=workspace)
+    W_nk = context.W_nk(f_k).copy()
+    eq(other.W_nk(f_k[::-1]), W_nk[:, ::-1])
+    ok_(np.shares_memory(context.W_nk(f_k + 1.0), other.W_nk(f_k[::-1])))
+    eq(context.W_nk(f_k), W_nk)
+    eq(context.hessian(f_k), pymbar.mbar_solvers.mbar_hessian(u_kn, N_k, f_k))
+
+    # Preconditioning copies u_kn once, unless it may be overwritten.
+    context.precondition(f_k)
+    eq(u_kn, u_kn_original)
+    u_kn_preconditioned = context.u_kn
+    context.precondition(f_k)
+    ok_(context.u_kn is u_kn_preconditioned)
+    eq(context.W_nk(f_k), W_nk)
+    u_kn_copy = u_kn.copy()
+    pymbar.mbar_solvers.MBARContext(u_kn_copy, N_k, overwrite_u_kn=True).precondition(f_k)
+    eq(u_kn_copy, pymbar.mbar_solvers.precondition_u_kn(u_kn, N_k, f_k))
+
+    f_k_solved = pymbar.mbar_solvers.solve_mbar_for_all_states(u_kn, N_k, np.zeros(len(N_k)), ({'method': 'adaptive'},),
+                                                              subsampling_schedule=(), workspace=workspace)
+    eq(f_k_solved, f_k, decimal=8)
+    eq(u_kn, u_kn_original)
+    ok_(workspace.nbytes > 0)
+
+
+def test_trusted_inputs():
+    """Contexts built from inputs validated before give the same results without checking them again."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    u_kn, N_k_float, f_k = pymbar.mbar_solvers.validate_inputs(u_kn, N_k, pymbar.MBAR(u_kn, N_k).f_k)
+    context = pymbar.mbar_solvers.MBARContext(u_kn, N_k)
+    trusted = pymbar.mbar_solvers.MBARContext(u_kn, N_k_float, validate=False)
+    eq(trusted.gradient(f_k), context.gradient(f_k))
+    eq(trusted.hessian(f_k), context.hessian(f_k))
+    eq(pymbar.mbar_solvers.precondition_u_kn(u_kn, N_k_float, f_k, validate=False),
+       pymbar.mbar_solvers.precondition_u_kn(u_kn, N_k, f_k))
+
+    # The weights of an MBAR object are checked by the first uncertainty calculation only.
+    mbar = pymbar.MBAR(u_kn, N_k)
+    ok_(not mbar._weights_checked)
+    dDelta_f = mbar.getFreeEnergyDifferences()['dDelta_f']
+    ok_(mbar._weights_checked)
+    eq(mbar.getFreeEnergyDifferences()['dDelta_f'], dDelta_f)
+
+
+def test_solver_trace():
+    """Every protocol step and iteration is recorded in solver_trace and passed to the callback."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 50)
+    records = []
+    protocol = ({'method': 'hybr'}, {'method': 'anderson', 'tol': 1e-6}, {'method': 'adaptive'})
+    mbar = pymbar.MBAR(u_kn, N_k, solver_protocol=protocol, subsampling_schedule=(), callback=records.append)
+    eq(len(mbar.solver_trace), 3)
+    ok_([step['method'] for step in mbar.solver_trace] == ['hybr', 'anderson', 'adaptive'])
+    ok_([record for record in records if record['event'] == 'step'] == mbar.solver_trace)
+    eq(sum(len(step['iterations']) for step in mbar.solver_trace) + 3, len(records))
+    for index, step in enumerate(mbar.solver_trace):
+        eq(step['protocol_step'], index)
+        ok_(step['converged'])
+        ok_(step['gradient_norm'] < 1e-6)
+        ok_(step['evaluation_counts']['log_denominator_n'] > 0)
+        ok_(step['wall_time'] >= sum(step['kernel_times'].values()) - 1e-6)
+    for iteration in mbar.solver_trace[2]['iterations']:
+        ok_(iteration['step'] in ('SCI', 'NR'))
+        eq(iteration['protocol_step'], 2)
+    ok_(mbar.solver_trace[1]['iterations'][-1]['max_delta'] < 1e-6)
+    ok_(len(mbar.solver_trace[0]['iterations']) == 0 and mbar.solver_trace[0]['n_iterations'] > 0)
+
+
+def test_checkpoint_resume():
+    """A solve interrupted after a checkpoint resumes from it, and only for the same inputs."""
+    import os
+    import shutil
+    import tempfile
+    name, u_kn, N_k, s_n = load_oscillators(5, 200)
+    protocol = ({'method': 'anderson', 'tol': 1e-4}, {'method': 'adaptive'})
+    options = dict(solver_protocol=protocol, subsampling_schedule=(0.5,), subsampling_protocol=({'method': 'adaptive'},))
+    f_k = pymbar.MBAR(u_kn, N_k, **options).f_k
+
+    class Interrupted(Exception):
+        pass
+
+    def interrupt(record):
+        if record['fraction'] == 1.0 and record['protocol_step'] == 1:
+            raise Interrupted()
+
+    directory = tempfile.mkdtemp()
+    try:
+        checkpoint_file = os.path.join(directory, 'checkpoint.npz')
+        try:
+            pymbar.MBAR(u_kn, N_k, checkpoint_file=checkpoint_file, checkpoint_interval=1, callback=interrupt, **options)
+        except Interrupted:
+            pass
+        state = pymbar.mbar_solvers.SolverCheckpoint.load(checkpoint_file)
+        # Saved after the first iteration of the last step, following anderson.
+        eq((state['level'], state['n_levels'], state['protocol_step'], state['iteration']), (1, 1, 1, 0))
+        mbar = pymbar.MBAR(u_kn, N_k, resume_from=checkpoint_file, **options)
+        eq(mbar.f_k, f_k, decimal=8)
+        ok_([(step['fraction'], step['protocol_step']) for step in mbar.solver_trace] == [(1.0, 1)])
+
+        u_kn_changed = u_kn.copy()
+        u_kn_changed[0, 0] += 1.0
+        try:
+            pymbar.MBAR(u_kn_changed, N_k, resume_from=checkpoint_file, **options)
+        except pymbar.utils.ParameterError:
+            pass
+        else:
+            raise AssertionError("Resuming with different u_kn should fail")
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_time_budget():
+    """A solve stopped by its time budget returns its best iterate and reports how good it is."""
+    name, u_kn, N_k, s_n = load_oscillators(5, 100)
+    mbar = pymbar.MBAR(u_kn, N_k, time_budget=60.0)
+    ok_(not mbar.convergence['budget_exhausted'])
+    ok_(mbar.convergence['gradient_norm'] < 1e-6 and mbar.convergence['estimated_error'] < 1e-6)
+
+    for method in ['adaptive', 'anderson', 'hybr', 'L-BFGS-B']:
+        records = []
+        f_k, results = pymbar.mbar_solvers.solve_mbar_once(u_kn, N_k, np.zeros(5), method=method, time_budget=0.0,
+                                                           callback=records.append)
+        eq(f_k, np.zeros(5))
+        ok_(records[-1]['budget_exhausted'] and not records[-1]['converged'])
+
+    mbar = pymbar.MBAR(u_kn, N_k, solver_protocol=({'method': 'adaptive'},), time_budget=0.0)
+    ok_(mbar.convergence['budget_exhausted'])
+    gradient_norm = np.linalg.norm(pymbar.mbar_solvers.mbar_gradient(u_kn, N_k, mbar.f_k))
+    eq(mbar.convergence['gradient_norm'], gradient_norm)
+    # The error of the initial guess is estimated to within the accuracy of the Newton step.
+    error = np.max(np.abs(mbar.f_k - pymbar.MBAR(u_kn, N_k).f_k))
+    ok_(0.5 * error < mbar.convergence['estimated_error'] < 2 * error)
+
+
+def test_sparse_hessian():
+    """The sparse Hessian matches the dense one, and Newton steps with it find the same solution."""
+    # Umbrella-like ladder: harmonic oscillators whose neighbours overlap, but not the states further apart.
+    x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=np.arange(16.0), K_k=16 * np.ones(16)).sample(
+        20 * np.ones(16, int), mode='u_kn', seed=0)
+    f_k = pymbar.MBAR(u_kn, N_k).f_k
+    counts_n = np.tile([1.0, 2.0], 160)
+    for context in [pymbar.mbar_solvers.MBARContext(u_kn, N_k),
+                    pymbar.mbar_solvers.ChunkedMBARContext(u_kn, N_k, chunk_size=30),
+                    pymbar.mbar_solvers.MBARContext(u_kn, 1.5 * N_k, counts_n=counts_n)]:
+        H = context.hessian(f_k)
+        eq(context.sparse_hessian(f_k, threshold=0.0).toarray(), H, decimal=10)
+        H_sparse = context.sparse_hessian(f_k)
+        ok_(H_sparse.nnz < 0.5 * H.size)
+        eq(H_sparse.toarray(), H, decimal=6)
+        ok_(context.sparse_hessian(f_k, maximum_density=0.1) is None)
+
+    for method in ['adaptive', 'chord']:
+        protocol = (dict(method=method, options=dict(sparse_hessian=True)), dict(method='adaptive'))
+        f_k_sparse, _ = pymbar.mbar_solvers.solve_mbar(u_kn, N_k, np.zeros(16), solver_protocol=protocol)
+        eq(f_k_sparse, f_k, decimal=8)
+
+
+def test_disconnected_components():
+    """Groups of states without overlap are solved separately, and differences between them are undefined."""
+    x_n, u_a, N_a, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=[0, 1, 2], K_k=[1, 2, 1]).sample(
+        [30, 30, 30], mode='u_kn', seed=0)
+    x_n, u_b, N_b, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=[5, 6, 7, 8], K_k=[1, 1, 2, 3]).sample(
+        [40, 0, 40, 40], mode='u_kn', seed=1)
+    # Two legs in one u_kn, with infinite energies across; the empty state 4 belongs to the second.
+    u_kn = np.inf * np.ones((7, 210))
+    u_kn[:3, :90] = u_a
+    u_kn[3:, 90:] = u_b
+    N_k = np.concatenate([N_a, N_b])
+    n_components, components_k = pymbar.mbar_solvers.state_components(u_kn, N_k)
+    eq(n_components, 2)
+    eq(components_k, np.array([0, 0, 0, 1, 1, 1, 1]))
+
+    mbar_a, mbar_b = pymbar.MBAR(u_a, N_a), pymbar.MBAR(u_b, N_b)
+    for n_processes in [1, 2]:
+        mbar = pymbar.MBAR(u_kn, N_k, n_processes=n_processes)
+        eq(mbar.f_k, np.concatenate([mbar_a.f_k, mbar_b.f_k]), decimal=8)
+        # The components share one time budget.
+        f_k = pymbar.mbar_solvers.solve_mbar_for_all_states(u_kn, N_k, np.zeros(7), ({'method': 'adaptive'},),
+                                                            time_budget=60.0, n_processes=n_processes)
+        eq(f_k, mbar.f_k, decimal=8)
+        f_k = pymbar.mbar_solvers.solve_mbar_for_all_states(u_kn, N_k, np.zeros(7), ({'method': 'adaptive'},),
+                                                            time_budget=0.0, n_processes=n_processes)
+        eq(f_k, np.concatenate([pymbar.mbar_solvers.solve_mbar_for_all_states(u, N, np.zeros(len(N)), ({'method': 'adaptive'},),
+                                                                              time_budget=0.0)
+                                for u, N in [(u_a, N_a), (u_b, N_b)]]))
+    results = mbar.getFreeEnergyDifferences()
+    ok_(np.all(np.isnan(results['Delta_f'][:3, 3:])) and np.all(np.isnan(results['dDelta_f'][3:, :3])))
+    eq(results['dDelta_f'][:3, :3], mbar_a.getFreeEnergyDifferences()['dDelta_f'], decimal=8)
+    eq(results['dDelta_f'][3:, 3:], mbar_b.getFreeEnergyDifferences()['dDelta_f'], decimal=8)
+
+    # The samples of each state are located from their multiplicities.
+    counts_n = np.tile([1.0, 3.0], 105)
+    N_k_counts = np.array([counts_n[:30].sum(), counts_n[30:60].sum(), counts_n[60:90].sum(),
+                           counts_n[90:130].sum(), 0, counts_n[130:170].sum(), counts_n[170:].sum()])
+    eq(pymbar.mbar_solvers.state_components(u_kn, N_k_counts, counts_n=counts_n)[1], components_k)
+    eq(pymbar.mbar_solvers.state_components(u_kn, N_k, chunk_size=7)[1], components_k)
+
+
+def test_one_way_overlap():
+    """States reached from the others in only one direction are still solved together."""
+    x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=[0, 1, 2, 3], K_k=[1, 2, 1, 2]).sample(
+        [50, 50, 50, 50], mode='u_kn', seed=0)
+    # The samples of states 0 and 1 have finite energies in states 2 and 3, but not the other way around.
+    u_kn[:2, 100:] = np.inf
+    n_components, components_k = pymbar.mbar_solvers.state_components(u_kn, N_k)
+    eq(n_components, 1)
+    eq(components_k, np.zeros(4, dtype=np.int64))
+    mbar = pymbar.MBAR(u_kn, N_k)
+    pymbar.utils.check_w_normalized(np.exp(mbar.Log_W_nk), N_k)
+    results = mbar.getFreeEnergyDifferences()
+    ok_(np.all(np.isfinite(results['Delta_f'])) and np.all(np.isfinite(results['dDelta_f'])))
+
+
+def test_hierarchical():
+    """Solving clusters of states separately gets close, and the following step converges."""
+    O_k = np.linspace(0, 12, 13)
+    N_k = np.array([40] * 6 + [0] + [40] * 6)
+    x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=O_k, K_k=np.ones(13)).sample(
+        N_k, mode='u_kn', seed=0)
+    reference = pymbar.MBAR(u_kn, N_k).f_k
+    # Shuffle the samples; the states they came from are given by x_kindices.
+    perm = np.random.RandomState(0).permutation(len(s_n))
+    trace = []
+    protocol = [dict(method='hierarchical', options=dict(cluster_size=3, callback=trace.append))]
+    mbar = pymbar.MBAR(u_kn[:, perm], N_k, x_kindices=s_n[perm], solver_protocol=protocol)
+    ok_([record['step'] for record in trace] == ['clusters', 'coarse'])
+    ok_(np.abs(mbar.f_k - reference).max() < 0.1)
+    for n_processes in [1, 2]:
+        protocol = [dict(method='hierarchical', options=dict(cluster_size=3, n_processes=n_processes)),
+                    dict(method='anderson')]
+        mbar = pymbar.MBAR(u_kn[:, perm], N_k, x_kindices=s_n[perm], solver_protocol=protocol)
+        eq(mbar.f_k, reference, decimal=8)
+        # The hierarchical step does not test for convergence itself.
+        ok_([step['converged'] for step in mbar.solver_trace] == [False, True])
+
+    # The module-level protocol keeps no options of the data sets it was used for.
+    protocol = pymbar.mbar_solvers.HIERARCHICAL_SOLVER_PROTOCOL
+    eq(pymbar.MBAR(u_kn[:, perm], N_k, x_kindices=s_n[perm], solver_protocol=protocol).f_k, reference, decimal=8)
+    ok_(protocol == (dict(method='hierarchical'), dict(method='chord'), dict(method='anderson')))
+    x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=O_k[:8], K_k=np.ones(8)).sample(
+        30 * np.ones(8, dtype=np.int64), mode='u_kn', seed=1)
+    eq(pymbar.MBAR(u_kn, N_k, solver_protocol=protocol).f_k, pymbar.MBAR(u_kn, N_k).f_k, decimal=8)
+
+
+def test_bar_tree_initialization():
+    """BAR along the tree of best-overlapping pairs does not depend on the order of the states."""
+    O_k = np.linspace(0, 8, 17)
+    x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=O_k, K_k=np.linspace(1, 3, 17)).sample(
+        50 * np.ones(17, dtype=np.int64), mode='u_kn', seed=0)
+    # Neighbouring oscillators overlap best, so the tree is the chain of states.
+    ok_(pymbar.mbar_solvers.overlap_spanning_tree(u_kn, N_k) == [(k, k + 1) for k in range(16)])
+    mbar = pymbar.MBAR(u_kn, N_k)
+    mbar._initializeFreeEnergies(method='BAR')
+    f_k = mbar.f_k.copy()
+
+    # Shuffle the states; chaining BAR in the given order then fails, but the tree recovers the chain.
+    perm = np.random.RandomState(1).permutation(17)
+    mbar = pymbar.MBAR(u_kn[perm], N_k[perm], x_kindices=np.argsort(perm)[s_n])
+    for n_processes in [1, 2]:
+        mbar._initializeFreeEnergies(method='BAR-tree', n_processes=n_processes)
+        eq(mbar.f_k, f_k[perm] - f_k[perm[0]], decimal=8)
+    mbar._initializeFreeEnergies(method='BAR')
+    ok_(np.abs(mbar.f_k - (f_k[perm] - f_k[perm[0]])).max() > 1)
+
+
+def test_duplicate_states():
+    """Duplicated states are found without comparing all pairs, and can be solved as one state."""
+    x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=[0, 1, 1, 2, 1], K_k=[1, 1, 1, 2, 1]).sample(
+        [50, 50, 40, 50, 0], mode='u_kn', seed=0)
+    eq(pymbar.mbar_solvers.duplicate_states(u_kn), np.array([0, 1, 1, 3, 1]))
+    # Equal infinite energies agree, and differences below the tolerance are ignored.
+    u_kn = np.vstack([u_kn, u_kn[3] + 1.0e-6, u_kn[3]])
+    u_kn[[0, 6], 0] = np.inf
+    N_k = np.append(N_k, [0, 0])
+    eq(pymbar.mbar_solvers.duplicate_states(u_kn, counts_n=np.ones(190)), np.array([0, 1, 1, 3, 1, 3, 6]))
+
+    mbar = pymbar.MBAR(u_kn, N_k)
+    ok_(sorted(map(tuple, mbar.samestates)) == [(1, 2), (1, 4), (2, 1), (2, 4), (3, 5), (4, 1), (4, 2), (5, 3)])
+    collapsed = pymbar.MBAR(u_kn, N_k, collapse_duplicate_states=True)
+    eq(collapsed.f_k, mbar.f_k, decimal=8)
+    eq(collapsed.getFreeEnergyDifferences()['dDelta_f'], mbar.getFreeEnergyDifferences()['dDelta_f'], decimal=8)
+    # The pooled samples of states 1, 2 and 4 come from the same distribution.
+    eq(collapsed.f_k[[0, 1, 3]], pymbar.MBAR(u_kn[[0, 1, 3]], np.array([50, 90, 50])).f_k, decimal=8)
+
+
+def test_solve_mbar_batch():
+    """A batched solve of a stack of problems matches solving each one separately."""
+    u_bkn, N_bk = [], []
+    for seed in range(4):
+        x_n, u_kn, N_k, s_n = pymbar.testsystems.HarmonicOscillatorsTestCase(O_k=[0, 1, 2, 3], K_k=[1, 2, 1, 2]).sample(
+            [20, 0, 20, 20], mode='u_kn', seed=seed)
+        u_bkn.append(u_kn)
+        N_bk.append(N_k)
+    f_bk = pymbar.mbar_solvers.solve_mbar_batch(u_bkn, N_bk)
+    for u_kn, N_k, f_k in zip(u_bkn, N_bk, f_bk):
+        eq(f_k, pymbar.MBAR(u_kn, N_k).f_k, decimal=8)
+
+    # Bootstrap replicates share u_kn and differ in their sample counts.
+    counts_bn = np.array([np.ones(60), np.repeat([2, 0], 30), np.tile([0, 1, 2], 20)])
+    N_bk = np.array([np.bincount(np.repeat([0, 2, 3], 20), weights=counts_n, minlength=4) for counts_n in counts_bn])
+    f_bk = pymbar.mbar_solvers.solve_mbar_batch(u_bkn[0], N_bk, counts_bn=counts_bn)
+    for counts_n, N_k, f_k in zip(counts_bn, N_bk, f_bk):
+        eq(f_k, pymbar.MBAR(u_bkn[0], N_k, counts_n=counts_n).f_k, decimal=8)
+
+
+def _free_energy_differences(mbar):
+    return mbar.getFreeEnergyDifferences(compute_uncertainty=False)['Delta_f']
+
+
+def _expectations(mbar, A_n):
+    return mbar.computeExpectations(A_n, compute_uncertainty=False)['mu']
+
+
+def test_bootstrap():
+    """Bootstrap replicates are reproducible, whatever the number of processes, and agree with the analytic error."""
+    name, u_kn, N_k, s_n = load_oscillators(4, 100)
+    mbar = pymbar.MBAR(u_kn, N_k)
+    # Functions are sent to the worker processes, so they must be picklable.
+    functions = {'Delta_f': _free_energy_differences, 'u': functools.partial(_expectations, A_n=u_kn[0])}
+    results = mbar.bootstrap(200, functions=functions, seed=0)
+    eq(results['f_k'].shape, (200, 4))
+    eq(results['u'].shape, (200, 4))
+    dDelta_f = mbar.getFreeEnergyDifferences()['dDelta_f']
+    ok_(np.all(np.abs(results['Delta_f'].std(0)[0, 1:] / dDelta_f[0, 1:] - 1) < 0.3))
+
+    results_parallel = mbar.bootstrap(4, functions=functions, seed=1, n_processes=2)
+    eq(results_parallel['Delta_f'], mbar.bootstrap(4, functions=functions, seed=1)['Delta_f'])
@@ -33,3 +33,16 @@ def test_logsum():
     y1 = pymbar.utils.logsumexp(u)
     y2 = pymbar.utils._logsum(u)
     eq(y1, y2, decimal=12)
+
+def test_blocked_logsumexp():
+    a = np.random.normal(size=(50, 300))
+    b = np.random.normal(size=(50, 1)) ** 2.
+    offset = np.random.normal(size=(300,))
+
+    for axis in range(a.ndim):
+        ans_scipy = logsumexp(offset - a, b=b, axis=axis)
+        for a_layout in [a, np.asfortranarray(a)]:
+            for n_threads in [1, 3]:
+                ans_blocked = pymbar.utils.blocked_logsumexp(a_layout, axis, b=b, offset=offset, negate=True,
+                                                             n_threads=n_threads, block_size=1000)
+                eq(ans_blocked, ans_scipy)
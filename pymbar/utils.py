@@ -24,6 +24,9 @@
 ##############################################################################
 
 from six.moves import zip_longest
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import threading
 import warnings
 import numpy as np
 
@@ -125,6 +128,84 @@ def kn_to_n(kn, N_k = None, cleanup = False):
     return n
 
 
+class FactorizedReducedPotential(object):
+    """Reduced potential energies of the form u_kn[k, n] = sum_m coefficients_km[k, m] * descriptors_mn[m, n].
+
+    Temperature, pressure and chemical potential sweeps have this form with only a few
+    components, e.g. ``coefficients_km = [beta_k, beta_k * p_k]`` and ``descriptors_mn = [U(x_n), V(x_n)]``.
+    Only the two factors are stored, in O((K + N) M) memory; indexing evaluates the requested
+    block of u_kn on demand, so this can be passed as ``u_kn`` wherever the columns are read in blocks,
+    e.g. to :class:`pymbar.MBAR` or :class:`pymbar.mbar_solvers.ChunkedMBARContext`.
+    ``np.asarray()`` gives the full matrix.
+
+    Parameters
+    ----------
+    coefficients_km : np.ndarray, float, shape=(K, M)
+        Coefficients of each component in each state
+    descriptors_mn : np.ndarray, float, shape=(M, N)
+        Value of each component for each sample
+
+    Notes
+    -----
+    Indexing follows numpy: ``u_kn[rows, columns]`` with two index arrays selects the elements
+    at paired rows and columns, and ``u_kn[np.ix_(rows, columns)]`` the rows x columns block.
+    """
+
+    def __init__(self, coefficients_km, descriptors_mn):
+        self.coefficients_km = np.atleast_2d(np.asarray(coefficients_km, dtype=np.float64))
+        self.descriptors_mn = np.atleast_2d(np.asarray(descriptors_mn, dtype=np.float64))
+        if self.coefficients_km.ndim != 2 or self.descriptors_mn.ndim != 2:
+            raise ParameterError("coefficients_km and descriptors_mn must be two-dimensional")
+        if self.coefficients_km.shape[1] != self.descriptors_mn.shape[0]:
+            raise ParameterError("coefficients_km has %d components, but descriptors_mn has %d" %
+                                 (self.coefficients_km.shape[1], self.descriptors_mn.shape[0]))
+        self.shape = (self.coefficients_km.shape[0], self.descriptors_mn.shape[1])
+        self.ndim = 2
+        self.dtype = np.dtype(np.float64)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > 2:
+            raise IndexError("too many indices for FactorizedReducedPotential")
+        key = tuple(key) + (slice(None),) * (2 - len(key))
+        rows, columns = [index if isinstance(index, slice) else np.asarray(index) for index in key]
+        # Boolean masks select the positions where they are True.
+        rows, columns = [index.nonzero()[0] if getattr(index, 'dtype', None) == bool else index for index in (rows, columns)]
+        if isinstance(rows, slice) or isinstance(columns, slice) or rows.ndim == 0 or columns.ndim == 0:
+            # Each index selects along its own axis.
+            u = np.tensordot(self.coefficients_km[rows], self.descriptors_mn[:, columns], axes=(-1, 0))
+            return u[()] if u.ndim == 0 else u
+        if rows.ndim == 2 and columns.ndim == 2 and rows.shape[1] == 1 and columns.shape[0] == 1:
+            # A block from np.ix_, evaluated without broadcasting the components.
+            return np.dot(self.coefficients_km[rows[:, 0]], self.descriptors_mn[:, columns[0]])
+        # Index arrays are broadcast against each other and select elements.
+        rows, columns = np.broadcast_arrays(rows, columns)
+        return np.einsum('...m,m...->...', self.coefficients_km[rows], self.descriptors_mn[:, columns])
+
+    def __array__(self, dtype=None):
+        u_kn = np.dot(self.coefficients_km, self.descriptors_mn)
+        return u_kn if dtype is None else u_kn.astype(dtype)
+
+    def with_coefficients(self, coefficients_km):
+        """Return the reduced potentials of the same samples in other states, e.g. at new temperatures.
+
+        Parameters
+        ----------
+        coefficients_km : np.ndarray, float, shape=(L, M)
+            Coefficients of each component in each new state
+
+        Returns
+        -------
+        u_ln : FactorizedReducedPotential, shape=(L, N)
+            The reduced potentials, sharing descriptors_mn with this one
+        """
+        return FactorizedReducedPotential(coefficients_km, self.descriptors_mn)
+
+
 def ensure_type(val, dtype, ndim, name, length=None, can_be_none=False, shape=None,
                 warn_on_cast=True, add_newaxis_on_deficient_ndim=False):
     """Typecheck the size, shape and dtype of a numpy array, with optional
@@ -311,17 +392,20 @@ def logsumexp(a, axis=None, b=None, use_numexpr=True):
     elif not np.isfinite(a_max):
         a_max = 0
 
+    # Accumulate single-precision input in double precision.
+    dtype = np.result_type(a.dtype, np.float64)
+
     if b is not None:
         b = np.asarray(b)
         if use_numexpr and HAVE_NUMEXPR:
-            out = np.log(numexpr.evaluate("b * exp(a - a_max)").sum(axis))
+            out = np.log(numexpr.evaluate("b * exp(a - a_max)").sum(axis, dtype=dtype))
         else:
-            out = np.log(np.sum(b * np.exp(a - a_max), axis=axis))
+            out = np.log(np.sum(b * np.exp(a - a_max), axis=axis, dtype=dtype))
     else:
         if use_numexpr and HAVE_NUMEXPR:
-            out = np.log(numexpr.evaluate("exp(a - a_max)").sum(axis))
+            out = np.log(numexpr.evaluate("exp(a - a_max)").sum(axis, dtype=dtype))
         else:
-            out = np.log(np.sum(np.exp(a - a_max), axis=axis))
+            out = np.log(np.sum(np.exp(a - a_max), axis=axis, dtype=dtype))
 
     a_max = np.squeeze(a_max, axis=axis)
     out += a_max
@@ -329,7 +413,170 @@ def logsumexp(a, axis=None, b=None, use_numexpr=True):
     return out
 
 
-def check_w_normalized(W, N_k, tolerance = 1.0e-4):
+# Number of elements of the tiles processed by `blocked_logsumexp` (512 KB of float64).
+LOGSUMEXP_BLOCK_SIZE = 2**16
+# Shortest run of contiguous elements `blocked_logsumexp` reads when it sums across rows.
+MINIMUM_CONTIGUOUS_RUN = 256
+
+_thread_pools = dict()
+_thread_pools_lock = threading.Lock()
+_thread_buffers = threading.local()
+
+
+def _get_thread_pool(n_threads):
+    """Return a persistent pool of n_threads worker threads."""
+    with _thread_pools_lock:
+        pool = _thread_pools.get(n_threads)
+        if pool is None:
+            pool = ThreadPool(n_threads)
+            _thread_pools[n_threads] = pool
+    return pool
+
+
+def _get_buffer(size):
+    """Return a float64 scratch buffer of at least `size` elements that belongs to the calling thread."""
+    buffer = getattr(_thread_buffers, 'buffer', None)
+    if buffer is None or buffer.size < size:
+        buffer = np.empty(size, dtype=np.float64)
+        _thread_buffers.buffer = buffer
+    return buffer[:size]
+
+
+def blocked_logsumexp(a, axis, b=None, offset=None, negate=False, n_threads=1, block_size=None):
+    """Compute log(sum(b * exp(offset +/- a))) along one axis of a 2D array, tile by tile.
+
+    The array is processed in tiles of about `block_size` elements that stay in cache.
+    Each tile is reduced to a running maximum and a scaled partial sum, and the partial
+    results are combined at the end, so no temporary of the size of `a` is ever formed.
+    Tiles follow the memory layout of `a`: when the summed axis is the strided one (e.g.
+    axis=0 of a C-ordered u_kn, or axis=1 of a Fortran-ordered one), each tile is read as
+    contiguous rows and reduced across them, rather than gathered into a transposed copy.
+    Sums along short contiguous rows (fewer than MINIMUM_CONTIGUOUS_RUN elements) are also
+    carried out across rows, which is faster in numpy than many short reductions.
+    Tiles are distributed over `n_threads` threads; numpy releases the GIL in the
+    elementwise kernels, so this gives a parallel speedup without numexpr.
+
+    Parameters
+    ----------
+    a : np.ndarray, shape=(M, L)
+        Input array, in any floating point dtype.  Accumulation is in double precision.
+    axis : int
+        Axis (0 or 1) over which the sum is taken.
+    b : array-like, optional
+        Scaling factor for the exponentials, broadcastable to `a`.
+    offset : array-like, optional
+        Added to (+/-) `a` before exponentiation, broadcastable to `a`.
+    negate : bool, optional, default=False
+        If True, compute log(sum(b * exp(offset - a))) instead.
+    n_threads : int, optional, default=1
+        Number of threads to use.  If None or 0, use one thread per CPU.
+    block_size : int, optional, default=LOGSUMEXP_BLOCK_SIZE
+        Approximate number of elements in each tile.
+
+    Returns
+    -------
+    res : np.ndarray, shape=(L,) if axis is 0, (M,) if axis is 1
+        The result, equal to ``logsumexp(offset +/- a, axis=axis, b=b)``.
+
+    Examples
+    --------
+    >>> u_kn = np.array([[0.0, 1.0, 2.0], [1.0, 0.5, 0.0]])
+    >>> f_k = np.array([0.0, 0.3])
+    >>> x = blocked_logsumexp(u_kn, axis=0, offset=f_k[:, np.newaxis], negate=True)
+    >>> np.allclose(x, logsumexp(f_k[:, np.newaxis] - u_kn, axis=0))
+    True
+    """
+    a = np.asarray(a)
+    if a.ndim != 2 or axis not in (0, 1, -1, -2):
+        raise ParameterError("blocked_logsumexp requires a 2D array and axis 0 or 1")
+    if b is not None:
+        b = np.broadcast_to(b, a.shape)
+    if offset is not None:
+        offset = np.broadcast_to(offset, a.shape)
+    if axis in (0, -2):
+        # Reduce along the rows of the transposed views.
+        a = a.T
+        b = None if b is None else b.T
+        offset = None if offset is None else offset.T
+    if not n_threads:
+        n_threads = multiprocessing.cpu_count()
+    if block_size is None:
+        block_size = LOGSUMEXP_BLOCK_SIZE
+
+    [M, L] = a.shape
+    if M == 0:
+        return np.zeros(0, dtype=np.float64)
+    if L == 0:
+        return np.repeat(-np.inf, M)
+    block_size = max(int(block_size), 1)
+    # Sum along the rows of a (axis 1) if they are long and contiguous in memory, otherwise across the
+    # rows of a.T, which numpy vectorizes over M instead of paying a per-row overhead for short rows.
+    across = M > 1 and L > 1 and (abs(a.strides[1]) > abs(a.strides[0]) or L < MINIMUM_CONTIGUOUS_RUN)
+    if across:
+        # Keep contiguous runs long enough to stream whole cache lines.
+        row_block = min(M, max(MINIMUM_CONTIGUOUS_RUN, block_size // L))
+        column_block = max(1, min(L, block_size // row_block))
+    else:
+        column_block = min(L, block_size)
+        row_block = max(1, block_size // column_block)
+    row_starts = range(0, M, row_block)
+    column_starts = range(0, L, column_block)
+    # Partial results for every column block: running maximum and sum of exp(x - maximum).
+    partial_max = np.empty([len(column_starts), M], dtype=np.float64)
+    partial_sum = np.empty([len(column_starts), M], dtype=np.float64)
+
+    def reduce_tile(tile):
+        j, i0, j0 = tile
+        i1 = min(i0 + row_block, M)
+        j1 = min(j0 + column_block, L)
+        if across:
+            # Tiles of a.T, summed along axis 0.
+            x = _get_buffer((i1 - i0) * (j1 - j0)).reshape(j1 - j0, i1 - i0)
+            a_tile = a[i0:i1, j0:j1].T
+            b_tile = None if b is None else b[i0:i1, j0:j1].T
+            offset_tile = None if offset is None else offset[i0:i1, j0:j1].T
+            sum_axis = 0
+        else:
+            x = _get_buffer((i1 - i0) * (j1 - j0)).reshape(i1 - i0, j1 - j0)
+            a_tile = a[i0:i1, j0:j1]
+            b_tile = None if b is None else b[i0:i1, j0:j1]
+            offset_tile = None if offset is None else offset[i0:i1, j0:j1]
+            sum_axis = 1
+        if negate:
+            np.negative(a_tile, out=x)
+        else:
+            x[...] = a_tile
+        if offset_tile is not None:
+            x += offset_tile
+        x_max = x.max(axis=sum_axis)
+        x_max[~np.isfinite(x_max)] = 0
+        x -= np.expand_dims(x_max, sum_axis)
+        np.exp(x, out=x)
+        if b_tile is not None:
+            x *= b_tile
+        partial_max[j, i0:i1] = x_max
+        x.sum(axis=sum_axis, out=partial_sum[j, i0:i1])
+
+    tiles = [(j, i0, j0) for (j, j0) in enumerate(column_starts) for i0 in row_starts]
+    if n_threads > 1 and len(tiles) > 1:
+        _get_thread_pool(n_threads).map(reduce_tile, tiles)
+    else:
+        for tile in tiles:
+            reduce_tile(tile)
+
+    # Blocks whose terms all vanish must not set the scale of the combined sum.
+    partial_max[~(partial_sum > 0)] = -np.inf
+    res_max = partial_max.max(axis=0)
+    res_max[~np.isfinite(res_max)] = 0
+    partial_max -= res_max
+    np.exp(partial_max, out=partial_max)
+    partial_sum *= partial_max
+    res = np.log(partial_sum.sum(axis=0))
+    res += res_max
+    return res
+
+
+def check_w_normalized(W, N_k, tolerance = 1.0e-4, counts_n = None):
     """Check the weight matrix W is properly normalized. The sum over N should be 1, and the sum over k by N_k should aslo be 1
 
     Parameters
@@ -341,6 +588,9 @@ def check_w_normalized(W, N_k, tolerance = 1.0e-4):
         N_k[k] is the number of samples from state k.
     tolerance : float, optional, default=1.0e-4
         Tolerance for checking equality of sums
+    counts_n : np.ndarray, shape=(N), dtype='float', optional, default=None
+        Multiplicity of each snapshot.  If given, W[n, k] is the total weight of the
+        counts_n[n] copies of snapshot n, and the sum over k by N_k should be counts_n[n].
 
     Returns
     -------
@@ -350,7 +600,7 @@ def check_w_normalized(W, N_k, tolerance = 1.0e-4):
 
     [N, K] = W.shape
 
-    column_sums = np.sum(W, axis=0)
+    column_sums = np.sum(W, axis=0, dtype=np.float64)
     badcolumns = (np.abs(column_sums - 1) > tolerance)
     if np.any(badcolumns):
         which_badcolumns = np.arange(K)[badcolumns]
@@ -359,8 +609,11 @@ def check_w_normalized(W, N_k, tolerance = 1.0e-4):
             'Warning: Should have \sum_n W_nk = 1.  Actual column sum for state %d was %f. %d other columns have similar problems' %
             (firstbad, column_sums[firstbad], np.sum(badcolumns)))
 
-    row_sums = np.sum(W * N_k, axis=1)
-    badrows = (np.abs(row_sums - 1) > tolerance)
+    row_sums = np.sum(W * N_k.astype(W.dtype), axis=1, dtype=np.float64)
+    if counts_n is None:
+        badrows = (np.abs(row_sums - 1) > tolerance)
+    else:
+        badrows = (np.abs(row_sums - counts_n) > tolerance * np.maximum(counts_n, 1))
     if np.any(badrows):
         which_badrows = np.arange(N)[badrows]
         firstbad = which_badrows[0]